@@ -1,12 +1,47 @@
-from flask import Flask
+from flask import Flask, current_app, has_app_context
 import json
+from threading import Lock
 from config import config as configs
+from elasticsearch import Elasticsearch
 from flask_elasticsearch import FlaskElasticsearch
 
 from dmutils.flask import DMGzipMiddleware
 from dmutils.flask_init import init_app, api_error_handlers
 
-elasticsearch_client = FlaskElasticsearch()
+
+class SharedFlaskElasticsearch(FlaskElasticsearch):
+    """A FlaskElasticsearch which creates one client per app rather than one per app context, so that requests share
+    its pool of connections instead of each opening their own"""
+
+    # so that concurrent first requests don't each create a client of their own
+    _client_lock = Lock()
+
+    def init_app(self, app, **kwargs):
+        super().init_app(app, **kwargs)
+        # created on first use, once the app's config is final
+        app.extensions["dm_elasticsearch"] = None
+
+    def __getattr__(self, item):
+        if item.startswith("_"):
+            raise AttributeError(item)
+        if not has_app_context():
+            return None
+
+        client = current_app.extensions["dm_elasticsearch"]
+        if client is None:
+            with self._client_lock:
+                client = current_app.extensions["dm_elasticsearch"]
+                if client is None:
+                    hosts = current_app.config["ELASTICSEARCH_HOST"]
+                    client = current_app.extensions["dm_elasticsearch"] = Elasticsearch(
+                        hosts=[hosts] if isinstance(hosts, str) else hosts,
+                        http_auth=current_app.config.get("ELASTICSEARCH_HTTP_AUTH"),
+                        **self.elasticsearch_options
+                    )
+        return getattr(client, item)
+
+
+elasticsearch_client = SharedFlaskElasticsearch()
 
 
 def get_service_by_name_from_vcap_services(vcap_services, name):
@@ -38,12 +73,28 @@ def create_app(config_name):
     elasticsearch_client.init_app(
         application,
         verify_certs=True,
+        maxsize=application.config['DM_ELASTICSEARCH_MAXSIZE'],
     )
 
+    from .json_provider import json_provider
     from .metrics import metrics as metrics_blueprint, gds_metrics
+    from .mapping import mapping_cache
     from .main import main as main_blueprint
+    from .main.services.meta_response_cache import meta_response_cache
+    from .main.services.search_response_cache import search_response_cache
+    from .main.services.single_flight import single_flight
+    from .main.services.slow_query_log import slow_query_log
+    from .main.services.write_behind_queue import write_behind_queue
     from .status import status as status_blueprint
 
+    json_provider.init_app(application)
+    mapping_cache.init_app(application)
+    meta_response_cache.init_app(application)
+    search_response_cache.init_app(application)
+    single_flight.init_app(application)
+    slow_query_log.init_app(application)
+    write_behind_queue.init_app(application)
+
     application.register_blueprint(metrics_blueprint)
     application.register_blueprint(status_blueprint)
     application.register_blueprint(main_blueprint)
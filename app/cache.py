@@ -0,0 +1,203 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask import copy_current_request_context, current_app, json
+
+
+class LRUCache(object):
+    """A thread-safe, size-bounded, least-recently-used cache whose entries also expire after ``ttl`` seconds.
+
+    A ``max_size`` of 0 disables the cache (nothing is ever stored) and a ``ttl`` of None means entries only leave the
+    cache through eviction or invalidation.
+    """
+
+    def __init__(self, max_size, ttl=None, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # {key: (expiry_time_or_None, value)}
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expiry, value = self._entries[key]
+            except KeyError:
+                return default
+
+            if expiry is not None and expiry <= self._clock():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if not self.max_size:
+            return
+
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def setdefault(self, key, value):
+        """The value cached for ``key``, first caching ``value`` for it if there isn't one"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > self._clock()):
+                self._entries.move_to_end(key)
+                return entry[1]
+            if self.max_size:
+                self._set(key, value, None)
+            return value
+
+    def _set(self, key, value, ttl):
+        ttl = self.ttl if ttl is None else ttl
+        self._entries[key] = (None if ttl is None else self._clock() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_where(self, predicate):
+        """Remove every entry for which ``predicate(key, value)`` is true"""
+        with self._lock:
+            for key in [key for key, (_, value) in self._entries.items() if predicate(key, value)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class InProcessCacheBackend(object):
+    """A `SearchResponseCache` backend keeping entries in this worker's own memory, bounded by ``max_size`` entries
+    besides up to ``max_unexpiring`` which don't expire (but can still be evicted, least recently used first)"""
+
+    shared = False
+
+    def __init__(self, max_size, ttl=None, max_unexpiring=256):
+        self._cache = LRUCache(max_size, ttl)
+        self._unexpiring = LRUCache(max_unexpiring)
+
+    def get(self, key):
+        value = self._unexpiring.get(key)
+        return self._cache.get(key) if value is None else value
+
+    def set(self, key, value, expire=True):
+        if expire:
+            self._cache.set(key, value)
+        else:
+            self._unexpiring.set(key, value)
+
+    def add(self, key, value):
+        """Store ``value`` under ``key``, never to expire, unless something already is, returning what then is"""
+        return self._unexpiring.setdefault(key, value)
+
+
+class RedisCacheBackend(object):
+    """A `SearchResponseCache` backend shared by every worker (and instance) pointed at the same Redis, so that a write
+    handled by one worker is seen by all of them.
+
+    Values must be JSON-serializable. Memory use is bounded by Redis' own ``maxmemory`` policy rather than by us, and
+    if Redis can't be reached every lookup is simply a miss.
+    """
+
+    shared = True
+
+    def __init__(self, url, ttl=None, key_prefix="dm-search-api:"):
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+        self._error = redis.RedisError
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+
+    def get(self, key):
+        try:
+            value = self._redis.get(self.key_prefix + key)
+        except self._error as e:
+            current_app.logger.warning("Failed to read from the response cache: %s", e)
+            return None
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, expire=True):
+        try:
+            self._redis.set(self.key_prefix + key, json.dumps(value), ex=self.ttl if expire else None)
+        except self._error as e:
+            current_app.logger.warning("Failed to write to the response cache: %s", e)
+
+    def add(self, key, value):
+        """Store ``value`` under ``key``, never to expire, unless something already is, returning what then is (or
+        ``value`` if Redis can't be reached)"""
+        try:
+            if self._redis.set(self.key_prefix + key, json.dumps(value), nx=True):
+                return value
+            stored = self._redis.get(self.key_prefix + key)
+        except self._error as e:
+            current_app.logger.warning("Failed to write to the response cache: %s", e)
+            return value
+        return value if stored is None else json.loads(stored)
+
+
+class RefreshingCache(object):
+    """A cache of values which are expensive to compute but may safely be a little out of date, which recomputes them
+    in the background rather than making a request wait.
+
+    A value is served as it is for ``ttl`` seconds after being computed. After that the next lookup starts recomputing
+    it in a background thread (with a copy of the request context) and is served the old value in the meantime, as is
+    every lookup until the new one is ready. A value more than ``max_stale`` seconds old is no longer served at all,
+    and is recomputed by the lookup that finds it so. Should recomputing a value in the background fail, the old one
+    goes on being served until it has been stale for that long.
+    """
+
+    def __init__(self, ttl, max_stale, max_size=16, clock=time.monotonic):
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = LRUCache(max_size, ttl=max_stale, clock=clock)  # {key: (time_computed, value)}
+        self._lock = threading.Lock()
+        self._refreshing = set()
+
+    def get(self, key, compute):
+        """The value cached for ``key``, using ``compute()`` to compute it if it isn't cached or is out of date"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return self._compute(key, compute)
+
+        computed_at, value = entry
+        if self._clock() - computed_at >= self.ttl:
+            with self._lock:
+                already_refreshing = key in self._refreshing
+                self._refreshing.add(key)
+            if not already_refreshing:
+                threading.Thread(
+                    target=copy_current_request_context(lambda: self._refresh(key, compute)),
+                    daemon=True,
+                ).start()
+        return value
+
+    def _compute(self, key, compute):
+        value = compute()
+        self._entries.set(key, (self._clock(), value))
+        return value
+
+    def _refresh(self, key, compute):
+        try:
+            self._compute(key, compute)
+        except Exception as e:
+            current_app.logger.warning("Failed to refresh cached value for %r: %s", key, e)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def discard(self, key):
+        self._entries.delete(key)
+
+    def clear(self):
+        self._entries.clear()
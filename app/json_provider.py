@@ -0,0 +1,120 @@
+from flask import current_app, json, jsonify
+
+from app.prometheus_metrics import timed_stage
+
+
+class JSONProvider(object):
+    """Serializes responses and parses request bodies with [orjson](https://github.com/ijl/orjson) when it's installed
+    and ``DM_FAST_JSON`` is set, and with Flask's own (stdlib-based) JSON functions otherwise.
+
+    orjson can't sort keys, pretty-print or escape non-ASCII characters, so responses are only serialized with it when
+    ``JSON_SORT_KEYS``, ``JSON_AS_ASCII``, ``JSONIFY_PRETTYPRINT_REGULAR`` and debug mode are all off, and with any
+    other settings (such as those used in tests) `flask.jsonify` is used. Its output is then the same as
+    `flask.jsonify`'s except for floats: those the stdlib gives in exponent notation (such as the scores of poorly
+    matching documents, or 1e16 and above) may be written differently, though they parse to the same values, and NaN
+    and infinity are written as null rather than as the (invalid JSON) NaN and Infinity. Checking each response for
+    them would cost more than orjson saves. Anything orjson won't serialize (or parse) is handed to Flask's functions,
+    so the same values are accepted and the same errors raised either way.
+    """
+
+    def init_app(self, app):
+        orjson = None
+        if app.config["DM_FAST_JSON"]:
+            try:
+                import orjson
+            except ImportError:
+                pass
+        app.extensions["dm_json_provider"] = orjson
+
+    @property
+    def _orjson(self):
+        return current_app.extensions["dm_json_provider"]
+
+    def _can_serialize_fast(self):
+        config = current_app.config
+        return self._orjson is not None and not (
+            config["JSON_SORT_KEYS"]
+            or config["JSON_AS_ASCII"]
+            or config["JSONIFY_PRETTYPRINT_REGULAR"]
+            or current_app.debug
+        )
+
+    def _fast_dumps(self, obj, newline=False):
+        orjson = self._orjson
+        return orjson.dumps(
+            obj,
+            # leave dates to Flask's encoder, which formats them differently to orjson, and subclasses of builtin types
+            # to `_default`, as orjson would serialize a dict subclass such as a MultiDict by what it stores rather than
+            # by its items
+            default=self._default,
+            option=(
+                orjson.OPT_PASSTHROUGH_DATETIME
+                | orjson.OPT_PASSTHROUGH_SUBCLASS
+                | (orjson.OPT_APPEND_NEWLINE if newline else 0)
+            ),
+        )
+
+    @staticmethod
+    def _default(obj):
+        """Converts subclasses of builtin types to the types themselves, as the stdlib encoder treats them"""
+        if isinstance(obj, dict):
+            return dict(obj.items())
+        if isinstance(obj, list):
+            return list(obj)
+        if isinstance(obj, str):
+            return str.__str__(obj)
+        if isinstance(obj, int):
+            return int.__int__(obj)
+        return current_app.json_encoder().default(obj)
+
+    def jsonify(self, *args, **kwargs):
+        """A drop-in replacement for `flask.jsonify`"""
+        with timed_stage("serialization"):
+            return self._jsonify(*args, **kwargs)
+
+    def _jsonify(self, *args, **kwargs):
+        if self._can_serialize_fast():
+            if args and kwargs:
+                raise TypeError("jsonify() behavior undefined when passed both args and kwargs")
+            try:
+                body = self._fast_dumps(args[0] if len(args) == 1 else (args or kwargs), newline=True)
+            except self._orjson.JSONEncodeError:
+                pass
+            else:
+                return current_app.response_class(body, mimetype=current_app.config["JSONIFY_MIMETYPE"])
+
+        return jsonify(*args, **kwargs)
+
+    def dumps(self, obj):
+        """A replacement for `flask.json.dumps`, giving compact output (with no spaces after separators) when orjson is
+        used"""
+        if self._can_serialize_fast():
+            try:
+                return self._fast_dumps(obj).decode("utf-8")
+            except self._orjson.JSONEncodeError:
+                pass
+
+        return json.dumps(obj)
+
+    def loads(self, s):
+        """A drop-in replacement for `flask.json.loads`"""
+        if self._orjson is not None:
+            try:
+                return self._orjson.loads(s)
+            except self._orjson.JSONDecodeError:
+                pass  # so the error is the same as it would otherwise be
+
+        return json.loads(s)
+
+    def get_json(self, request):
+        """A replacement for ``request.get_json()``, returning None (as it does) if the request isn't JSON"""
+        if self._orjson is not None and request.is_json:
+            try:
+                return self._orjson.loads(request.get_data(cache=True))
+            except self._orjson.JSONDecodeError:
+                pass  # so the error is the same as it would otherwise be
+
+        return request.get_json()
+
+
+json_provider = JSONProvider()
@@ -0,0 +1,72 @@
+import gzip
+
+from flask import current_app, request
+
+from app.cache import RefreshingCache
+
+
+class MetaResponseCache(object):
+    """Per-worker cache of the responses of endpoints, such as the API root and `_status`, which are expensive to build
+    (asking Elasticsearch about every index) but polled constantly. Each is kept both as it is and gzipped, so serving
+    one takes neither Elasticsearch nor compression.
+
+    Responses are rebuilt in the background once they are ``DM_META_RESPONSE_CACHE_TTL`` seconds old, so at most one
+    request per worker every that many seconds goes as far as Elasticsearch, and are no longer served at all once
+    ``DM_META_RESPONSE_CACHE_MAX_STALE`` seconds old (see `RefreshingCache`). Changes made through this app to which
+    indexes and aliases exist should call `invalidate`.
+
+    Error responses aren't cached: one is served only to the request which got it, and whatever was cached before it is
+    discarded, so that the next request asks again rather than being told everything's fine.
+    """
+
+    def init_app(self, app):
+        app.extensions["dm_meta_response_cache"] = RefreshingCache(
+            ttl=app.config["DM_META_RESPONSE_CACHE_TTL"],
+            max_stale=app.config["DM_META_RESPONSE_CACHE_MAX_STALE"],
+        )
+
+    @property
+    def _cache(self):
+        return current_app.extensions["dm_meta_response_cache"]
+
+    def response(self, key, view):
+        """Serve the response cached for ``key`` (which must include anything besides the app's state which affects
+        the response), calling ``view()`` for a new one when needed. ``view`` returns a response, or a
+        ``(response, status_code)`` tuple, as a view function would."""
+        key = key + (request.url_root,)
+
+        def render():
+            response = current_app.make_response(view())
+            if not 200 <= response.status_code < 300:
+                self._cache.discard(key)
+                raise _ErrorResponse(response)
+            body = response.get_data()
+            return body, gzip.compress(body), response.status_code, response.mimetype
+
+        try:
+            body, gzipped_body, status_code, mimetype = self._cache.get(key, render)
+        except _ErrorResponse as e:
+            return e.response
+
+        # the same test of whether the client accepts gzip as `flask_gzip` makes
+        if "gzip" in request.headers.get("Accept-Encoding", "").lower():
+            response = current_app.response_class(gzipped_body, status=status_code, mimetype=mimetype)
+            response.headers["Content-Encoding"] = "gzip"
+            # it's already compressed
+            response.headers["X-Compression-Safe"] = "0"
+        else:
+            response = current_app.response_class(body, status=status_code, mimetype=mimetype)
+        response.vary.add("Accept-Encoding")
+        return response
+
+    def invalidate(self):
+        self._cache.clear()
+
+
+class _ErrorResponse(Exception):
+    def __init__(self, response):
+        super().__init__("{} response".format(response.status))
+        self.response = response
+
+
+meta_response_cache = MetaResponseCache()
@@ -1,10 +1,13 @@
 import hashlib
+import heapq
 from itertools import chain
 
 import six
 from flask import request
 from werkzeug.exceptions import abort
 
+from app.json_provider import json_provider
+
 
 def _ensure_value_list(json_string_or_list):
     if isinstance(json_string_or_list, list):
@@ -13,76 +16,299 @@ def _ensure_value_list(json_string_or_list):
         return [json_string_or_list]
 
 
-def _append_conditionally(arguments, document):
-    """
-    A transformation processor that generates new field values in "target field" when
-    certain values are present in "field". The example use case is when
-    we are adding parent categories, whenever any one of their subcategories
-    is present.
-    :param arguments: dict -- the parameters to the processor as specified in configuration
-    :param document: dict -- the submitted document that we are transforming
+def _compile_conditionally(transformation_type, rules):
     """
-    _set_conditionally(arguments, document, append=True)
+    Compiles a run of consecutive "append_conditionally" or "set_conditionally" transformations, all with the same
+    "field" and "target field", into one transformation processor.
 
+    "set_conditionally" sets field values in "target field" when certain values are present in "field" - the example
+    use case is converting awarded, unsuccessful or cancelled brief status to closed. "append_conditionally" appends
+    to them instead, the example use case being adding parent categories whenever any one of their subcategories is
+    present.
 
-def _set_conditionally(arguments, document, append=False):
-    """
-    A transformation processor that sets field values in "target field" when
-    certain values are present in "field". The example use case is when
-    we are converting awarded, unsuccessful or cancelled brief status to closed.
-    :param arguments: dict -- the parameters to the processor as specified in configuration
-    :param document: dict -- the submitted document that we are transforming
-    :param append: bool -- if true, then the target field is appended to instead of set. See the function above.
+    Rather than testing every value of each rule's "any_of" against the document, the document's values are looked up
+    in an inverted index of them, so the cost of transforming a document depends on how many values it has rather
+    than how many rules there are. The result is the same as applying each rule in turn: a rule whose "target field"
+    is its "field" sees the values appended by the rules before it.
+    :param transformation_type: str -- "append_conditionally" or "set_conditionally"
+    :param rules: list -- the parameters to each transformation as specified in configuration
+    :return: function -- the transformation processor, which takes the submitted document and transforms it in place
     """
+    source_field = rules[0]['field']
+    target_field = rules[0].get('target_field') or source_field
+    rules_by_value = _index_rules_by_value(rules)
+
+    if transformation_type == 'set_conditionally':
+        set_values = tuple(rule['set_value'] for rule in rules)
+
+        def _set_conditionally(document):
+            if source_field in document:
+                matched = _matching_rules(rules_by_value, document[source_field])
+                if matched:
+                    # each rule would have overwritten the one before
+                    document[target_field] = set_values[max(matched)]
 
-    source_field = arguments['field']
-    target_field = arguments.get('target_field') or source_field
+        return _set_conditionally
 
-    if source_field in document:
-        source_values = _ensure_value_list(document[source_field])
-        source_values_set = set(source_values)
-        target_values = _ensure_value_list(document.get(target_field, []))
+    # "append_value" key singular despite being a list, consistent with Elasticsearch practice
+    append_values = tuple(rule['append_value'] for rule in rules)
+    # values appended by one rule can satisfy a later one, which must then be appended in its turn
+    feeds_back = target_field == source_field
 
-        if any(value in source_values_set for value in arguments['any_of']):
-            if append:
-                target_values.extend(arguments['append_value'])
-                # "append_value" key singular despite being a list, consistent with Elasticsearch practice
+    def _append_conditionally(document):
+        if source_field in document:
+            matched = _matching_rules(rules_by_value, document[source_field])
+            if matched:
+                target_values = _ensure_value_list(document.get(target_field, []))
+                for rule_index in _in_order(matched, rules_by_value if feeds_back else {}, append_values):
+                    target_values.extend(append_values[rule_index])
                 document[target_field] = target_values
-            else:
-                document[target_field] = arguments['set_value']
+
+    return _append_conditionally
+
+
+def _index_rules_by_value(rules):
+    """{value of "field": the (ascending) indexes of the rules in which it is one of "any_of"}"""
+    rules_by_value = {}
+    for rule_index, rule in enumerate(rules):
+        for value in rule['any_of']:
+            rule_indexes = rules_by_value.setdefault(value, [])
+            if not rule_indexes or rule_indexes[-1] != rule_index:
+                rule_indexes.append(rule_index)
+    return {value: tuple(rule_indexes) for value, rule_indexes in rules_by_value.items()}
 
 
-def _hash_to(arguments, document):
+def _matching_rules(rules_by_value, json_string_or_list):
+    return {
+        rule_index
+        for value in set(_ensure_value_list(json_string_or_list))
+        for rule_index in rules_by_value.get(value, ())
+    }
+
+
+def _in_order(matched, rules_by_value, append_values):
+    """Yields the indexes of the ``matched`` rules in ascending order, adding to them any later rules which the values
+    appended by those before satisfy, according to ``rules_by_value``"""
+    pending = sorted(matched)
+    while pending:
+        rule_index = heapq.heappop(pending)
+        yield rule_index
+        for value in append_values[rule_index]:
+            for later_rule_index in rules_by_value.get(value, ()):
+                if later_rule_index > rule_index and later_rule_index not in matched:
+                    matched.add(later_rule_index)
+                    heapq.heappush(pending, later_rule_index)
+
+
+def _compile_hash_to(transformation_type, rules):
     """
-    A transformation processor that performs a sha256 on the (utf8) string representation of the "field" and stores
-    the (lowercase hex string) result on the document under a key specified by "target_field". If "target_field" is not
-    specified, the source field will be overwritten with the result.
-    :param arguments: dict -- the parameters to the processor as specified in configuration
-    :param document: dict -- the submitted document that we are transforming
+    Compiles a "hash_to" transformation, which performs a sha256 on the (utf8) string representation of the "field"
+    and stores the (lowercase hex string) result on the document under a key specified by "target_field". If
+    "target_field" is not specified, the source field will be overwritten with the result.
+    :param transformation_type: str -- "hash_to"
+    :param rules: list -- the parameters to the (one) transformation as specified in configuration
+    :return: function -- the transformation processor, which takes the submitted document and transforms it in place
     """
-    source_field = arguments['field']
-    target_field = arguments.get('target_field') or source_field
+    source_field = rules[0]['field']
+    target_field = rules[0].get('target_field') or source_field
 
-    if source_field in document:
-        document[target_field] = hashlib.sha256((six.text_type(document[source_field])).encode('utf-8')).hexdigest()
+    def _hash_to(document):
+        if source_field in document:
+            document[target_field] = hashlib.sha256((six.text_type(document[source_field])).encode('utf-8')).hexdigest()
 
+    return _hash_to
 
-TRANSFORMATION_PROCESSORS = {
-    'append_conditionally': _append_conditionally,
-    'set_conditionally': _set_conditionally,
-    'hash_to': _hash_to,
+
+TRANSFORMATION_COMPILERS = {
+    'append_conditionally': _compile_conditionally,
+    'set_conditionally': _compile_conditionally,
+    'hash_to': _compile_hash_to,
 }
 
 
-def convert_request_json_into_index_json(mapping, request_json):
-    for transformation in mapping.transform_fields:
-        # Each transformation is a dictionary, with a type mapping to the arguments pertaining to
-        # that type. We anticipate only one type per transformation (consistent with how 'ingest
-        # processors' are specified for Elasticsearch - see
-        # <https://www.elastic.co/guide/en/elasticsearch/reference/current/ingest-processors.html>).
+def _run_key(transformation_type, transformation_arguments):
+    """What consecutive transformations must have in common to be compiled together, or None if this one can't be"""
+    if transformation_type not in ('append_conditionally', 'set_conditionally'):
+        return None
+    source_field = transformation_arguments['field']
+    target_field = transformation_arguments.get('target_field') or source_field
+    if transformation_type == 'set_conditionally' and target_field == source_field:
+        # it changes what the next one would be tested against
+        return None
+    return transformation_type, source_field, target_field
+
 
+def compile_transformations(transform_fields):
+    """Compiles a mapping's transformations into a tuple of transformation processors which, applied to a document in
+    order, transform it as the transformations themselves would one after another"""
+    # Each transformation is a dictionary, with a type mapping to the arguments pertaining to
+    # that type. We anticipate only one type per transformation (consistent with how 'ingest
+    # processors' are specified for Elasticsearch - see
+    # <https://www.elastic.co/guide/en/elasticsearch/reference/current/ingest-processors.html>).
+    runs = []  # [(run key, transformation type, [arguments, ...])]
+    for transformation in transform_fields:
         for transformation_type, transformation_arguments in transformation.items():
-            TRANSFORMATION_PROCESSORS[transformation_type](transformation_arguments, request_json)
+            run_key = _run_key(transformation_type, transformation_arguments)
+            if run_key is not None and runs and runs[-1][0] == run_key:
+                runs[-1][2].append(transformation_arguments)
+            else:
+                runs.append((run_key, transformation_type, [transformation_arguments]))
+
+    return tuple(
+        TRANSFORMATION_COMPILERS[transformation_type](transformation_type, rules)
+        for _, transformation_type, rules in runs
+    )
+
+
+def get_transformation_processors(mapping):
+    """The compiled transformations of ``mapping``, compiling them the first time they're needed (or after
+    ``mapping.transform_fields`` is replaced)"""
+    compiled = mapping.compiled_transformations
+    if compiled is None or compiled[0] is not mapping.transform_fields:
+        compiled = mapping.compiled_transformations = (
+            mapping.transform_fields, compile_transformations(mapping.transform_fields),
+        )
+    return compiled[1]
+
+
+# Painless equivalents of the transformation processors above, for ingest pipelines (see `compile_ingest_pipeline`).
+# Each takes its transformation's arguments as params, so is only compiled once however many pipelines use it.
+# `hash_to` only hashes strings, as Painless doesn't write other values out as Python does (`true` rather than `True`,
+# `[a, b]` rather than `['a', 'b']`) - `convert_request_json_into_index_json` hashes the others before sending them
+_HASH_TO_SCRIPT = """
+if (ctx[params.field] instanceof String) {
+    ctx[params.target_field] = ctx[params.field].sha256();
+}
+"""
+
+_SET_CONDITIONALLY_SCRIPT = """
+if (ctx.containsKey(params.field)) {
+    def source = ctx[params.field];
+    List sourceValues = source instanceof List ? source : [source];
+    boolean matched = false;
+    for (def value : params.any_of) {
+        if (sourceValues.contains(value)) {
+            matched = true;
+            break;
+        }
+    }
+    if (matched) {
+        if (params.append) {
+            def target = ctx[params.target_field];
+            List targetValues = target == null ? new ArrayList()
+                : (target instanceof List ? new ArrayList(target) : [target]);
+            for (def value : params.append_value) {
+                if (!targetValues.contains(value)) {
+                    targetValues.add(value);
+                }
+            }
+            ctx[params.target_field] = targetValues;
+        } else {
+            ctx[params.target_field] = params.set_value;
+        }
+    }
+}
+"""
+
+INGEST_TRANSFORMATION_SCRIPTS = {
+    'append_conditionally': (_SET_CONDITIONALLY_SCRIPT, {'append': True}),
+    'set_conditionally': (_SET_CONDITIONALLY_SCRIPT, {'append': False}),
+    'hash_to': (_HASH_TO_SCRIPT, {}),
+}
+
+# so that a document already indexed with one mapping can be reindexed with another, its fields are first un-prefixed
+# (every prefixed copy of a field having the same value), without replacing any which weren't prefixed to begin with
+_UNPREFIX_SCRIPT = """
+Map unprefixed = new HashMap();
+for (def entry : ctx.entrySet()) {
+    String key = entry.getKey();
+    int separator = key.indexOf('_');
+    if (separator > 0 && params.prefixes.contains(key.substring(0, separator))) {
+        unprefixed.putIfAbsent(key.substring(separator + 1), entry.getValue());
+    }
+}
+for (def entry : unprefixed.entrySet()) {
+    ctx.putIfAbsent(entry.getKey(), entry.getValue());
+}
+"""
+
+# replaces every field (metadata fields such as `_id` aside) with a copy under each prefix it has in the mapping
+_FAN_OUT_SCRIPT = """
+Map prefixed = new HashMap();
+for (def entry : params.prefixes_by_field.entrySet()) {
+    if (ctx.containsKey(entry.getKey())) {
+        for (def prefix : entry.getValue()) {
+            prefixed[prefix + '_' + entry.getKey()] = ctx[entry.getKey()];
+        }
+    }
+}
+ctx.keySet().removeIf(key -> !key.startsWith('_'));
+ctx.putAll(prefixed);
+"""
+
+
+def _script_processor(tag, source, params):
+    return {"script": {"tag": tag, "lang": "painless", "source": source.strip(), "params": params}}
+
+
+def compile_ingest_pipeline(mapping):
+    """An Elasticsearch ingest pipeline doing to a document what `convert_request_json_into_index_json` does, so that
+    documents can be transformed by Elasticsearch itself - including when reindexing from an index with another
+    mapping, whose documents' fields are un-prefixed first.
+
+    The one difference is that values which `append_conditionally` would append to a field already having them aren't
+    appended again, so reindexing a document doesn't duplicate them.
+    """
+    processors = [
+        _script_processor("unprefix", _UNPREFIX_SCRIPT, {"prefixes": sorted(mapping.fields_by_prefix)}),
+    ]
+    for transformation in mapping.transform_fields:
+        for transformation_type, transformation_arguments in transformation.items():
+            source, params = INGEST_TRANSFORMATION_SCRIPTS[transformation_type]
+            processors.append(_script_processor(transformation_type, source, dict(
+                transformation_arguments,
+                target_field=transformation_arguments.get('target_field') or transformation_arguments['field'],
+                **params
+            )))
+    processors.append(_script_processor("fan_out", _FAN_OUT_SCRIPT, {
+        "prefixes_by_field": {name: sorted(prefixes) for name, prefixes in mapping.prefixes_by_field.items()},
+    }))
+
+    return {
+        "description": "Transformations and field prefixes of the {} mapping".format(
+            mapping.definition['mappings'].get('_meta', {}).get('generated_from_framework', mapping.mapping_type)
+        ),
+        "processors": processors,
+    }
+
+
+def _hash_non_strings(mapping, index_json):
+    """Does any `hash_to` transformations of ``mapping`` whose field isn't a string in ``index_json``, which its ingest
+    pipeline leaves alone, so that they're hashed just as `_compile_hash_to` would hash them"""
+    for transformation in mapping.transform_fields:
+        arguments = transformation.get('hash_to')
+        if arguments is None or arguments['field'] not in index_json:
+            continue
+        value = index_json[arguments['field']]
+        if isinstance(value, six.string_types):
+            continue
+        target_field = arguments.get('target_field') or arguments['field']
+        if target_field == arguments['field']:
+            # the pipeline will hash it in place once it's a string, giving the same hash
+            index_json[target_field] = six.text_type(value)
+        else:
+            index_json[target_field] = hashlib.sha256(six.text_type(value).encode('utf-8')).hexdigest()
+
+
+def convert_request_json_into_index_json(mapping, request_json):
+    if mapping.ingest_pipeline:
+        # the index's own ingest pipeline transforms documents, so only needs the fields it will look at
+        index_json = {key: value for key, value in request_json.items() if key in mapping.ingest_fields}
+        _hash_non_strings(mapping, index_json)
+        return index_json
+
+    for transformation_processor in get_transformation_processors(mapping):
+        transformation_processor(request_json)
 
     # build a dict: for each key/value in the request_json, look up mapping.prefixes_by_field to see how many
     # differently-prefixed variants that field has in the mapping and copy value verbatim to all those keys. it could
@@ -101,13 +327,59 @@ def check_json_from_request(request):
                                     'application/json; charset=UTF-8']:
         abort(400, "Unexpected Content-Type, expecting 'application/json'")
 
-    data = request.get_json()
+    data = json_provider.get_json(request)
 
     if data is None:
         abort(400, "Invalid JSON; must be a valid JSON object")
     return data
 
 
+BULK_ACTIONS = ("index", "delete")
+
+
+def get_bulk_operations_from_request(request):
+    """Parse a batch of bulk operations from either a JSON array or an NDJSON (one JSON object per line) request body.
+
+    Each operation is an object with an ``id``, an optional ``action`` (one of `BULK_ACTIONS`, defaulting to
+    "index") and, for "index" operations, a ``document``. Returns a list of ``(action, document_id, document)``
+    tuples, ``document`` being None for deletions.
+    """
+    if request.mimetype == "application/x-ndjson":
+        operations = []
+        for line_number, line in enumerate(request.get_data(as_text=True).splitlines(), start=1):
+            if line.strip():
+                try:
+                    operations.append(json_provider.loads(line))
+                except ValueError:
+                    abort(400, "Invalid JSON on line {}".format(line_number))
+    else:
+        operations = check_json_from_request(request)
+
+    if not isinstance(operations, list):
+        abort(400, "Invalid JSON; must be a list of operations")
+
+    return [_parse_bulk_operation(position, operation) for position, operation in enumerate(operations)]
+
+
+def _parse_bulk_operation(position, operation):
+    if not isinstance(operation, dict):
+        abort(400, "Invalid operation at position {}; must be a JSON object".format(position))
+
+    action = operation.get("action", "index")
+    if action not in BULK_ACTIONS:
+        abort(400, "Invalid operation at position {}; 'action' must be one of {}".format(position, BULK_ACTIONS))
+
+    document_id = operation.get("id")
+    if isinstance(document_id, bool) or not isinstance(document_id, (str, int)) or document_id == "":
+        abort(400, "Invalid operation at position {}; must have an 'id'".format(position))
+
+    document = operation.get("document")
+    if action == "index" and not isinstance(document, dict):
+        abort(400, "Invalid operation at position {}; must have a 'document' object".format(position))
+
+    return action, str(document_id), document
+
+
 def json_has_required_keys(data, keys):
     for key in keys:
         if key not in data.keys():
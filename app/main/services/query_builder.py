@@ -1,15 +1,32 @@
-from itertools import chain
+import base64
+import binascii
 
+from flask import json
+from werkzeug.datastructures import MultiDict
 
-def construct_query(mapping, query_args, aggregations=[], page_size=100):
+
+# for callers which don't pass `aggregation_sizes` and really do want every bucket in one go
+UNBOUNDED_AGGREGATION_SIZE = 999999
+
+
+def construct_query(mapping, query_args, aggregations=[], page_size=100, with_documents=False, aggregation_sizes=None):
     """
         :param mapping: index's mapping as returned by `app.mapping.get_mapping`
         :param query_args: a MultiDict of request arguments
         :param aggregations: sequence of aggregations request arguments
         :param page_size: desired number of results per page. falsey values cause page & sorting-related parameters to
             be omitted (useful for e.g. `count` requests)
+        :param with_documents: whether a page of documents should be returned along with any aggregations, rather than
+            just the aggregations
+        :param aggregation_sizes: dict of the terms aggregation size to use for each field, as returned by
+            `app.mapping.get_aggregation_sizes`
     """
-    if not is_filtered(mapping, query_args):
+    with_documents = with_documents or not aggregations
+    plan = query_plan(mapping, query_args)
+    disjunctive = bool(aggregations) and plan.is_filtered and "disjunctiveAggregations" in query_args
+    aggregation_sizes = aggregation_sizes or {}
+
+    if not plan.is_filtered or disjunctive:
         query = {
             "query": build_keywords_query(mapping, query_args)
         }
@@ -18,11 +35,14 @@ def construct_query(mapping, query_args, aggregations=[], page_size=100):
             "query": {
                 "bool": {
                     "must": build_keywords_query(mapping, query_args),
-                    "filter": filter_clause(mapping, query_args)
+                    "filter": plan.filter_clause(query_args)
                 }
             }
         }
 
+    if disjunctive:
+        query["post_filter"] = plan.filter_clause(query_args)
+
     if page_size:
         query["size"] = page_size
 
@@ -34,19 +54,31 @@ def construct_query(mapping, query_args, aggregations=[], page_size=100):
         if missing_aggregations:
             raise ValueError("Aggregations for `{}` are not supported.".format(', '.join(missing_aggregations)))
 
-        query["size"] = 0  # We don't want any services returned, just aggregations
         query['aggregations'] = {
-            x: {"terms": {"field": "_".join((mapping.aggregatable_field_prefix, x)), "size": 999999}}
+            x: disjunctive_aggregation_clause(
+                mapping, x, query_args, aggregation_sizes.get(x, UNBOUNDED_AGGREGATION_SIZE)
+            ) if disjunctive else aggregation_clause(mapping, x, aggregation_sizes.get(x, UNBOUNDED_AGGREGATION_SIZE))
             for x in aggregations
         }
 
+    if not with_documents:
+        query["size"] = 0  # We don't want any services returned, just aggregations
     elif 'idOnly' in query_args:
         query['_source'] = False
     elif page_size:
-        query["highlight"] = highlight_clause(mapping)
+        query['_source'] = mapping.response_source_includes or False
+        query["highlight"] = plan.highlight
+        query['sort'] = mapping.sort_clause
+
+    if page_size and "cursor" in query_args and with_documents:
+        if query_args.get("page", "1") != "1":
+            raise ValueError("Cannot use both page and cursor")
+        # search_after needs every page sorted the same way, including those which otherwise wouldn't be sorted
         query['sort'] = mapping.sort_clause
+        if query_args["cursor"]:
+            query["search_after"] = decode_cursor(query_args["cursor"])["search_after"]
 
-    if page_size and "page" in query_args:
+    elif page_size and "page" in query_args:
         try:
             query["from"] = (int(query_args.get("page")) - 1) * page_size
         except ValueError:
@@ -55,6 +87,121 @@ def construct_query(mapping, query_args, aggregations=[], page_size=100):
     return query
 
 
+def is_disjunctive(mapping, query_args):
+    """Whether aggregations should be made in disjunctive mode, where filters are applied to the hits and to each
+    aggregation separately rather than to the whole query"""
+    return "disjunctiveAggregations" in query_args and query_plan(mapping, query_args).is_filtered
+
+
+def aggregation_clause(mapping, field_name, size):
+    return {"terms": {"field": "_".join((mapping.aggregatable_field_prefix, field_name)), "size": size}}
+
+
+def _without_field_filter(query_args, field_name):
+    return MultiDict(
+        (key, value) for key, values in query_args.lists() if key != "filter_" + field_name for value in values
+    )
+
+
+def disjunctive_aggregation_clause(mapping, field_name, query_args, size):
+    """Aggregate a field over the documents matching every filter except the field's own, i.e. counting how many
+    results there would be if each of its values were added to (or made) the field's filter.
+
+    Returns a "filter" aggregation with a sub-aggregation of the same name as the field.
+    """
+    return {
+        "filter": filter_clause(mapping, _without_field_filter(query_args, field_name)),
+        "aggregations": {field_name: aggregation_clause(mapping, field_name, size)},
+    }
+
+
+def construct_composite_aggregation_query(mapping, query_args, field_name, page_size, after=None):
+    """Build a query for one page of all of a field's aggregation buckets, for when there are too many to get from a
+    terms aggregation. Gives the same counts as the field's aggregation in `construct_query` would for ``query_args``.
+    """
+    if is_disjunctive(mapping, query_args):
+        # composite aggregations can't be nested in a filter aggregation, so the other fields' filters go in the query
+        query_args = _without_field_filter(query_args, field_name)
+
+    query = construct_query(mapping, query_args, page_size=None)
+    query["size"] = 0
+    query["aggregations"] = {
+        field_name: {
+            "composite": {
+                "size": page_size,
+                "sources": [
+                    {field_name: {"terms": {"field": "_".join((mapping.aggregatable_field_prefix, field_name))}}},
+                ],
+            },
+        },
+    }
+    if after is not None:
+        query["aggregations"][field_name]["composite"]["after"] = after
+
+    return query
+
+
+def encode_cursor(search_after, pit_id=None):
+    """Encode the sort values of the last hit on a page (and the point in time it was read from, if any) as an opaque,
+    url-safe cursor for the page after it"""
+    cursor = {"search_after": search_after}
+    if pit_id:
+        cursor["pit"] = pit_id
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8"))
+        if not isinstance(decoded, dict) or not isinstance(decoded.get("search_after"), list):
+            raise ValueError
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        raise ValueError("Invalid cursor {}".format(cursor))
+    return decoded
+
+
+class QueryPlan(object):
+    """The parts of a query which depend only on the mapping and on which filters are being used - not on their values
+    - worked out once for each combination of filter arguments seen and reused by `construct_query` thereafter.
+
+    Use `query_plan` to get the plan for a request. The clauses it holds are shared by every query built from it, so
+    mustn't be modified.
+    """
+
+    def __init__(self, mapping, filter_arg_keys):
+        known_filter_fields = mapping.fields_by_prefix.get(mapping.filter_field_prefix) or frozenset()
+        filter_field_names = [arg_key[len("filter_"):] for arg_key in filter_arg_keys]
+
+        # ((argument name, elasticsearch field name), ...) in the order the arguments were given. unknown fields still
+        # get filters (matching nothing), but don't count towards the query being filtered
+        self.filter_fields = tuple(
+            (arg_key, "_".join((mapping.filter_field_prefix, field_name)))
+            for arg_key, field_name in zip(filter_arg_keys, filter_field_names)
+        )
+        self.is_filtered = any(field_name in known_filter_fields for field_name in filter_field_names)
+        self.highlight = highlight_clause(mapping)
+
+    def filter_clause(self, query_args):
+        """See `filter_clause`"""
+        must = []
+        for arg_key, field_name in self.filter_fields:
+            field_values = query_args.getlist(arg_key)
+            if field_is_or_filter(field_values):
+                must.extend(or_field_filters(field_name, field_values))
+            else:
+                must.extend(and_field_filters(field_name, field_values))
+        return {"bool": {"must": must}}
+
+
+def query_plan(mapping, query_args):
+    filter_arg_keys = tuple(arg_key for arg_key in query_args.keys() if arg_key.startswith("filter_"))
+    plan = mapping.query_plans.get(filter_arg_keys)
+    if plan is None:
+        plan = QueryPlan(mapping, filter_arg_keys)
+        mapping.query_plans.set(filter_arg_keys, plan)
+    return plan
+
+
 def highlight_clause(mapping):
     highlights = {
         "encoder": "html",
@@ -76,11 +223,7 @@ def highlight_clause(mapping):
 
 
 def is_filtered(mapping, query_args):
-    return bool(frozenset(
-        maybe_name_seq[0]
-        for prefix, *maybe_name_seq in (arg_key.split("_", 1) for arg_key in query_args.keys())
-        if prefix == "filter" and maybe_name_seq  # maybe_name_seq could be an empty seq if no underscores were found
-    ) & (mapping.fields_by_prefix.get(mapping.filter_field_prefix) or frozenset()))
+    return query_plan(mapping, query_args).is_filtered
 
 
 def build_keywords_query(mapping, query_args):
@@ -118,10 +261,7 @@ def multi_match_clause(mapping, keywords):
     return {
         "simple_query_string": {
             "query": keywords,
-            "fields": [
-                "_".join((mapping.text_search_field_prefix, field_name))
-                for field_name in mapping.fields_by_prefix.get(mapping.text_search_field_prefix, ())
-            ],
+            "fields": mapping.text_search_fields,
             "default_operator": "and",
             "flags": "OR|AND|NOT|PHRASE|ESCAPE|WHITESPACE"
         }
@@ -204,16 +344,4 @@ def filter_clause(mapping, query_args):
     just any one of them.
 
     """
-    return {
-        "bool": {
-            "must": list(chain.from_iterable(
-                field_filters(mapping, maybe_name_seq[0], values)
-                for (prefix, *maybe_name_seq), values in (
-                    (arg_key.split("_", 1), values)
-                    for arg_key, values in query_args.lists()
-                )
-                if prefix == "filter" and maybe_name_seq  # maybe_name_seq could be an empty seq if no underscores were
-                                                          # found
-            )),
-        },
-    }
+    return query_plan(mapping, query_args).filter_clause(query_args)
@@ -0,0 +1,341 @@
+import threading
+import time
+from datetime import datetime
+
+from elasticsearch import NotFoundError, TransportError
+from flask import current_app
+from werkzeug.datastructures import MultiDict
+
+import app.mapping
+from app.main.services.meta_response_cache import meta_response_cache
+from app.main.services.query_builder import construct_query
+from app.main.services.search_service import BULK_LOAD_META_KEY, BULK_LOAD_SETTINGS, create_alias, create_index, \
+    ingest_pipeline_name, put_ingest_pipeline, _force_merge, _get_an_error_message, _get_meta, _leave_bulk_load, \
+    _put_meta
+from app.prometheus_metrics import timed_elasticsearch_request
+
+from ... import elasticsearch_client as es
+
+
+# the key under the target index's mapping `_meta` which a reindex job's progress is kept under, so that any worker
+# can report on it
+REINDEX_META_KEY = "dm_reindex"
+
+# the counts of a reindex task's status which are reported as its progress
+REINDEX_PROGRESS_COUNTS = ("total", "created", "updated", "deleted", "batches", "version_conflicts", "noops")
+
+# the steps a reindex job goes through once it's started, before it's "done" (or "failed")
+REINDEX_STEPS = ("reindexing", "leaving_bulk_load", "warming", "swapping_alias")
+
+
+class ReindexFailed(Exception):
+    pass
+
+
+def _now():
+    return datetime.utcnow().isoformat() + "Z"
+
+
+def _seconds_since(timestamp):
+    return (datetime.utcnow() - datetime.fromisoformat(timestamp.rstrip("Z"))).total_seconds()
+
+
+def _get_mapping_data(index_name):
+    """The name of the index ``index_name`` is (or is an alias of) and its mapping"""
+    with timed_elasticsearch_request('get_mapping'):
+        return next(iter(es.indices.get_mapping(index=index_name).items()))
+
+
+def _record(index_name, job, **changes):
+    """Stores ``job``, updated with ``changes``, in ``index_name``'s mapping and returns it"""
+    job = dict(job, updatedAt=_now(), **changes)
+    resolved_index_name, meta = _get_meta(index_name)
+    _put_meta(resolved_index_name, dict(meta, **{REINDEX_META_KEY: job}))
+    return job
+
+
+def start_reindex(alias_name, target_index, mapping_name):
+    """Creates ``target_index`` with the named mapping, in bulk load mode, and starts copying every document of the
+    index ``alias_name`` points to into it, with Elasticsearch's `_reindex` transforming them with the new mapping's
+    ingest pipeline. The rest of the job - waiting for the copy, leaving bulk load mode (force-merging the index),
+    warming it and swapping the alias over - is left to a background thread (see `finish_reindex`).
+
+    Documents indexed into (or deleted from) the old index after the copy starts aren't copied over.
+    """
+    try:
+        with timed_elasticsearch_request('get_alias'):
+            source_indexes = list(es.indices.get_alias(name=alias_name))
+    except TransportError as e:
+        return _get_an_error_message(e), e.status_code
+    if len(source_indexes) != 1:
+        return "Alias '{}' points to {} indexes; expected 1".format(alias_name, len(source_indexes)), 400
+    source_index = source_indexes[0]
+
+    mapping_definition = app.mapping.load_mapping_definition(mapping_name)
+    index_settings = mapping_definition.get("settings", {}).get("index", {})
+    job = {
+        "alias": alias_name,
+        "source": source_index,
+        "target": target_index,
+        "mapping": mapping_name,
+        "step": "reindexing",
+        "startedAt": _now(),
+    }
+    result, status_code = create_index(target_index, mapping_name, settings=BULK_LOAD_SETTINGS, meta={
+        REINDEX_META_KEY: job,
+        # as `search_service.enter_bulk_load` would have saved them, had the index been created with its own settings
+        BULK_LOAD_META_KEY: {name: index_settings.get(name) for name in BULK_LOAD_SETTINGS},
+    })
+    if status_code != 200:
+        return result, status_code
+    meta_response_cache.invalidate()
+
+    try:
+        pipeline_name = put_ingest_pipeline(target_index, mapping_definition)
+        with timed_elasticsearch_request('reindex'):
+            task = es.reindex(
+                body={
+                    "source": {"index": source_index},
+                    "dest": {"index": target_index, "pipeline": pipeline_name},
+                },
+                slices=current_app.config["DM_REINDEX_SLICES"],
+                requests_per_second=current_app.config["DM_REINDEX_REQUESTS_PER_SECOND"],
+                wait_for_completion=False,
+            )
+        job = _record(target_index, job, task=task["task"])
+    except TransportError as e:
+        current_app.logger.warning(
+            "Failed to start reindexing %s into %s: %s", source_index, target_index, _get_an_error_message(e),
+        )
+        _fail(target_index, job, _get_an_error_message(e))
+        return _get_an_error_message(e), e.status_code
+
+    _start_finishing(target_index, job)
+
+    return job, 202
+
+
+def _start_finishing(target_index, job):
+    threading.Thread(
+        target=_finish_reindex_in_app_context,
+        args=(current_app._get_current_object(), target_index, job),
+        daemon=True,
+    ).start()
+
+
+def _finish_reindex_in_app_context(app_, target_index, job):
+    with app_.app_context():
+        finish_reindex(target_index, job)
+
+
+def finish_reindex(target_index, job):
+    """Sees the reindex job ``job`` (as started by `start_reindex`, or resumed by `resume_reindex`) through from its
+    current step to the alias pointing at ``target_index``, recording each step as it's reached, or the step at which
+    it failed"""
+    try:
+        _finish_steps(target_index, job)
+    except (TransportError, ReindexFailed) as e:
+        error = _get_an_error_message(e) if isinstance(e, TransportError) else str(e)
+        current_app.logger.error(
+            "Reindexing %s into %s failed while %s: %s", job["source"], target_index, job["step"], error,
+            extra={"reindexJob": job},
+        )
+        _fail(target_index, job, error)
+    except Exception as e:
+        current_app.logger.exception(
+            "Reindexing %s into %s failed while %s", job["source"], target_index, job["step"],
+            extra={"reindexJob": job},
+        )
+        _fail(target_index, job, "{}: {}".format(type(e).__name__, e))
+
+
+def _finish_steps(target_index, job):
+    # each step records the next as it finishes, so that `job` always has the step in progress
+    if job["step"] == "reindexing":
+        job.update(_record(target_index, job, progress=_wait_for_task(job["task"])))
+        job.update(_record(target_index, job, step="leaving_bulk_load"))
+
+    if job["step"] == "leaving_bulk_load":
+        _delete_reindex_pipeline(target_index)
+        if not _leave_bulk_load(target_index, force_merge=True):
+            # it was taken out of bulk load mode when the job failed, before being resumed, but still needs merging
+            _force_merge(target_index)
+        job.update(_record(target_index, job, step="warming"))
+
+    if job["step"] == "warming":
+        _warm(target_index)
+        job.update(_record(target_index, job, step="swapping_alias"))
+
+    result, status_code = create_alias(job["alias"], target_index)
+    if status_code != 200:
+        raise ReindexFailed(result)
+    # other workers go on using the old index until their cached mapping of the alias expires
+    app.mapping.mapping_cache.invalidate(job["alias"])
+    meta_response_cache.invalidate()
+
+    _record(target_index, job, step="done", finishedAt=_now())
+    current_app.logger.info(
+        "Reindexed %s into %s and pointed %s at it", job["source"], target_index, job["alias"],
+        extra={"reindexJob": job},
+    )
+
+
+def _delete_reindex_pipeline(target_index):
+    """Deletes the ingest pipeline ``target_index`` was filled through, unless it's the index's own (see
+    ``DM_INGEST_PIPELINES``)"""
+    if not current_app.config["DM_INGEST_PIPELINES"]:
+        # documents indexed from now on are transformed before they get here
+        with timed_elasticsearch_request('delete_pipeline'):
+            es.ingest.delete_pipeline(id=ingest_pipeline_name(target_index), ignore=404)
+
+
+def _fail(target_index, job, error):
+    """Records ``job`` as having failed at its current step, and takes ``target_index`` out of bulk load mode so that
+    it isn't left without replicas or refreshes. Unless the index has its own ingest pipeline, the one it was being
+    filled through is deleted too, as a job which fails while copying can't be resumed."""
+    try:
+        _record(target_index, job, step="failed", failedStep=job["step"], error=error)
+    except TransportError:
+        pass  # the error's already been logged
+    try:
+        _delete_reindex_pipeline(target_index)
+    except TransportError as e:
+        current_app.logger.warning(
+            "Failed to delete the ingest pipeline of %s: %s", target_index, _get_an_error_message(e),
+        )
+    try:
+        _leave_bulk_load(target_index)
+    except TransportError as e:
+        current_app.logger.warning(
+            "Failed to take %s out of bulk load mode: %s", target_index, _get_an_error_message(e),
+        )
+
+
+def _wait_for_task(task_id):
+    """Polls the `_reindex` task ``task_id`` until it's completed, returning its final progress, or cancels it if it
+    hasn't after ``DM_REINDEX_TIMEOUT`` seconds"""
+    deadline = time.monotonic() + current_app.config["DM_REINDEX_TIMEOUT"]
+    while True:
+        with timed_elasticsearch_request('get_task'):
+            task = es.tasks.get(task_id=task_id)
+        if task.get("completed"):
+            break
+        if time.monotonic() >= deadline:
+            try:
+                with timed_elasticsearch_request('cancel_task'):
+                    es.tasks.cancel(task_id=task_id)
+            except TransportError as e:
+                current_app.logger.warning("Failed to cancel reindex task %s: %s", task_id, _get_an_error_message(e))
+            raise ReindexFailed("Gave up waiting for the copy after {} seconds".format(
+                current_app.config["DM_REINDEX_TIMEOUT"],
+            ))
+        time.sleep(current_app.config["DM_REINDEX_POLL_INTERVAL"])
+
+    if task.get("error"):
+        raise ReindexFailed("{type}: {reason}".format(**task["error"]))
+    failures = task.get("response", {}).get("failures")
+    if failures:
+        cause = failures[0].get("cause", {})
+        raise ReindexFailed("{} documents failed to copy, the first with {}: {}".format(
+            len(failures), cause.get("type", "<unknown type>"), cause.get("reason", "<unknown reason>"),
+        ))
+
+    return _progress(task)
+
+
+def _progress(task):
+    status = task.get("task", {}).get("status", {})
+    return {name: status[name] for name in REINDEX_PROGRESS_COUNTS if name in status}
+
+
+def _warm(target_index):
+    """Searches ``target_index`` as a search landing page would, with every aggregation, so that its caches and global
+    ordinals are loaded before the alias is pointed at it"""
+    resolved_index_name, mapping_data = _get_mapping_data(target_index)
+    mapping = app.mapping.Mapping(
+        mapping_data, mapping_data["mappings"]["_meta"]["doc_type"], index_name=resolved_index_name,
+    )
+    aggregations = sorted(mapping.fields_by_prefix.get(mapping.aggregatable_field_prefix, ()))
+    with timed_elasticsearch_request('search'):
+        es.search(
+            index=target_index,
+            body=construct_query(
+                mapping,
+                MultiDict(),
+                aggregations,
+                int(current_app.config["DM_SEARCH_PAGE_SIZE"]),
+                aggregation_sizes=app.mapping.get_aggregation_sizes(mapping),
+            ),
+            track_total_hits=True,
+        )
+
+
+def _is_abandoned(job, task=None):
+    """Whether whichever worker was seeing ``job`` through has evidently stopped (say, in a deploy), as it has gone
+    ``DM_REINDEX_ABANDONED_AFTER`` seconds longer than its step could take without moving on to the next. While
+    documents are being copied that's judged by when the copy (the `_reindex` task ``task``, or None if there's no
+    such task) finished, and otherwise by when the job was last updated."""
+    grace_period = current_app.config["DM_REINDEX_ABANDONED_AFTER"]
+    if job["step"] == "reindexing":
+        if task is None:
+            return _seconds_since(job["updatedAt"]) > grace_period
+        status = task.get("task", {})
+        if not task.get("completed") or "start_time_in_millis" not in status:
+            return False
+        finished_at = status["start_time_in_millis"] / 1000 + status.get("running_time_in_nanos", 0) / 1e9
+        return time.time() - finished_at > grace_period
+    if job["step"] == "leaving_bulk_load":
+        grace_period += current_app.config["DM_FORCE_MERGE_TIMEOUT"]
+    return job["step"] in REINDEX_STEPS and _seconds_since(job["updatedAt"]) > grace_period
+
+
+def reindex_status(index_name):
+    """The progress of the reindex job into ``index_name``, with up-to-date counts while documents are being copied,
+    and ``abandoned`` set if it needs resuming (see `resume_reindex`)"""
+    try:
+        _, meta = _get_meta(index_name)
+    except TransportError as e:
+        return _get_an_error_message(e), e.status_code
+
+    job = meta.get(REINDEX_META_KEY)
+    if job is None:
+        return "Index '{}' was not created by a reindex".format(index_name), 404
+
+    if job["step"] == "reindexing" and "task" in job:
+        try:
+            with timed_elasticsearch_request('get_task'):
+                task = es.tasks.get(task_id=job["task"])
+            job = dict(job, progress=_progress(task), abandoned=_is_abandoned(job, task))
+        except NotFoundError:
+            job = dict(job, abandoned=_is_abandoned(job))
+        except TransportError as e:
+            current_app.logger.warning("Failed to get reindex task %s: %s", job["task"], _get_an_error_message(e))
+    elif job["step"] in REINDEX_STEPS:
+        job = dict(job, abandoned=_is_abandoned(job))
+
+    return job, 200
+
+
+def resume_reindex(index_name):
+    """Sees through a reindex job into ``index_name`` which has been abandoned, or which failed after its documents
+    were copied, from the step at which it stopped"""
+    job, status_code = reindex_status(index_name)
+    if status_code != 200:
+        return job, status_code
+
+    if job["step"] == "failed" and job["failedStep"] != "reindexing":
+        job = dict(job, step=job["failedStep"])
+        del job["failedStep"], job["error"]
+    elif not job.pop("abandoned", False):
+        if job["step"] == "failed":
+            return "Reindex into '{}' failed to copy documents, so has to be started again".format(index_name), 400
+        return "Reindex into '{}' is {} and hasn't been abandoned".format(index_name, job["step"]), 400
+
+    try:
+        job = _record(job["target"], job, resumedAt=_now())
+    except TransportError as e:
+        return _get_an_error_message(e), e.status_code
+    current_app.logger.info("Resuming reindex into %s while %s", job["target"], job["step"], extra={"reindexJob": job})
+    _start_finishing(job["target"], job)
+
+    return job, 202
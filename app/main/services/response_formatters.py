@@ -1,6 +1,8 @@
 import math
 
-from flask import current_app, jsonify
+from flask import current_app, request
+
+from app.json_provider import json_provider
 
 
 def convert_es_status(index_name, status_response, info_response=None):
@@ -34,32 +36,30 @@ def _convert_es_index_status(index_name, status_response, info_response):
 
 def _convert_es_result(mapping, es_result):
     # generate outgoing result dict only including es_result keys whose un-prefixed field name is in
-    # mapping.response_fields, removing prefix in the process
-    return {
-        maybe_name_seq[0]: value
-        for (prefix, *maybe_name_seq), value in (
-            (prefixed_name.split("_", 1), value)
-            for prefixed_name, value in es_result.items()
-        )
-        if prefix and maybe_name_seq and maybe_name_seq[0] in mapping.fields_by_prefix[mapping.response_field_prefix]
-    }
+    # mapping.response_fields, removing prefix in the process (see `Mapping.response_projection`)
+    projection = mapping.response_projection
+    return {projection[name]: value for name, value in es_result.items() if name in projection}
 
 
-def convert_es_results(mapping, results, query_args):
-    documents = []
+def convert_es_hit(mapping, document, id_only=False):
+    if id_only:
+        return {"id": document["_id"]}
+
+    # populate result from document["_source"] object
+    result = _convert_es_result(mapping, document["_source"])
 
-    for document in results["hits"]["hits"]:
-        if 'idOnly' in query_args:
-            documents.append({"id": document["_id"]})
-        else:
-            # populate result from document["_source"] object
-            result = _convert_es_result(mapping, document["_source"])
+    if "highlight" in document:
+        # perform the same conversion for any highlight terms
+        result["highlight"] = _convert_es_result(mapping, document["highlight"])
 
-            if "highlight" in document:
-                # perform the same conversion for any highlight terms
-                result["highlight"] = _convert_es_result(mapping, document["highlight"])
+    return result
 
-            documents.append(result)
+
+def convert_es_results(mapping, results, query_args):
+    if 'idOnly' in query_args:
+        documents = [{"id": document["_id"]} for document in results["hits"]["hits"]]
+    else:
+        documents = [convert_es_hit(mapping, document) for document in results["hits"]["hits"]]
 
     return {
         "meta": {
@@ -86,6 +86,16 @@ def generate_pagination_links(query_args, total, page_size, url_for_search):
     return links
 
 
+def generate_cursor_links(query_args, next_cursor, url_for_search):
+    # there's no going back with a cursor, only forward, so we can only ever link to the next page
+    args_no_cursor = {k: v for k, v in query_args.lists() if k != 'cursor'}
+
+    links = dict()
+    if next_cursor:
+        links['next'] = url_for_search(cursor=next_cursor, **args_no_cursor)
+    return links
+
+
 def api_response(data, status_code, key='message'):
     """Handle error codes.
 
@@ -97,8 +107,32 @@ def api_response(data, status_code, key='message'):
     """
     try:
         if status_code // 100 == 2:
-            return jsonify({key: data}), status_code
+            return json_provider.jsonify({key: data}), status_code
     except TypeError:
         current_app.logger.error(f'API response error: "{str(data)}" Unexpected status code: "{status_code}"')
-        return jsonify(error=str(data), unexpectedStatusCode=status_code), 500
-    return jsonify(error=data), status_code
+        return json_provider.jsonify(error=str(data), unexpectedStatusCode=status_code), 500
+    return json_provider.jsonify(error=data), status_code
+
+
+def conditional_response(etag, cache_control, view, response_etag=None):
+    """Respond with ``view()`` (anything a view function can return), tagged with ``etag`` and given a
+    ``Cache-Control`` of ``cache_control`` if it's successful - or, if the request's ``If-None-Match`` already has
+    ``etag``, with a 304 and without calling ``view`` at all. Either can be None, for no header.
+
+    If ``response_etag`` is given, a response from ``view`` is tagged with what it returns once the view has run
+    instead - the ETag of what the response was actually built from, which may not be what ``etag`` was.
+    """
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.make_response(view())
+        if response.status_code != 200:
+            return response
+        if response_etag is not None:
+            etag = response_etag()
+
+    if etag is not None:
+        response.set_etag(etag)
+    if cache_control:
+        response.headers["Cache-Control"] = cache_control
+    return response
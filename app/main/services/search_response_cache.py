@@ -0,0 +1,116 @@
+import hashlib
+import time
+import uuid
+
+from flask import current_app, json
+
+from app.cache import InProcessCacheBackend, RedisCacheBackend
+from app.prometheus_metrics import SEARCH_RESPONSE_CACHE_LOOKUPS_TOTAL
+
+
+class SearchResponseCache(object):
+    """Cache of raw Elasticsearch search responses, keyed by a canonical form of the request's query arguments.
+
+    Every key also includes the current "generation" of the concrete index being searched, a random token which is
+    replaced whenever that index is written to through this app (and otherwise never expires). Replacing it orphans
+    everything cached for the old generation (to be evicted in due course) without having to find and delete it.
+
+    Because Elasticsearch only makes writes visible to searches on its next refresh, nothing is cached for
+    ``DM_SEARCH_RESPONSE_CACHE_SETTLE_TIME`` seconds after a generation starts, so we don't go on serving results from
+    before the write once it is visible. With the in-process backend each worker has its own generations, so other
+    workers won't know a write has happened and go on serving what they've cached until it expires - the TTL is then
+    the bound on how stale responses can be. Use the redis backend, which shares generations too, where that matters.
+
+    Hits and misses are counted by the ``search_api_search_response_cache_lookups_total`` metric, from which the hit
+    ratio can be derived.
+    """
+
+    def init_app(self, app):
+        backend = app.config["DM_SEARCH_RESPONSE_CACHE_BACKEND"]
+        if backend == "memory":
+            app.extensions["dm_search_response_cache"] = InProcessCacheBackend(
+                max_size=app.config["DM_SEARCH_RESPONSE_CACHE_MAX_SIZE"],
+                ttl=app.config["DM_SEARCH_RESPONSE_CACHE_TTL"],
+            )
+        elif backend == "redis":
+            app.extensions["dm_search_response_cache"] = RedisCacheBackend(
+                url=app.config["DM_SEARCH_RESPONSE_CACHE_REDIS_URL"],
+                ttl=app.config["DM_SEARCH_RESPONSE_CACHE_TTL"],
+            )
+        elif backend is None:
+            app.extensions["dm_search_response_cache"] = None
+        else:
+            raise ValueError("Unrecognized DM_SEARCH_RESPONSE_CACHE_BACKEND {!r}".format(backend))
+
+    @property
+    def _backend(self):
+        return current_app.extensions["dm_search_response_cache"]
+
+    @property
+    def shared(self):
+        """Whether every worker sees the same generations, and so gives the same keys for the same responses"""
+        return self._backend is not None and self._backend.shared
+
+    def key(self, mapping, query_args, **options):
+        """Returns the key a search of ``mapping``'s index should be cached under, or None if it shouldn't be cached.
+
+        ``options`` should include anything besides the query arguments which affects the Elasticsearch response.
+        """
+        if self._backend is None:
+            return None
+
+        generation, started_at = self._generation(mapping.index_name)
+        if time.time() - started_at < current_app.config["DM_SEARCH_RESPONSE_CACHE_SETTLE_TIME"]:
+            SEARCH_RESPONSE_CACHE_LOOKUPS_TOTAL.labels("bypass").inc()
+            return None
+
+        canonical = json.dumps(
+            [mapping.index_name, generation, mapping.mapping_type, options, _canonical_query_args(query_args)],
+            sort_keys=True,
+        )
+        return "search:" + hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        if key is None:
+            return None
+
+        response = self._backend.get(key)
+        SEARCH_RESPONSE_CACHE_LOOKUPS_TOTAL.labels("miss" if response is None else "hit").inc()
+        return response
+
+    def set(self, key, response):
+        if key is not None:
+            self._backend.set(key, response)
+
+    def new_generation(self, index_name):
+        """Call after writing to ``index_name`` (a concrete index, not an alias) to stop serving responses from
+        before the write"""
+        if self._backend is not None:
+            self._backend.set("generation:" + index_name, [uuid.uuid4().hex, time.time()], expire=False)
+
+    def _generation(self, index_name):
+        # if the index is new to us we know of no recent write, so there's nothing to wait for
+        return self._backend.add("generation:" + index_name, [uuid.uuid4().hex, 0])
+
+
+def _canonical_query_args(query_args):
+    """Reduce a MultiDict of query arguments to only what `construct_query` actually looks at, in a consistent order,
+    so that equivalent requests share a cache entry"""
+    canonical = {}
+    if "q" in query_args:
+        canonical["q"] = query_args["q"]
+    if query_args.get("page", "1") != "1":
+        canonical["page"] = query_args["page"]
+    if "cursor" in query_args:
+        canonical["cursor"] = query_args["cursor"]
+    for flag in ("idOnly", "disjunctiveAggregations"):
+        if flag in query_args:
+            canonical[flag] = True
+    for key, values in query_args.lists():
+        if key.startswith("filter_"):
+            # values for the same field are ANDed together so their order doesn't matter
+            canonical[key] = sorted(values)
+    return canonical
+
+
+search_response_cache = SearchResponseCache()
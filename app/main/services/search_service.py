@@ -1,28 +1,68 @@
+import hashlib
+from contextlib import contextmanager
+
 from elasticsearch import TransportError
-from flask import current_app, url_for
+from elasticsearch.helpers import scan, streaming_bulk
+from flask import current_app, has_request_context, request, url_for
+from werkzeug.datastructures import MultiDict
 
-from dmutils.timing import logged_duration_for_external_request
 
 import app.mapping
-from app.main.services.response_formatters import convert_es_status, convert_es_results, generate_pagination_links
-from app.main.services.query_builder import construct_query
+from app.main.services.process_request_json import compile_ingest_pipeline
+from app.main.services.response_formatters import convert_es_status, convert_es_hit, convert_es_results, \
+    generate_pagination_links, generate_cursor_links
+from app.main.services.query_builder import construct_query, construct_composite_aggregation_query, decode_cursor, \
+    encode_cursor
+from app.main.services.search_response_cache import search_response_cache
+from app.main.services.single_flight import single_flight
+from app.main.services.slow_query_log import slow_query_log
+from app.prometheus_metrics import observe_elasticsearch_took, timed_elasticsearch_request, timed_stage
 
 from ... import elasticsearch_client as es
 
 
 def refresh(index_name):
     try:
-        with logged_duration_for_external_request('es'):
+        with timed_elasticsearch_request('refresh'):
             es.indices.refresh(index_name)
+        # responses are cached by the concrete index they came from, while ``index_name`` may well be an alias
+        with timed_elasticsearch_request('get_mapping'):
+            resolved_index_names = list(es.indices.get_mapping(index=index_name))
+        for resolved_index_name in resolved_index_names:
+            search_response_cache.new_generation(resolved_index_name)
         return "acknowledged", 200
     except TransportError as e:
         return _get_an_error_message(e), e.status_code
 
 
-def create_index(index_name, mapping_name):
+def ingest_pipeline_name(index_name):
+    return "{}-pipeline".format(index_name)
+
+
+def put_ingest_pipeline(index_name, mapping_definition):
+    """Registers the ingest pipeline compiled from ``mapping_definition``'s transformations and prefixes for the index
+    ``index_name``, returning its name"""
+    pipeline_name = ingest_pipeline_name(index_name)
+    mapping = app.mapping.Mapping(mapping_definition, mapping_definition["mappings"]["_meta"]["doc_type"])
+    with timed_elasticsearch_request('put_pipeline'):
+        es.ingest.put_pipeline(id=pipeline_name, body=compile_ingest_pipeline(mapping))
+    return pipeline_name
+
+
+def create_index(index_name, mapping_name, settings=None, meta=None):
+    """Creates the index ``index_name`` with the named mapping, updating its index settings with ``settings`` and its
+    ``_meta`` with ``meta`` if given"""
     mapping_definition = app.mapping.load_mapping_definition(mapping_name)
+    if settings:
+        mapping_definition.setdefault("settings", {}).setdefault("index", {}).update(settings)
+    if meta:
+        mapping_definition["mappings"]["_meta"].update(meta)
     try:
-        with logged_duration_for_external_request('es'):
+        if current_app.config['DM_INGEST_PIPELINES']:
+            pipeline_name = put_ingest_pipeline(index_name, mapping_definition)
+            mapping_definition.setdefault("settings", {}).setdefault("index", {})["default_pipeline"] = pipeline_name
+            mapping_definition["mappings"]["_meta"]["dm_ingest_pipeline"] = pipeline_name
+        with timed_elasticsearch_request('create_index'):
             es.indices.create(index=index_name, body=mapping_definition)
         return "acknowledged", 200
     except TransportError as e:
@@ -41,7 +81,7 @@ def create_alias(alias_name, target_index):
     """
 
     try:
-        with logged_duration_for_external_request('es'):
+        with timed_elasticsearch_request('update_aliases'):
             es.indices.update_aliases({"actions": [
                 {"remove": {"index": "_all", "alias": alias_name}},
                 {"add": {"index": target_index, "alias": alias_name}}
@@ -53,16 +93,116 @@ def create_alias(alias_name, target_index):
 
 def delete_index(index_name):
     try:
-        with logged_duration_for_external_request('es'):
+        with timed_elasticsearch_request('delete_index'):
             es.indices.delete(index=index_name)
+        if current_app.config['DM_INGEST_PIPELINES']:
+            with timed_elasticsearch_request('delete_pipeline'):
+                es.ingest.delete_pipeline(id=ingest_pipeline_name(index_name), ignore=404)
+        return "acknowledged", 200
+    except TransportError as e:
+        return _get_an_error_message(e), e.status_code
+
+
+# index settings which make filling an index faster, at the cost of nothing written being searchable, nor copied to any
+# replicas, until they're restored
+BULK_LOAD_SETTINGS = {"number_of_replicas": 0, "refresh_interval": "-1"}
+
+# the key under an index's mapping `_meta` which its own settings are saved under while it's in bulk load mode
+BULK_LOAD_META_KEY = "dm_bulk_load"
+
+
+def _get_meta(index_name):
+    """The name of the index ``index_name`` is (or is an alias of) and its mapping's `_meta`"""
+    with timed_elasticsearch_request('get_mapping'):
+        resolved_index_name, mapping_data = next(iter(es.indices.get_mapping(index=index_name).items()))
+    return resolved_index_name, mapping_data["mappings"].get("_meta", {})
+
+
+def _put_meta(index_name, meta):
+    with timed_elasticsearch_request('put_mapping'):
+        # `_meta` is replaced as a whole, not merged
+        es.indices.put_mapping(index=index_name, body={"_meta": meta})
+
+
+def _enter_bulk_load(index_name):
+    resolved_index_name, meta = _get_meta(index_name)
+    if BULK_LOAD_META_KEY not in meta:
+        with timed_elasticsearch_request('get_settings'):
+            settings = es.indices.get_settings(index=resolved_index_name)[resolved_index_name]["settings"]
+        # None (for a setting left at its default) resets it to the default when they're restored
+        _put_meta(resolved_index_name, dict(meta, **{BULK_LOAD_META_KEY: {
+            name: settings["index"].get(name) for name in BULK_LOAD_SETTINGS
+        }}))
+
+    with timed_elasticsearch_request('put_settings'):
+        es.indices.put_settings(index=resolved_index_name, body={"index": BULK_LOAD_SETTINGS})
+
+
+def _leave_bulk_load(index_name, force_merge=False):
+    """Returns False if the index wasn't in bulk load mode"""
+    resolved_index_name, meta = _get_meta(index_name)
+    if BULK_LOAD_META_KEY not in meta:
+        return False
+
+    meta = dict(meta)
+    saved_settings = meta.pop(BULK_LOAD_META_KEY)
+    with timed_elasticsearch_request('put_settings'):
+        es.indices.put_settings(index=resolved_index_name, body={"index": saved_settings})
+    _put_meta(resolved_index_name, meta)
+
+    with timed_elasticsearch_request('refresh'):
+        es.indices.refresh(index=resolved_index_name)
+    if force_merge:
+        _force_merge(resolved_index_name)
+    search_response_cache.new_generation(resolved_index_name)
+    return True
+
+
+def _force_merge(index_name):
+    with timed_elasticsearch_request('force_merge'):
+        es.indices.forcemerge(
+            index=index_name,
+            max_num_segments=current_app.config["DM_FORCE_MERGE_MAX_NUM_SEGMENTS"],
+            request_timeout=current_app.config["DM_FORCE_MERGE_TIMEOUT"],
+        )
+
+
+def enter_bulk_load(index_name):
+    """Puts ``index_name`` into bulk load mode, saving its refresh interval and number of replicas in its mapping and
+    setting `BULK_LOAD_SETTINGS` in their place. Entering it again leaves the saved settings as they are."""
+    try:
+        _enter_bulk_load(index_name)
         return "acknowledged", 200
     except TransportError as e:
         return _get_an_error_message(e), e.status_code
 
 
+def leave_bulk_load(index_name, force_merge=False):
+    """Restores the settings ``index_name`` had before it was put into bulk load mode, then refreshes it and, if
+    ``force_merge`` is set, force-merges it"""
+    try:
+        if not _leave_bulk_load(index_name, force_merge=force_merge):
+            return "Index '{}' is not in bulk load mode".format(index_name), 400
+        return "acknowledged", 200
+    except TransportError as e:
+        return _get_an_error_message(e), e.status_code
+
+
+@contextmanager
+def bulk_load(index_name, force_merge=False):
+    """Keeps ``index_name`` in bulk load mode for the duration of the block, for scripted loads. Unlike the functions
+    above, this raises any `TransportError`."""
+    _enter_bulk_load(index_name)
+    try:
+        yield
+    finally:
+        _leave_bulk_load(index_name, force_merge=force_merge)
+
+
 def fetch_by_id(index_name, doc_type, document_id):
+    _note_fetched_etag(fetch_etag(index_name, doc_type, document_id))
     try:
-        with logged_duration_for_external_request('es'):
+        with timed_elasticsearch_request('get'):
             res = es.get(index=index_name, id=document_id)
         return res, 200
     except TransportError as e:
@@ -71,7 +211,7 @@ def fetch_by_id(index_name, doc_type, document_id):
 
 def delete_by_id(index_name, doc_type, document_id):
     try:
-        with logged_duration_for_external_request('es'):
+        with timed_elasticsearch_request('delete'):
             res = es.delete(index=index_name, id=document_id)
         return res, 200
     except TransportError as e:
@@ -80,7 +220,7 @@ def delete_by_id(index_name, doc_type, document_id):
 
 def index(index_name, doc_type, document, document_id):
     try:
-        with logged_duration_for_external_request('es'):
+        with timed_elasticsearch_request('index'):
             es.index(
                 index=index_name,
                 id=document_id,
@@ -94,11 +234,76 @@ def index(index_name, doc_type, document, document_id):
         return _get_an_error_message(e), e.status_code
 
 
+def bulk(index_name, doc_type, operations):
+    """Apply ``operations``, an iterable of ``(action, document_id, document)`` tuples, to an index using as few
+    `_bulk` requests as the configured chunk size and byte limits allow.
+
+    Failures of individual operations (or of whole chunks) don't abort the batch; instead the returned report has an
+    entry for every operation, in the order they were given, each with its own status.
+    """
+    items, failures = [], 0
+    for ok, item in streaming_bulk(
+        _TimedBulkClient(es),
+        (_bulk_action(index_name, *operation) for operation in operations),
+        chunk_size=int(current_app.config['DM_BULK_INDEX_CHUNK_SIZE']),
+        max_chunk_bytes=int(current_app.config['DM_BULK_INDEX_MAX_CHUNK_BYTES']),
+        raise_on_error=False,
+        raise_on_exception=False,
+    ):
+        (action, info), = item.items()
+        items.append(_bulk_item_report(action, info))
+        # a delete of a missing document has no "error", only a 404 status, but still didn't do what was asked
+        failures += not ok
+
+    if failures:
+        current_app.logger.error(
+            "Failed to apply %s of %s bulk operations to %s",
+            failures, len(items), index_name
+        )
+
+    return {"errors": bool(failures), "items": items}, 200
+
+
+class _TimedBulkClient(object):
+    """Times each `_bulk` request `streaming_bulk` sends, so that only the time spent waiting on Elasticsearch is
+    recorded against the "bulk" operation, not that spent building and serializing the chunks"""
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def bulk(self, *args, **kwargs):
+        with timed_elasticsearch_request('bulk'):
+            return self._client.bulk(*args, **kwargs)
+
+
+def _bulk_action(index_name, action, document_id, document):
+    es_action = {"_op_type": action, "_index": index_name, "_id": document_id}
+    if action == "index":
+        es_action["_source"] = document
+    return es_action
+
+
+def _bulk_item_report(action, info):
+    report = {"id": info.get("_id"), "action": action, "status": info.get("status")}
+    if "error" in info:
+        error = info["error"]
+        report["error"] = (
+            "{}: {}".format(error.get("type", "<unknown type>"), error.get("reason", "<unknown reason>"))
+            if isinstance(error, dict) else str(error)
+        )
+    else:
+        report["result"] = info.get("result")
+    return report
+
+
 def status_for_index(index_name):
     try:
-        with logged_duration_for_external_request('es'):
+        with timed_elasticsearch_request('stats'):
             res = es.indices.stats(index=index_name, human=True)
-        with logged_duration_for_external_request('es'):
+        with timed_elasticsearch_request('get_index'):
             info = es.indices.get(index_name)
     except TransportError as e:
         return _get_an_error_message(e), e.status_code
@@ -119,29 +324,136 @@ def _page_404_response(requested_page):
     ), 404
 
 
+def _page_size(query_args):
+    page_size = int(current_app.config['DM_SEARCH_PAGE_SIZE'])
+    if 'idOnly' in query_args:
+        page_size *= int(current_app.config['DM_ID_ONLY_SEARCH_PAGE_SIZE_MULTIPLIER'])
+    return page_size
+
+
+def _uses_point_in_time(query_args, search):
+    return search and "cursor" in query_args and current_app.config['DM_SEARCH_CURSOR_USE_PIT']
+
+
+def _search_cache_key(mapping, query_args, search, aggregations):
+    # a point in time only lives as long as its keep_alive, so we mustn't go on handing out responses naming one
+    if _uses_point_in_time(query_args, search):
+        return None
+    return search_response_cache.key(
+        mapping, query_args, search=search, aggregations=sorted(set(aggregations)), page_size=_page_size(query_args)
+    )
+
+
+def _etag(cache_key):
+    # responses link to other pages by absolute url, so differ with the host they were requested from
+    return hashlib.sha1("{} {}".format(cache_key, request.url_root).encode("utf-8")).hexdigest()
+
+
+def search_etag(index_name, doc_type, query_args, search=False, aggregations=[]):
+    """A strong ETag for the response `core_search_and_aggregate` would give for these arguments now, which holds
+    until the index is next written to through this app, or None if the index's generation isn't known (see
+    `SearchResponseCache.key`) and so the response has to be fetched to be sure of it. The response itself is tagged
+    with the ETag of the generation it was fetched in, as `fetched_etag` has it.
+
+    Only a response cache shared by every worker has generations they all agree on, so without one there are no ETags
+    at all - otherwise each worker would give its own, and not know of writes handled by the others."""
+    if not search_response_cache.shared:
+        return None
+    try:
+        mapping = app.mapping.get_mapping(index_name, doc_type)
+    except (app.mapping.MappingNotFound, TransportError):
+        return None  # left to `core_search_and_aggregate` to report
+
+    cache_key = _search_cache_key(mapping, query_args, search, aggregations)
+    return None if cache_key is None else _etag(cache_key)
+
+
+def fetch_etag(index_name, doc_type, document_id):
+    """A strong ETag for the response `fetch_by_id` would give for this document now - see `search_etag`"""
+    if not search_response_cache.shared:
+        return None
+    try:
+        mapping = app.mapping.get_mapping(index_name, doc_type)
+    except (app.mapping.MappingNotFound, TransportError):
+        return None  # left to `fetch_by_id` to report
+
+    cache_key = search_response_cache.key(mapping, MultiDict(), fetch=document_id)
+    return None if cache_key is None else _etag(cache_key)
+
+
+def _note_fetched_etag(etag):
+    if has_request_context():
+        request.environ["dm.fetched_etag"] = etag
+
+
+def fetched_etag():
+    """The ETag of the search, aggregations or document the request being handled has fetched, taken from the cache key
+    it was fetched under, before asking Elasticsearch - so a write landing meanwhile can only make the ETag older than
+    the response, never newer"""
+    return request.environ.get("dm.fetched_etag")
+
+
 def core_search_and_aggregate(index_name, doc_type, query_args, search=False, aggregations=[]):
+    with slow_query_log.record(index_name, query_args, search=search, aggregations=aggregations):
+        return _core_search_and_aggregate(index_name, doc_type, query_args, search=search, aggregations=aggregations)
+
+
+def _core_search_and_aggregate(index_name, doc_type, query_args, search=False, aggregations=[]):
     try:
         mapping = app.mapping.get_mapping(index_name, doc_type)
-        page_size = int(current_app.config['DM_SEARCH_PAGE_SIZE'])
-        if 'idOnly' in query_args:
-            page_size *= int(current_app.config['DM_ID_ONLY_SEARCH_PAGE_SIZE_MULTIPLIER'])
-
-        es_search_kwargs = {'search_type': 'dfs_query_then_fetch'} if search else {}
-        constructed_query = construct_query(mapping, query_args, aggregations, page_size)
-        with logged_duration_for_external_request('es'):
-            res = es.search(
-                index=index_name, body=constructed_query, track_total_hits=True, **es_search_kwargs
+        page_size = _page_size(query_args)
+        use_cursor = search and "cursor" in query_args
+        use_point_in_time = _uses_point_in_time(query_args, search)
+
+        cache_key = _search_cache_key(mapping, query_args, search, aggregations)
+        if search_response_cache.shared and cache_key is not None:
+            _note_fetched_etag(_etag(cache_key))
+        res = search_response_cache.get(cache_key)
+        if res is None:
+            es_search_kwargs = {'search_type': 'dfs_query_then_fetch'} if search else {}
+            aggregation_sizes = app.mapping.get_aggregation_sizes(mapping) if aggregations else None
+            with timed_stage("query_construction"):
+                constructed_query = construct_query(
+                    mapping, query_args, aggregations, page_size, with_documents=search,
+                    aggregation_sizes=aggregation_sizes,
+                )
+            search_index = index_name
+            if use_point_in_time:
+                # searches of a point in time mustn't name an index - the point in time determines it
+                constructed_query["pit"] = {
+                    "id": _point_in_time_for_cursor(index_name, query_args["cursor"]),
+                    "keep_alive": current_app.config['DM_SEARCH_CURSOR_PIT_KEEP_ALIVE'],
+                }
+                search_index = None
+            res = single_flight.do(
+                search_index, constructed_query, es_search_kwargs,
+                lambda: _search_and_complete_aggregations(
+                    index_name, mapping, query_args, search_index, constructed_query, es_search_kwargs
+                ),
             )
 
-        results = convert_es_results(mapping, res, query_args)
+            # determine whether we're actually off the end of the results. ES handles this as a result-less-yet-happy
+            # response, but we probably want to turn it into a 404 not least so we can match our behaviour when
+            # fetching beyond the `max_result_window` below
+            if _is_off_the_end(constructed_query, res):
+                return _page_404_response(query_args.get("page", None))
+
+            search_response_cache.set(cache_key, res)
+
+        with timed_stage("result_conversion"):
+            results = convert_es_results(mapping, res, query_args)
 
         def url_for_search(**kwargs):
             return url_for('.search', index_name=index_name, doc_type=doc_type, _external=True, **kwargs)
 
+        next_cursor = _next_cursor(res, page_size, close_point_in_time=use_point_in_time) if use_cursor else None
+
         response = {
             "meta": results['meta'],
             "documents": results['documents'],
-            "links": generate_pagination_links(
+            "links": generate_cursor_links(
+                query_args, next_cursor, url_for_search
+            ) if use_cursor else generate_pagination_links(
                 query_args, results['meta']['total'],
                 page_size, url_for_search
             ),
@@ -150,16 +462,10 @@ def core_search_and_aggregate(index_name, doc_type, query_args, search=False, ag
         if aggregations:
             # Return aggregations in a slightly cleaner format.
             response['aggregations'] = {
-                k: {d['key']: d['doc_count'] for d in v['buckets']}
+                k: {d['key']: d['doc_count'] for d in v.get(k, v)['buckets']}
                 for k, v in res.get('aggregations', {}).items()
             }
 
-        # determine whether we're actually off the end of the results. ES handles this as a result-less-yet-happy
-        # response, but we probably want to turn it into a 404 not least so we can match our behaviour when fetching
-        # beyond the `max_result_window` below
-        if search and constructed_query.get("from") and not response["documents"]:
-            return _page_404_response(query_args.get("page", None))
-
         return response, 200
 
     except TransportError as e:
@@ -174,7 +480,7 @@ def core_search_and_aggregate(index_name, doc_type, query_args, search=False, ag
             # (note minor race condition possible if index is modified between the original call and this one)
             try:
                 body = construct_query(mapping, query_args, page_size=None)
-                with logged_duration_for_external_request('es'):
+                with timed_elasticsearch_request('count'):
                     result_count = es.count(
                         index=index_name,
                         body=body
@@ -193,14 +499,131 @@ def core_search_and_aggregate(index_name, doc_type, query_args, search=False, ag
         return str(e), 400
 
 
-def search_with_keywords_and_filters(index_name, doc_type, query_args):
-    return core_search_and_aggregate(index_name, doc_type, query_args, search=True)
+def _search_and_complete_aggregations(index_name, mapping, query_args, search_index, constructed_query, search_kwargs):
+    with timed_elasticsearch_request('search'):
+        res = es.search(index=search_index, body=constructed_query, track_total_hits=True, **search_kwargs)
+    observe_elasticsearch_took(res)
+    if not _is_off_the_end(constructed_query, res):
+        _complete_truncated_aggregations(index_name, mapping, query_args, res)
+    return res
+
+
+def _is_off_the_end(constructed_query, res):
+    return bool(constructed_query.get("from")) and not res["hits"]["hits"]
+
+
+def _complete_truncated_aggregations(index_name, mapping, query_args, res):
+    """Fill in the buckets of any aggregations in ``res`` which had more values than we asked for"""
+    for field_name, aggregation in res.get('aggregations', {}).items():
+        # disjunctive aggregations have their buckets in a sub-aggregation of the same name
+        terms = aggregation.get(field_name, aggregation)
+        if terms.get('sum_other_doc_count'):
+            terms['buckets'] = list(_all_aggregation_buckets(index_name, mapping, query_args, field_name))
+            terms['sum_other_doc_count'] = 0
+
+
+def _all_aggregation_buckets(index_name, mapping, query_args, field_name):
+    """Generates every bucket of a field's aggregation, using a composite aggregation to fetch them a page at a time"""
+    page_size = int(current_app.config['DM_AGGREGATION_COMPOSITE_PAGE_SIZE'])
+    after = None
+    while True:
+        with timed_elasticsearch_request('search'):
+            res = es.search(index=index_name, body=construct_composite_aggregation_query(
+                mapping, query_args, field_name, page_size, after=after
+            ))
+        composite = res['aggregations'][field_name]
+        for bucket in composite['buckets']:
+            yield {'key': bucket['key'][field_name], 'doc_count': bucket['doc_count']}
+
+        after = composite.get('after_key')
+        if after is None or len(composite['buckets']) < page_size:
+            return
+
+
+def _point_in_time_for_cursor(index_name, cursor):
+    """Returns the id of the point in time a cursor was read from, or of a new one if it's the first page's cursor"""
+    pit_id = decode_cursor(cursor).get("pit") if cursor else None
+    if pit_id is None:
+        with timed_elasticsearch_request('open_point_in_time'):
+            pit_id = es.open_point_in_time(
+                index=index_name, keep_alive=current_app.config['DM_SEARCH_CURSOR_PIT_KEEP_ALIVE']
+            )["id"]
+    return pit_id
+
+
+def _close_point_in_time(pit_id):
+    """Closes a point in time now rather than leaving it to hold a search context open until its keep_alive runs out"""
+    try:
+        with timed_elasticsearch_request('close_point_in_time'):
+            es.close_point_in_time(body={"id": pit_id})
+    except TransportError as e:
+        current_app.logger.warning("Failed to close point in time: %s", _get_an_error_message(e))
+
+
+def _next_cursor(res, page_size, close_point_in_time=False):
+    """The cursor of the page after ``res``, or None if it's the last - in which case, with ``close_point_in_time``,
+    the point in time it was read from is closed, as nothing will search it again"""
+    hits = res["hits"]["hits"]
+    if len(hits) < page_size:
+        if close_point_in_time:
+            _close_point_in_time(res["pit_id"])
+        return None
+    # the point in time's id can change between searches, so always pass on the latest
+    return encode_cursor(hits[-1]["sort"], res.get("pit_id"))
+
+
+def search_with_keywords_and_filters(index_name, doc_type, query_args, aggregations=[]):
+    return core_search_and_aggregate(index_name, doc_type, query_args, search=True, aggregations=aggregations)
 
 
 def aggregations_with_keywords_and_filters(index_name, doc_type, query_args, aggregations=[]):
     return core_search_and_aggregate(index_name, doc_type, query_args, aggregations=aggregations)
 
 
+def export(index_name, doc_type, query_args):
+    """Returns a generator of every document matching ``query_args`` (or just their ids, with `idOnly`), in no
+    particular order, read from a scroll a page at a time so memory use doesn't grow with the number of results.
+
+    The first page is fetched before returning so that errors can still be reported with a status code. An error
+    after that can only cut the export short.
+    """
+    try:
+        mapping = app.mapping.get_mapping(index_name, doc_type)
+        id_only = 'idOnly' in query_args
+
+        query = construct_query(mapping, query_args, page_size=None)
+        query['_source'] = False if id_only else (mapping.response_source_includes or False)
+        hits = scan(
+            es,
+            index=index_name,
+            query=query,
+            size=int(current_app.config['DM_EXPORT_PAGE_SIZE']),
+            scroll=current_app.config['DM_EXPORT_SCROLL_KEEP_ALIVE'],
+        )
+        with timed_elasticsearch_request('scroll'):
+            first_hit = next(hits, None)
+    except TransportError as e:
+        return _get_an_error_message(e), e.status_code
+    except ValueError as e:
+        return str(e), 400
+
+    def documents():
+        if first_hit is None:
+            return
+        yield convert_es_hit(mapping, first_hit, id_only=id_only)
+        try:
+            for hit in hits:
+                yield convert_es_hit(mapping, hit, id_only=id_only)
+        except TransportError as e:
+            current_app.logger.error(
+                "Export of %s failed part way through: %s",
+                index_name, _get_an_error_message(e)
+            )
+            raise
+
+    return documents(), 200
+
+
 def _get_an_error_message(exception):
     try:
         info = exception.info
@@ -217,7 +640,7 @@ def _get_an_error_message(exception):
 
         return f"{type}: {reason}"
 
-    except (KeyError, IndexError):
+    except (KeyError, IndexError, TypeError):  # some errors, such as a missing alias, are only a string
         pass
 
     return error
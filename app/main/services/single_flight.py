@@ -0,0 +1,174 @@
+import hashlib
+import threading
+import time
+import uuid
+
+from flask import current_app, json
+
+from app.prometheus_metrics import SEARCH_SINGLE_FLIGHT_REQUESTS_TOTAL
+
+
+class SingleFlight(object):
+    """Coalesces identical Elasticsearch searches made at the same time, so that when many requests for the same
+    results arrive at once (say, for a framework's landing page as it opens) only one search is actually sent and the
+    rest wait for, and share, its response.
+
+    Searches are identified by the body actually sent to Elasticsearch rather than by the request's query arguments.
+    A request which waits longer than ``DM_SEARCH_SINGLE_FLIGHT_TIMEOUT`` seconds abandons the wait and makes its own
+    search.
+
+    How many requests were coalesced is counted by the ``search_api_search_single_flight_requests_total`` metric.
+    """
+
+    def init_app(self, app):
+        backend = app.config["DM_SEARCH_SINGLE_FLIGHT_BACKEND"]
+        if backend == "memory":
+            app.extensions["dm_search_single_flight"] = InProcessSingleFlight(
+                timeout=app.config["DM_SEARCH_SINGLE_FLIGHT_TIMEOUT"],
+            )
+        elif backend == "redis":
+            app.extensions["dm_search_single_flight"] = RedisSingleFlight(
+                url=app.config["DM_SEARCH_SINGLE_FLIGHT_REDIS_URL"],
+                timeout=app.config["DM_SEARCH_SINGLE_FLIGHT_TIMEOUT"],
+            )
+        elif backend is None:
+            app.extensions["dm_search_single_flight"] = None
+        else:
+            raise ValueError("Unrecognized DM_SEARCH_SINGLE_FLIGHT_BACKEND {!r}".format(backend))
+
+    def do(self, index_name, body, search_kwargs, fn):
+        """Returns the result of ``fn()``, which should make the search of ``index_name`` with ``body`` and
+        ``search_kwargs``, or that of an identical search already in flight"""
+        backend = current_app.extensions["dm_search_single_flight"]
+        if backend is None:
+            return fn()
+
+        key = hashlib.sha1(
+            json.dumps([index_name, body, search_kwargs], sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        return backend.do(key, fn)
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class InProcessSingleFlight(object):
+    """Coalesces calls made by the threads (or greenlets) of this worker. Waiting callers get the leader's exception if
+    it raises one."""
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            if not flight.done.wait(self.timeout):
+                SEARCH_SINGLE_FLIGHT_REQUESTS_TOTAL.labels("abandoned").inc()
+                return fn()
+            SEARCH_SINGLE_FLIGHT_REQUESTS_TOTAL.labels("coalesced").inc()
+            if flight.exception is not None:
+                raise flight.exception
+            return flight.result
+
+        SEARCH_SINGLE_FLIGHT_REQUESTS_TOTAL.labels("leader").inc()
+        try:
+            flight.result = fn()
+            return flight.result
+        except Exception as e:
+            flight.exception = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+# releases a leader's lock only if it still names the leader's token, so that a leader which overran the lock's expiry
+# doesn't release that of the next leader (letting every caller waiting on it through)
+_RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class RedisSingleFlight(object):
+    """Coalesces calls made by every worker (and instance) pointed at the same Redis.
+
+    The leader holds a lock naming a unique token, under which it publishes its result for the others (who poll for
+    it) to pick up. Results must be JSON-serializable. If the leader fails, or Redis can't be reached, callers just
+    call ``fn`` themselves.
+    """
+
+    def __init__(self, url, timeout, poll_interval=0.02, key_prefix="dm-search-api:flight:"):
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+        self._error = redis.RedisError
+        self._release_script = self._redis.register_script(_RELEASE_SCRIPT)
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.key_prefix = key_prefix
+
+    def do(self, key, fn):
+        lock_key = self.key_prefix + key
+        token = uuid.uuid4().hex
+        try:
+            leader = self._redis.set(lock_key, token, nx=True, px=int(self.timeout * 1000))
+            if not leader:
+                return self._wait_for(lock_key, fn)
+        except self._error as e:
+            current_app.logger.warning("Failed to coalesce search: %s", e)
+            return fn()
+
+        SEARCH_SINGLE_FLIGHT_REQUESTS_TOTAL.labels("leader").inc()
+        try:
+            result = fn()
+        except Exception:
+            self._release(lock_key, token)
+            raise
+
+        try:
+            self._redis.set(self.key_prefix + "result:" + token, json.dumps(result), px=int(self.timeout * 1000))
+        except self._error as e:
+            current_app.logger.warning("Failed to publish coalesced search result: %s", e)
+        self._release(lock_key, token)
+        return result
+
+    def _release(self, lock_key, token):
+        try:
+            self._release_script(keys=[lock_key], args=[token])
+        except self._error as e:
+            current_app.logger.warning("Failed to release search lock: %s", e)
+
+    def _wait_for(self, lock_key, fn):
+        token = self._redis.get(lock_key)
+        deadline = time.monotonic() + self.timeout
+        while token is not None and time.monotonic() < deadline:
+            # check on the leader before looking for its result, as it publishes that before releasing the lock
+            leader_finished = not self._redis.exists(lock_key)
+            result = self._redis.get(self.key_prefix + "result:" + token.decode("utf-8"))
+            if result is not None:
+                SEARCH_SINGLE_FLIGHT_REQUESTS_TOTAL.labels("coalesced").inc()
+                return json.loads(result)
+            if leader_finished:
+                break
+            time.sleep(self.poll_interval)
+
+        SEARCH_SINGLE_FLIGHT_REQUESTS_TOTAL.labels("abandoned").inc()
+        return fn()
+
+
+single_flight = SingleFlight()
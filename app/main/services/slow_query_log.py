@@ -0,0 +1,151 @@
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from flask import current_app, json
+
+
+class SlowQueryLog(object):
+    """Per-worker record of how long searches and aggregations take, grouped by "fingerprint" - the index and the shape
+    of the query (which filters, whether there are keywords, which aggregations, how deep a page) without any of its
+    values - so the kinds of query responsible for Elasticsearch being slow can be found.
+
+    Any single request taking at least ``DM_SLOW_QUERY_LOG_THRESHOLD`` seconds is logged. At most
+    ``DM_SLOW_QUERY_LOG_MAX_FINGERPRINTS`` fingerprints are tracked, those seen least recently being dropped to make
+    room for new ones, and percentiles are calculated from the last ``DM_SLOW_QUERY_LOG_SAMPLES`` durations of each.
+    """
+
+    def init_app(self, app):
+        app.extensions["dm_slow_query_log"] = FingerprintStats(
+            max_size=app.config["DM_SLOW_QUERY_LOG_MAX_FINGERPRINTS"],
+            samples=app.config["DM_SLOW_QUERY_LOG_SAMPLES"],
+        )
+
+    @property
+    def _stats(self):
+        return current_app.extensions["dm_slow_query_log"]
+
+    @contextmanager
+    def record(self, index_name, query_args, search=False, aggregations=()):
+        """Time the search (or aggregation) of ``index_name`` made within the block"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            shape = dict(fingerprint(query_args, search=search, aggregations=aggregations), index=index_name)
+            fingerprint_id = self._stats.record(shape, duration)
+
+            threshold = current_app.config["DM_SLOW_QUERY_LOG_THRESHOLD"]
+            if threshold is not None and duration >= threshold:
+                current_app.logger.warning(
+                    "Slow query of %s took %.3fs (fingerprint %s)", index_name, duration, fingerprint_id,
+                    extra={"index_name": index_name, "duration": duration, "fingerprint": shape,
+                           "fingerprint_id": fingerprint_id, "query_args": query_args.to_dict(flat=False)},
+                )
+
+    def most_expensive(self, limit):
+        """The ``limit`` fingerprints which have taken the most time in total, most expensive first"""
+        return self._stats.most_expensive(limit)
+
+
+def _page_depth(query_args):
+    if "cursor" in query_args:
+        return "cursor"
+    try:
+        page = int(query_args.get("page", 1))
+    except ValueError:
+        return "invalid"
+    for depth in (1, 10, 100, 1000):
+        if page <= depth:
+            return "<={}".format(depth)
+    return ">1000"
+
+
+def fingerprint(query_args, search=False, aggregations=()):
+    """The shape of a search or aggregation request, as a dict which is the same for any two requests differing only
+    in their keywords, filter values or (to within an order of magnitude) page"""
+    return {
+        "search": search,
+        "keywords": "q" in query_args,
+        "filters": sorted(key[len("filter_"):] for key in query_args.keys() if key.startswith("filter_")),
+        "aggregations": sorted(set(aggregations)),
+        "disjunctive": "disjunctiveAggregations" in query_args,
+        "idOnly": "idOnly" in query_args,
+        "page": _page_depth(query_args),
+    }
+
+
+class FingerprintStats(object):
+    """A thread-safe, size-bounded table of how many times each fingerprint has been seen and how long it took"""
+
+    def __init__(self, max_size, samples):
+        self.max_size = max_size
+        self.samples = samples
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # {fingerprint id: _FingerprintEntry}
+
+    def record(self, shape, duration):
+        """Add a ``duration`` for the fingerprint ``shape``, returning its id"""
+        fingerprint_id = hashlib.sha1(json.dumps(shape, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+        if not self.max_size:
+            return fingerprint_id
+
+        with self._lock:
+            entry = self._entries.get(fingerprint_id)
+            if entry is None:
+                entry = self._entries[fingerprint_id] = _FingerprintEntry(shape, self.samples)
+            self._entries.move_to_end(fingerprint_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+            entry.count += 1
+            entry.total_duration += duration
+            entry.max_duration = max(entry.max_duration, duration)
+            entry.durations.append(duration)
+
+        return fingerprint_id
+
+    def most_expensive(self, limit):
+        with self._lock:
+            entries = sorted(self._entries.items(), key=lambda item: item[1].total_duration, reverse=True)[:limit]
+            return [entry.as_dict(fingerprint_id) for fingerprint_id, entry in entries]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _FingerprintEntry(object):
+    def __init__(self, shape, samples):
+        self.shape = shape
+        self.count = 0
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+        self.durations = deque(maxlen=samples)
+
+    def as_dict(self, fingerprint_id):
+        durations = sorted(self.durations)
+        return {
+            "id": fingerprint_id,
+            "fingerprint": self.shape,
+            "count": self.count,
+            "totalSeconds": self.total_duration,
+            "meanSeconds": self.total_duration / self.count,
+            "maxSeconds": self.max_duration,
+            "percentileSeconds": {
+                "50": _percentile(durations, 0.5),
+                "95": _percentile(durations, 0.95),
+                "99": _percentile(durations, 0.99),
+            },
+        }
+
+
+def _percentile(sorted_values, fraction):
+    """The nearest-rank percentile of a sorted list, or None if it's empty"""
+    return sorted_values[max(0, math.ceil(len(sorted_values) * fraction) - 1)] if sorted_values else None
+
+
+slow_query_log = SlowQueryLog()
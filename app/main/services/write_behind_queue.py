@@ -0,0 +1,327 @@
+import atexit
+import os
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+
+from flask import current_app, json
+
+from app.main.services.search_response_cache import search_response_cache
+from app.main.services.search_service import bulk
+from app.prometheus_metrics import WRITE_BEHIND_FLUSH_DURATION_SECONDS, WRITE_BEHIND_OPERATIONS_TOTAL, \
+    WRITE_BEHIND_QUEUE_DEPTH
+
+
+# ``index_name`` is the index (or alias) the operation was requested for, and ``resolved_index_name`` the concrete
+# index that was at the time, whose search response cache generation is replaced once it's written. ``attempts`` is
+# how many times it has been sent and failed in a way worth trying again
+QueuedOperation = namedtuple(
+    "QueuedOperation", ("index_name", "resolved_index_name", "action", "document_id", "document", "attempts"),
+    defaults=(0,),
+)
+
+
+class WriteBehindQueue(object):
+    """Per-worker queue of index and delete operations which have been acknowledged (with a 202) but not yet sent to
+    Elasticsearch, when ``DM_WRITE_BEHIND`` is set. A background thread sends them as `_bulk` requests once
+    ``DM_WRITE_BEHIND_BATCH_SIZE`` are waiting or every ``DM_WRITE_BEHIND_FLUSH_INTERVAL`` seconds, whichever is
+    sooner, and only the last operation queued on each document in that time is sent. Operations which fail because
+    Elasticsearch couldn't be reached or couldn't cope (with a 429 or 5xx) are put back at the front of the queue to be
+    tried again, up to ``DM_WRITE_BEHIND_MAX_ATTEMPTS`` times in all, after which they're dead-lettered: logged and,
+    with a spool, written to a file of their own which is never replayed. Any others which fail are logged and dropped.
+
+    At most ``DM_WRITE_BEHIND_MAX_QUEUE_SIZE`` operations wait at once: beyond that, requests wait up to
+    ``DM_WRITE_BEHIND_ENQUEUE_TIMEOUT`` seconds for room and are otherwise turned away. With a
+    ``DM_WRITE_BEHIND_SPOOL_DIR`` each operation is also written to a file there before it's acknowledged, and the
+    operations left in the files of workers which died are sent by the next worker to start its thread.
+    """
+
+    def init_app(self, app):
+        app.extensions["dm_write_behind_queue"] = _Buffer(
+            app,
+            max_size=app.config["DM_WRITE_BEHIND_MAX_QUEUE_SIZE"],
+            batch_size=app.config["DM_WRITE_BEHIND_BATCH_SIZE"],
+            flush_interval=app.config["DM_WRITE_BEHIND_FLUSH_INTERVAL"],
+            max_attempts=app.config["DM_WRITE_BEHIND_MAX_ATTEMPTS"],
+            spool_dir=app.config["DM_WRITE_BEHIND_SPOOL_DIR"],
+        ) if app.config["DM_WRITE_BEHIND"] else None
+
+    @property
+    def _buffer(self):
+        return current_app.extensions["dm_write_behind_queue"]
+
+    @property
+    def enabled(self):
+        return self._buffer is not None
+
+    def put(self, index_name, resolved_index_name, action, document_id, document=None):
+        """Queue an operation as `search_service.bulk` takes them, returning False if there wasn't room for it"""
+        operation = QueuedOperation(index_name, resolved_index_name, action, document_id, document)
+        if self._buffer.put(operation, timeout=current_app.config["DM_WRITE_BEHIND_ENQUEUE_TIMEOUT"]):
+            return True
+        WRITE_BEHIND_OPERATIONS_TOTAL.labels("rejected").inc()
+        return False
+
+    def flush(self):
+        """Send everything queued so far, without waiting for the background thread to, returning how many operations
+        were put back to be tried again"""
+        return self._buffer.flush()
+
+
+class _Buffer(object):
+    def __init__(self, app, max_size, batch_size, flush_interval, max_attempts, spool_dir=None):
+        self._app = app
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self._spool = _Spool(spool_dir) if spool_dir else None
+
+        self._condition = threading.Condition()
+        self._operations = deque()
+        self._flushing = threading.Lock()  # so operations on the same document are sent in the order they came
+        self._thread = None
+        self._pid = None
+
+    def put(self, operation, timeout):
+        with self._condition:
+            self._start_thread()
+            if not self._condition.wait_for(lambda: len(self._operations) < self.max_size, timeout):
+                return False
+            self._append(operation)
+        return True
+
+    def _append(self, operation):
+        if self._spool is not None:
+            self._spool.append(operation)
+        self._operations.append(operation)
+        WRITE_BEHIND_QUEUE_DEPTH.inc()
+        if len(self._operations) >= self.batch_size:
+            self._condition.notify_all()
+
+    def _start_thread(self):
+        # threads don't survive forking, so each worker process needs its own
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _take(self):
+        """Everything queued so far, and whether it has been spooled"""
+        with self._condition:
+            operations = list(self._operations)
+            self._operations.clear()
+            WRITE_BEHIND_QUEUE_DEPTH.dec(len(operations))
+            spooled = self._spool is not None and self._spool.rotate() is not None
+            self._condition.notify_all()
+        return operations, spooled
+
+    def _put_back(self, operations):
+        with self._condition:
+            # ahead of anything queued since, so that operations on each document are still sent in order
+            self._operations.extendleft(reversed(operations))
+            WRITE_BEHIND_QUEUE_DEPTH.inc(len(operations))
+
+    def flush(self):
+        with self._flushing, self._app.app_context():
+            operations, spooled = self._take()
+            try:
+                retries = _write(operations)
+            except Exception:
+                current_app.logger.exception("Failed to write %s queued operations", len(operations))
+                retries = operations
+            retries = [operation._replace(attempts=operation.attempts + 1) for operation in retries]
+            dead_letters = [operation for operation in retries if operation.attempts >= self.max_attempts]
+            if dead_letters:
+                self._dead_letter(dead_letters)
+                retries = [operation for operation in retries if operation.attempts < self.max_attempts]
+            if retries:
+                WRITE_BEHIND_OPERATIONS_TOTAL.labels("retried").inc(len(retries))
+                self._put_back(retries)
+            if spooled:
+                self._spool.keep(retries)
+            return len(retries)
+
+    def _dead_letter(self, operations):
+        WRITE_BEHIND_OPERATIONS_TOTAL.labels("dead_lettered").inc(len(operations))
+        # before they're cut from the spool, so that a crash in between leaves them in both files rather than neither
+        dead_letter_path = self._spool.dead_letter(operations) if self._spool is not None else None
+        for operation in operations:
+            current_app.logger.error(
+                "Giving up on queued %s of document %s in %s after %s attempts%s",
+                operation.action, operation.document_id, operation.index_name, operation.attempts,
+                ", kept in {}".format(dead_letter_path) if dead_letter_path else "",
+            )
+
+    def _run(self):
+        if self._spool is not None:
+            with self._app.app_context():
+                self._replay_spool()
+
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: len(self._operations) >= self.batch_size, self.flush_interval)
+            try:
+                if self.flush():
+                    # give Elasticsearch time to recover before trying again
+                    time.sleep(self.flush_interval)
+            except Exception:
+                with self._app.app_context():
+                    current_app.logger.exception("Failed to write queued operations")
+
+    def _replay_spool(self):
+        for path in self._spool.claim_orphans():
+            with open(path) as spool_file:
+                operations = [QueuedOperation(**json.loads(line)) for line in spool_file if line.strip()]
+            with self._condition:
+                # regardless of the queue's size, as they've already been acknowledged
+                for operation in operations:
+                    self._append(operation)
+            os.remove(path)
+            current_app.logger.info("Replaying %s queued operations from %s", len(operations), path)
+
+
+def _is_retryable(item):
+    # an operation which couldn't be sent at all has the name of the exception as its status rather than a number
+    return not isinstance(item["status"], int) or item["status"] == 429 or item["status"] >= 500
+
+
+def _write(operations):
+    """Send ``operations``, returning those which failed but are worth trying again"""
+    # only the last operation on each document matters, and it's sent in the place of the last one
+    latest = OrderedDict()
+    for operation in operations:
+        key = (operation.index_name, operation.document_id)
+        latest.pop(key, None)
+        latest[key] = operation
+    WRITE_BEHIND_OPERATIONS_TOTAL.labels("coalesced").inc(len(operations) - len(latest))
+
+    operations_by_index = OrderedDict()
+    for operation in latest.values():
+        operations_by_index.setdefault(operation.index_name, []).append(operation)
+
+    retries = []
+    for index_name, index_operations in operations_by_index.items():
+        with WRITE_BEHIND_FLUSH_DURATION_SECONDS.labels(index_name).time():
+            result, _ = bulk(index_name, None, (
+                (operation.action, operation.document_id, operation.document) for operation in index_operations
+            ))
+        for operation, item in zip(index_operations, result["items"]):
+            if _is_retryable(item):
+                retries.append(operation)
+                current_app.logger.warning(
+                    "Failed to %s queued document %s in %s (attempt %s): %s",
+                    operation.action, operation.document_id, index_name, operation.attempts + 1,
+                    item.get("error", item.get("result")),
+                )
+            elif "error" in item or item["status"] >= 300:
+                WRITE_BEHIND_OPERATIONS_TOTAL.labels("failed").inc()
+                current_app.logger.error(
+                    "Failed to %s queued document %s in %s: %s",
+                    operation.action, operation.document_id, index_name, item.get("error", item.get("result")),
+                )
+            else:
+                WRITE_BEHIND_OPERATIONS_TOTAL.labels("written").inc()
+
+        for resolved_index_name in {operation.resolved_index_name for operation in index_operations}:
+            search_response_cache.new_generation(resolved_index_name)
+
+    return retries
+
+
+def _sync(file):
+    file.flush()
+    os.fsync(file.fileno())
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # it's running, as someone else
+    return True
+
+
+class _Spool(object):
+    """Files of queued operations, one JSON object per line, one file per worker process. Each is moved aside whenever
+    its operations are taken to be sent, and deleted once they have been (or cut down to those to be tried again).
+    Operations which have been tried too many times are appended to a ".dead" file, which isn't replayed."""
+
+    # the pid of the worker which spooled the operations, and of the one replaying them if they've been claimed
+    file_name_pattern = re.compile(r"(write-behind-(\d+)\.ndjson(\.sending)?)(\.claimed-(\d+))?$")
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._file = None
+        self._path = None
+        self._sending_path = None
+
+    def append(self, operation):
+        if self._file is None:
+            self._path = os.path.join(self.directory, "write-behind-{}.ndjson".format(os.getpid()))
+            self._file = open(self._path, "a")
+        self._file.write(json.dumps(operation._asdict()) + "\n")
+        _sync(self._file)
+
+    def rotate(self):
+        """Move what has been spooled so far aside, after anything already there to be tried again, returning where to,
+        or None if nothing has been"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            sending_path = self._path + ".sending"
+            if os.path.exists(sending_path):
+                with open(self._path) as spool_file, open(sending_path, "a") as sending_file:
+                    shutil.copyfileobj(spool_file, sending_file)
+                    _sync(sending_file)
+                os.remove(self._path)
+            else:
+                os.replace(self._path, sending_path)
+            self._sending_path = sending_path
+        return self._sending_path
+
+    def keep(self, operations):
+        """Cut what was moved aside down to ``operations``, those of it still to be sent"""
+        if not operations:
+            os.remove(self._sending_path)
+            self._sending_path = None
+            return
+        with open(self._sending_path + ".tmp", "w") as sending_file:
+            sending_file.writelines(json.dumps(operation._asdict()) + "\n" for operation in operations)
+            _sync(sending_file)
+        os.replace(self._sending_path + ".tmp", self._sending_path)
+
+    def dead_letter(self, operations):
+        """Append ``operations`` to this worker's dead-letter file, returning its path"""
+        path = os.path.join(self.directory, "write-behind-{}.ndjson.dead".format(os.getpid()))
+        with open(path, "a") as dead_letter_file:
+            dead_letter_file.writelines(json.dumps(operation._asdict()) + "\n" for operation in operations)
+            _sync(dead_letter_file)
+        return path
+
+    def claim_orphans(self):
+        """Yield the spool files of worker processes which aren't running any more (including those claimed by workers
+        which died replaying them), oldest operations first, each renamed first so that no other worker claims it too"""
+        orphans = []
+        for file_name in os.listdir(self.directory):
+            match = self.file_name_pattern.match(file_name)
+            if match and not _is_running(int(match.group(5) or match.group(2))):
+                # a ".sending" file's operations were queued before those of the file it was rotated out of
+                orphans.append((int(match.group(2)), match.group(3) is None, file_name, match.group(1)))
+
+        for _, _, file_name, unclaimed_file_name in sorted(orphans):
+            claimed = os.path.join(self.directory, "{}.claimed-{}".format(unclaimed_file_name, os.getpid()))
+            try:
+                os.rename(os.path.join(self.directory, file_name), claimed)
+            except FileNotFoundError:
+                continue  # another worker got there first
+            yield claimed
+
+
+write_behind_queue = WriteBehindQueue()
@@ -1,9 +1,75 @@
+from flask import current_app, request
 from werkzeug.exceptions import abort
 
 from app.main import main
-from app.main.services.search_service import create_index, create_alias, status_for_index, delete_index
+from app.mapping import mapping_cache
+from app.main.services.meta_response_cache import meta_response_cache
+from app.main.services.search_response_cache import search_response_cache
+from app.main.services.search_service import create_index, create_alias, status_for_index, delete_index, \
+    enter_bulk_load, leave_bulk_load
 from app.main.services.process_request_json import get_json_from_request
+from app.main.services.reindex_service import reindex_status, resume_reindex, start_reindex
 from app.main.services.response_formatters import api_response
+from app.main.services.slow_query_log import slow_query_log
+
+
+@main.route('/_slow-queries', methods=['GET'])
+def slow_queries():
+    """The query fingerprints which have taken this worker the most time in total, most expensive first"""
+    try:
+        limit = int(request.args.get('limit', current_app.config['DM_SLOW_QUERY_LOG_TOP_N']))
+    except ValueError:
+        abort(400, "Invalid limit {}".format(request.args['limit']))
+
+    return api_response(slow_query_log.most_expensive(limit), 200, key='fingerprints')
+
+
+@main.route('/<string:alias_name>/_reindex', methods=['POST'])
+def reindex(alias_name):
+    """Starts copying the index ``alias_name`` points to into a new index with the given mapping, pointing the alias
+    at the new index once it's ready. The response has the job's progress, as does `GET /<new index>/_reindex`.
+
+    Other workers only see the swap once their cached mapping of the alias expires (see ``DM_MAPPING_CACHE_TTL``).
+    """
+    mapping_name = get_json_from_request('mapping')
+    target_index = get_json_from_request('target')
+
+    result, status_code = start_reindex(alias_name, target_index, mapping_name)
+
+    return api_response(result, status_code, key='reindex')
+
+
+@main.route('/<string:index_name>/_reindex', methods=['GET'])
+def reindex_progress(index_name):
+    result, status_code = reindex_status(index_name)
+
+    return api_response(result, status_code, key='reindex')
+
+
+@main.route('/<string:index_name>/_reindex/resume', methods=['POST'])
+def resume_reindex_job(index_name):
+    """Carries on with a reindex job into the index which has been abandoned (as its progress will say), or which
+    failed after its documents were copied, from the step it stopped at"""
+    result, status_code = resume_reindex(index_name)
+
+    return api_response(result, status_code, key='reindex')
+
+
+@main.route('/<string:index_name>/_bulk-load', methods=['PUT'])
+def start_bulk_load(index_name):
+    """Puts the index into bulk load mode, in which writes to it are faster but only become searchable (and copied to
+    any replicas) once it leaves it"""
+    result, status_code = enter_bulk_load(index_name)
+
+    return api_response(result, status_code)
+
+
+@main.route('/<string:index_name>/_bulk-load', methods=['DELETE'])
+def finish_bulk_load(index_name):
+    """Takes the index out of bulk load mode, force-merging it too if `force-merge` is given"""
+    result, status_code = leave_bulk_load(index_name, force_merge='force-merge' in request.args)
+
+    return api_response(result, status_code)
 
 
 @main.route('/<string:index_name>', methods=['PUT'])
@@ -12,12 +78,18 @@ def create(index_name):
     if create_type == 'index':
         mapping_name = get_json_from_request('mapping')
         result, status_code = create_index(index_name, mapping_name)
+        search_response_cache.new_generation(index_name)
     elif create_type == 'alias':
         alias_target = get_json_from_request('target')
         result, status_code = create_alias(index_name, alias_target)
+        search_response_cache.new_generation(alias_target)
     else:
         abort(400, "Unrecognized 'type' value. Expected 'index' or 'alias'")
 
+    # whichever it was, anything we've cached under this name is no longer what it points to
+    mapping_cache.invalidate(index_name)
+    meta_response_cache.invalidate()
+
     return api_response(result, status_code)
 
 
@@ -38,6 +110,9 @@ def delete(index_name):
             ), 400)
 
     result, status_code = delete_index(index_name)
+    mapping_cache.invalidate(index_name)
+    meta_response_cache.invalidate()
+    search_response_cache.new_generation(index_name)
 
     return api_response(result, status_code)
 
@@ -1,9 +1,10 @@
-from flask import jsonify, url_for
-
-from dmutils.timing import logged_duration_for_external_request
+from flask import url_for
 
+from app.json_provider import json_provider
 from app.main import main
+from app.main.services.meta_response_cache import meta_response_cache
 from app import elasticsearch_client as es
+from app.prometheus_metrics import timed_elasticsearch_request
 
 import app.mapping
 
@@ -11,7 +12,11 @@ import app.mapping
 @main.route('/')
 def root():
     """Entry point for the API, show the resources that are available."""
-    with logged_duration_for_external_request('es'):
+    return meta_response_cache.response(("root",), _root)
+
+
+def _root():
+    with timed_elasticsearch_request('get_mapping'):
         es_indices = es.indices.get_mapping().items()
 
     def types_from_index(index: dict) -> list:
@@ -38,7 +43,7 @@ def root():
                                 doc_type=type_name,
                                 _external=True)})
 
-    with logged_duration_for_external_request('es'):
+    with timed_elasticsearch_request('cat_aliases'):
         es_alias_json = es.cat.aliases(format='json')
 
     aliases = {
@@ -54,7 +59,7 @@ def root():
                                 index_name=alias_name,
                                 doc_type=type_name,
                                 _external=True)})
-    return jsonify(
+    return json_provider.jsonify(
         {
             'links': links,
             'field-mappings': [name for name in app.mapping.get_mapping_file_paths_by_name().keys()],
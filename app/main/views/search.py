@@ -1,42 +1,90 @@
-from flask import jsonify, request
+from flask import Response, current_app, request, stream_with_context
 
+from app.json_provider import json_provider
 from app.main import main
-from app.main.services.response_formatters import api_response
+from app.main.services.response_formatters import api_response, conditional_response
 from app.main.services.search_service import search_with_keywords_and_filters, aggregations_with_keywords_and_filters, \
-    fetch_by_id
+    fetch_by_id, export, search_etag, fetch_etag, fetched_etag
 
 
 @main.route('/<string:index_name>/<string:doc_type>/search', methods=['GET'])
 def search(index_name, doc_type):
-    result, status_code = search_with_keywords_and_filters(index_name, doc_type, request.args)
+    aggregations = request.args.getlist('aggregations')
+    return conditional_response(
+        search_etag(index_name, doc_type, request.args, search=True, aggregations=aggregations),
+        current_app.config['DM_SEARCH_CACHE_CONTROL'],
+        lambda: _search(index_name, doc_type, aggregations),
+        fetched_etag,
+    )
+
+
+def _search(index_name, doc_type, aggregations):
+    result, status_code = search_with_keywords_and_filters(index_name, doc_type, request.args, aggregations)
 
     if status_code == 200:
-        return jsonify(meta=result['meta'],
-                       documents=result["documents"],
-                       links=result['links']), status_code
+        # aggregations are only included if some were asked for, saving the need for a separate aggregations request
+        return json_provider.jsonify(meta=result['meta'],
+                                     documents=result["documents"],
+                                     links=result['links'],
+                                     **({'aggregations': result['aggregations']} if 'aggregations' in result else {})
+                                     ), status_code
     else:
         return api_response(result, status_code)
 
 
 @main.route('/<string:index_name>/<string:doc_type>/aggregations', methods=['GET'])
 def aggregations(index_name, doc_type):
-    result, status_code = aggregations_with_keywords_and_filters(index_name, doc_type, request.args,
-                                                                 request.args.getlist('aggregations'))
+    aggregations = request.args.getlist('aggregations')
+    return conditional_response(
+        search_etag(index_name, doc_type, request.args, aggregations=aggregations),
+        current_app.config['DM_AGGREGATIONS_CACHE_CONTROL'],
+        lambda: _aggregations(index_name, doc_type, aggregations),
+        fetched_etag,
+    )
+
+
+def _aggregations(index_name, doc_type, aggregations):
+    result, status_code = aggregations_with_keywords_and_filters(index_name, doc_type, request.args, aggregations)
 
     if status_code == 200:
-        return jsonify(meta=result['meta'],
-                       aggregations=result['aggregations'],
-                       links=result['links']), status_code
+        return json_provider.jsonify(meta=result['meta'],
+                                     aggregations=result['aggregations'],
+                                     links=result['links']), status_code
     else:
         return api_response(result, status_code)
 
 
+@main.route('/<string:index_name>/<string:doc_type>/export', methods=['GET'])
+def export_documents(index_name, doc_type):
+    result, status_code = export(index_name, doc_type, request.args)
+
+    if status_code != 200:
+        return api_response(result, status_code)
+
+    response = Response(
+        stream_with_context(json_provider.dumps(document) + "\n" for document in result),
+        mimetype="application/x-ndjson",
+    )
+    # compressing the response would mean buffering all of it first
+    response.headers["X-Compression-Safe"] = "0"
+    return response
+
+
 @main.route('/<string:index_name>/<string:doc_type>/<string:service_id>',
             methods=['GET'])
 def fetch_service(index_name, doc_type, service_id):
+    return conditional_response(
+        fetch_etag(index_name, doc_type, service_id),
+        current_app.config['DM_FETCH_CACHE_CONTROL'],
+        lambda: _fetch_service(index_name, doc_type, service_id),
+        fetched_etag,
+    )
+
+
+def _fetch_service(index_name, doc_type, service_id):
     result, status_code = fetch_by_id(index_name, doc_type, service_id)
 
     if status_code == 200:
-        return jsonify(services=result), status_code
+        return json_provider.jsonify(services=result), status_code
     else:
         return api_response(result, status_code)
@@ -1,11 +1,23 @@
 from flask import request
 from werkzeug.exceptions import abort
 
+from app.json_provider import json_provider
 from app.main import main
 from app.mapping import get_mapping
-from app.main.services.process_request_json import convert_request_json_into_index_json, check_json_from_request
+from app.main.services.process_request_json import convert_request_json_into_index_json, check_json_from_request, \
+    get_bulk_operations_from_request
 from app.main.services.response_formatters import api_response
-from app.main.services.search_service import index, delete_by_id
+from app.main.services.search_response_cache import search_response_cache
+from app.main.services.search_service import index, delete_by_id, bulk
+from app.main.services.write_behind_queue import write_behind_queue
+
+
+def _queue(index_name, mapping, action, document_id, document=None):
+    if not write_behind_queue.put(index_name, mapping.index_name, action, document_id, document):
+        response, status_code = api_response("Too many writes are waiting to be made; try again later", 503)
+        return response, status_code, {"Retry-After": "1"}
+
+    return api_response("queued", 202)
 
 
 @main.route('/<string:index_name>/<string:doc_type>/<string:document_id>', methods=['PUT'])
@@ -17,7 +29,11 @@ def index_document(index_name, doc_type, document_id):
 
     mapping = get_mapping(index_name, doc_type)
     index_json = convert_request_json_into_index_json(mapping, json_payload)
+    if write_behind_queue.enabled:
+        return _queue(index_name, mapping, "index", document_id, index_json)
+
     result, status_code = index(index_name, doc_type, index_json, document_id)
+    search_response_cache.new_generation(mapping.index_name)
 
     return api_response(result, status_code)
 
@@ -25,8 +41,25 @@ def index_document(index_name, doc_type, document_id):
 @main.route('/<string:index_name>/<string:doc_type>/<string:service_id>', methods=['DELETE'])
 def delete_service(index_name, doc_type, service_id):
     # This checks that the index_name and doc_type exist or 400s
-    get_mapping(index_name, doc_type)
+    mapping = get_mapping(index_name, doc_type)
+    if write_behind_queue.enabled:
+        return _queue(index_name, mapping, "delete", service_id)
 
     result, status_code = delete_by_id(index_name, doc_type, service_id)
+    search_response_cache.new_generation(mapping.index_name)
 
     return api_response(result, status_code)
+
+
+@main.route('/<string:index_name>/<string:doc_type>/_bulk', methods=['POST'])
+def bulk_update(index_name, doc_type):
+    operations = get_bulk_operations_from_request(request)
+
+    mapping = get_mapping(index_name, doc_type)
+    result, status_code = bulk(index_name, doc_type, (
+        (action, document_id, document if document is None else convert_request_json_into_index_json(mapping, document))
+        for action, document_id, document in operations
+    ))
+    search_response_cache.new_generation(mapping.index_name)
+
+    return json_provider.jsonify(errors=result["errors"], results=result["items"]), status_code
@@ -3,17 +3,22 @@ from functools import reduce
 from itertools import groupby
 from operator import or_
 
-from flask import json
+from flask import current_app, json
 
-from elasticsearch.exceptions import NotFoundError
+from elasticsearch.exceptions import NotFoundError, TransportError
 from werkzeug.exceptions import BadRequest
 
-from dmutils.timing import logged_duration_for_external_request
 
 from app import elasticsearch_client as es
+from app.cache import LRUCache
+from app.prometheus_metrics import MAPPING_CACHE_LOOKUPS_TOTAL, index_found, timed_elasticsearch_request, timed_stage
 
 _mapping_files = None  # dict(name: filespec)
 
+# how many combinations of filters to keep compiled query plans for, per mapping - the filter names come from the
+# request so there could be any number of them, but only a few are in everyday use
+QUERY_PLAN_CACHE_SIZE = 256
+
 
 class MappingNotFound(BadRequest):
     pass
@@ -40,9 +45,11 @@ class Mapping(object):
             if maybe_name_seq  # maybe_name_seq would be an empty seq if no underscores were found, discard them
         )
 
-    def __init__(self, mapping_definition, mapping_type):
+    def __init__(self, mapping_definition, mapping_type, index_name=None):
         self.definition = mapping_definition
         self.mapping_type = mapping_type
+        # the concrete index this mapping was read from (i.e. with any alias resolved), if it came from Elasticsearch
+        self.index_name = index_name
 
         # build a dict of {prefix: frozenset(unprefixed_field_names)}
         self.fields_by_prefix = {
@@ -58,19 +65,113 @@ class Mapping(object):
             for name in reduce(or_, self.fields_by_prefix.values() or frozenset())
         }
 
+        # {prefixed field name: name in responses} for every field of the mapping `_convert_es_result` passes through -
+        # those whose un-prefixed name is a response field, whatever their own prefix
+        response_fields = self.fields_by_prefix.get(self.response_field_prefix, frozenset())
+        self.response_projection = {
+            "_".join((prefix, name)): name
+            for prefix, name in self._get_prefix_split_fields()
+            if prefix and name in response_fields
+        }
+
+        # the only `_source` fields a search response needs, as `_convert_es_result` discards everything else
+        self.response_source_includes = sorted(
+            "_".join((self.response_field_prefix, name))
+            for name in self.fields_by_prefix.get(self.response_field_prefix, ())
+        )
+
+        # the fields keyword searches are made against, in a consistent order so identical searches have identical
+        # bodies in every worker
+        self.text_search_fields = sorted(
+            "_".join((self.text_search_field_prefix, name))
+            for name in self.fields_by_prefix.get(self.text_search_field_prefix, ())
+        )
+
         self.transform_fields = tuple(
             self.definition['mappings'].get('_meta', {}).get('transformations', {})
         )
 
+        # `(transform_fields, transformation processors)`, compiled by
+        # `process_request_json.get_transformation_processors`
+        self.compiled_transformations = None
+
         self.sort_clause = self.definition['mappings'].get('_meta', {}).get('dm_sort_clause', ["_score"])
 
+        # the ingest pipeline the index was created with (see `process_request_json.compile_ingest_pipeline`), if any,
+        # and the fields of a document it uses - those which are mapped or which transformations read
+        self.ingest_pipeline = self.definition['mappings'].get('_meta', {}).get('dm_ingest_pipeline')
+        self.ingest_fields = frozenset(self.prefixes_by_field).union(
+            arguments['field'] for transformation in self.transform_fields for arguments in transformation.values()
+        )
+
+        # {field_name: terms aggregation size} for any aggregatable fields whose number of values is known in advance
+        self.aggregation_size_hints = self.definition['mappings'].get('_meta', {}).get('dm_aggregation_sizes', {})
+        # sizes for every aggregatable field, filled in by `get_aggregation_sizes`
+        self.aggregation_sizes = None
+
+        # `query_builder.QueryPlan`s for this mapping, by the names of the filter arguments they were compiled for
+        self.query_plans = LRUCache(QUERY_PLAN_CACHE_SIZE)
+
+
+class MappingCache(object):
+    """Per-worker cache of `Mapping`s, keyed by the index name (or alias) they were requested with.
+
+    Each cached `Mapping` knows the concrete index it was read from, so invalidating an index name also drops entries
+    for any alias which resolved to it. Entries are evicted by age and least-recent use according to the app's
+    ``DM_MAPPING_CACHE_TTL`` and ``DM_MAPPING_CACHE_MAX_SIZE`` config.
+    """
+
+    def init_app(self, app):
+        app.extensions["dm_mapping_cache"] = LRUCache(
+            max_size=app.config["DM_MAPPING_CACHE_MAX_SIZE"],
+            ttl=app.config["DM_MAPPING_CACHE_TTL"],
+        )
+
+    @property
+    def _cache(self):
+        return current_app.extensions["dm_mapping_cache"]
+
+    def get(self, index_name):
+        mapping = self._cache.get(index_name)
+        MAPPING_CACHE_LOOKUPS_TOTAL.labels("miss" if mapping is None else "hit").inc()
+        return mapping
+
+    def set(self, index_name, mapping):
+        self._cache.set(index_name, mapping)
+
+    def invalidate(self, index_name):
+        self._cache.delete_where(lambda key, mapping: index_name in (key, mapping.index_name))
+
+
+mapping_cache = MappingCache()
+
 
 def get_mapping(index_name, document_type):
+    with timed_stage("mapping_lookup"):
+        mapping = mapping_cache.get(index_name)
+        if mapping is None:
+            mapping = _get_mapping_from_es(index_name, document_type)
+            mapping_cache.set(index_name, mapping)
+        index_found()
+
+    # In ES 7 mapping types are being removed, so document types are no longer relevant.
+    # However our API still uses them in URLs and is expecting a 400 to be raised in case
+    # the wrong document type is specified.
+    if mapping.mapping_type != document_type:
+        raise MappingNotFound(
+            f"Document type '{document_type}' is not valid in index '{index_name}' - not returning mapping."
+        )
+
+    return mapping
+
+
+def _get_mapping_from_es(index_name, document_type):
     try:
         # es.indices.get_mapping has a key for the index name, regardless of any alias we may be going via, so rather
-        # than use index_name, we access the one and only value in the dictionary using next(iter).
-        with logged_duration_for_external_request('es'):
-            mapping_data = next(iter(es.indices.get_mapping(index=index_name).values()))
+        # than use index_name, we take the one and only item in the dictionary using next(iter), which also tells us
+        # which index the alias resolved to.
+        with timed_elasticsearch_request('get_mapping'):
+            resolved_index_name, mapping_data = next(iter(es.indices.get_mapping(index=index_name).items()))
     except NotFoundError as e:
         if e.error == "type_missing_exception":
             raise MappingNotFound("Document type '{}' is not valid in index '{}' - no mapping found.".format(
@@ -81,15 +182,68 @@ def get_mapping(index_name, document_type):
         raise MappingNotFound("Document type '{}' is not valid in index '{}' - no mapping found.".format(
             document_type, index_name))
 
-    # In ES 7 mapping types are being removed, so document types are no longer relevant.
-    # However our API still uses them in URLs and is expecting a 400 to be raised in case
-    # the wrong document type is specified.
-    if mapping_data["mappings"]["_meta"]["doc_type"] != document_type:
-        raise MappingNotFound(
-            f"Document type '{document_type}' is not valid in index '{index_name}' - not returning mapping."
+    return Mapping(
+        mapping_data,
+        mapping_type=mapping_data["mappings"]["_meta"]["doc_type"],
+        index_name=resolved_index_name,
+    )
+
+
+def get_aggregation_sizes(mapping):
+    """Returns a dict of {field_name: terms aggregation size} for every aggregatable field in ``mapping``'s index.
+
+    Sizes come from the mapping's ``dm_aggregation_sizes`` hint if it has one for a field, otherwise from a probe of the
+    number of distinct values the field has in the index, with room to spare for values added since. Either way they're
+    capped at ``DM_AGGREGATION_MAX_SIZE``. The probe is made once per `Mapping`, so it's repeated as often as the
+    mapping cache refetches it.
+    """
+    if mapping.aggregation_sizes is None:
+        max_size = int(current_app.config["DM_AGGREGATION_MAX_SIZE"])
+        field_names = mapping.fields_by_prefix.get(mapping.aggregatable_field_prefix) or frozenset()
+        cardinalities = _probe_cardinalities(mapping, field_names - mapping.aggregation_size_hints.keys())
+        if cardinalities is None:
+            # we'll try again next time rather than being stuck with maximum sizes until the mapping is refetched
+            return {
+                field_name: min(mapping.aggregation_size_hints.get(field_name, max_size), max_size)
+                for field_name in field_names
+            }
+
+        mapping.aggregation_sizes = {
+            field_name: min(
+                mapping.aggregation_size_hints[field_name] if field_name in mapping.aggregation_size_hints
+                else max(10, 2 * cardinalities[field_name]),
+                max_size,
+            )
+            for field_name in field_names
+        }
+
+    return mapping.aggregation_sizes
+
+
+def _probe_cardinalities(mapping, field_names):
+    if not field_names:
+        return {}
+    if mapping.index_name is None:
+        return None
+
+    try:
+        with timed_elasticsearch_request('search'):
+            response = es.search(index=mapping.index_name, body={
+                "size": 0,
+                "aggregations": {
+                    field_name: {"cardinality": {
+                        "field": "_".join((mapping.aggregatable_field_prefix, field_name))
+                    }}
+                    for field_name in field_names
+                },
+            })
+    except TransportError as e:
+        current_app.logger.warning(
+            "Failed to probe aggregatable field cardinalities of %s: %s", mapping.index_name, e
         )
+        return None
 
-    return Mapping(mapping_data, mapping_type=document_type)
+    return {field_name: response["aggregations"][field_name]["value"] for field_name in field_names}
 
 
 def load_mapping_definition(mapping_name):
@@ -0,0 +1,132 @@
+"""
+Application-specific Prometheus metrics, exported alongside the standard request metrics on the `/_metrics` endpoint.
+
+These are kept separate from `app.metrics` so that importing them doesn't instantiate `gds_metrics` (and fix its
+metrics path) as a side effect.
+"""
+from contextlib import contextmanager
+from time import perf_counter
+
+from dmutils.timing import logged_duration_for_external_request
+from flask import has_request_context, request
+from gds_metrics import Counter, Gauge, Histogram
+
+
+# the index label given to requests whose url names an index (or alias) that hasn't been found to exist, so that
+# misspelt and deleted index names don't each get time series of their own
+UNKNOWN_INDEX_LABEL = "other"
+
+# finer at the low end than the defaults, as most stages take no more than a few milliseconds
+DURATION_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, float("inf"))
+
+
+MAPPING_CACHE_LOOKUPS_TOTAL = Counter(
+    'search_api_mapping_cache_lookups_total',
+    'Total index mapping lookups, by whether they were served from the per-worker mapping cache',
+    ['result']
+)
+
+SEARCH_RESPONSE_CACHE_LOOKUPS_TOTAL = Counter(
+    'search_api_search_response_cache_lookups_total',
+    'Total search response cache lookups, by whether they were a hit, a miss, or bypassed the cache because the index '
+    'was recently written to',
+    ['result']
+)
+
+SEARCH_SINGLE_FLIGHT_REQUESTS_TOTAL = Counter(
+    'search_api_search_single_flight_requests_total',
+    'Total searches passed through single-flight coalescing, by whether they were sent to Elasticsearch ("leader"), '
+    'shared the response of an identical search already in flight ("coalesced"), or gave up waiting for it and were '
+    'sent anyway ("abandoned")',
+    ['result']
+)
+
+REQUEST_STAGE_DURATION_SECONDS = Histogram(
+    'search_api_request_stage_duration_seconds',
+    'Time spent in each stage of handling a request - "mapping_lookup", "query_construction", "result_conversion" or '
+    '"serialization" - by the index (or alias) in its url, or "other" if that wasn\'t found, and its endpoint',
+    ['stage', 'index', 'endpoint'],
+    buckets=DURATION_BUCKETS,
+)
+
+ELASTICSEARCH_REQUEST_DURATION_SECONDS = Histogram(
+    'search_api_elasticsearch_request_duration_seconds',
+    'Time spent waiting on Elasticsearch, by the operation asked of it, the index (or alias) in the url of the request '
+    'being handled, or "other" if that wasn\'t found, and its endpoint',
+    ['operation', 'index', 'endpoint'],
+    buckets=DURATION_BUCKETS,
+)
+
+ELASTICSEARCH_TOOK_SECONDS = Histogram(
+    'search_api_elasticsearch_took_seconds',
+    'Time Elasticsearch reports searches taking itself (their "took"), by the index (or alias) in the url of the '
+    'request being handled, or "other" if that wasn\'t found, and its endpoint',
+    ['index', 'endpoint'],
+    buckets=DURATION_BUCKETS,
+)
+
+WRITE_BEHIND_QUEUE_DEPTH = Gauge(
+    'search_api_write_behind_queue_depth',
+    'Index and delete operations acknowledged but not yet sent to Elasticsearch, across all workers',
+    multiprocess_mode='livesum',
+)
+
+WRITE_BEHIND_FLUSH_DURATION_SECONDS = Histogram(
+    'search_api_write_behind_flush_duration_seconds',
+    'Time taken to send each batch of queued index and delete operations to Elasticsearch, by index (or alias)',
+    ['index'],
+    buckets=DURATION_BUCKETS,
+)
+
+WRITE_BEHIND_OPERATIONS_TOTAL = Counter(
+    'search_api_write_behind_operations_total',
+    'Total index and delete operations handled by the write-behind queue, by whether they were "written", "failed", '
+    'were "retried" after failing, were "dead_lettered" after failing too many times, were "coalesced" with a later '
+    'operation on the same document, or were "rejected" because the queue was full',
+    ['result']
+)
+
+
+def index_found():
+    """Note that the index (or alias) in the url of the request being handled exists, so that its metrics are labelled
+    with it rather than with `UNKNOWN_INDEX_LABEL`"""
+    if has_request_context():
+        request.environ["dm.metrics_index_found"] = True
+
+
+def _request_labels():
+    """The index and endpoint labels for the request being handled, which are empty outside of one"""
+    if not has_request_context():
+        return "", ""
+    index_name = (request.view_args or {}).get("index_name", "")
+    if index_name and not request.environ.get("dm.metrics_index_found"):
+        index_name = UNKNOWN_INDEX_LABEL
+    return index_name, request.endpoint or ""
+
+
+@contextmanager
+def timed_stage(stage):
+    # labelled once the stage is over, by which point it may have found the index
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        REQUEST_STAGE_DURATION_SECONDS.labels(stage, *_request_labels()).observe(perf_counter() - start)
+
+
+@contextmanager
+def timed_elasticsearch_request(operation):
+    """Log the duration of a request to Elasticsearch, as `logged_duration_for_external_request` does, and record it
+    by ``operation`` - a request that succeeds shows that the index in the url exists"""
+    start = perf_counter()
+    try:
+        with logged_duration_for_external_request('es'):
+            yield
+        index_found()
+    finally:
+        ELASTICSEARCH_REQUEST_DURATION_SECONDS.labels(operation, *_request_labels()).observe(perf_counter() - start)
+
+
+def observe_elasticsearch_took(response):
+    if "took" in response:
+        ELASTICSEARCH_TOOK_SECONDS.labels(*_request_labels()).observe(response["took"] / 1000)
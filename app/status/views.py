@@ -1,10 +1,24 @@
 from flask import request
 
 from . import status
+from .. import elasticsearch_client as es
+from ..main.services.meta_response_cache import meta_response_cache
 from ..main.services.search_service import status_for_all_indexes
+from ..prometheus_metrics import timed_elasticsearch_request
 from dmutils.status import get_app_status, StatusError
 
 
+def ping_es():
+    with timed_elasticsearch_request('ping'):
+        # False, rather than an exception, if it can't be reached
+        reachable = es.ping()
+
+    if not reachable:
+        raise StatusError('Error connecting to elasticsearch')
+
+    return {}
+
+
 def get_es_status():
     result, status_code = status_for_all_indexes()
 
@@ -18,7 +32,18 @@ def get_es_status():
 
 @status.route('/_status')
 def status():
+    if 'ignore-dependencies' in request.args:
+        # polled constantly by load balancers, so only checks that elasticsearch can be reached, not every index's stats
+        return get_app_status(data_api_client=None,
+                              search_api_client=None,
+                              ignore_dependencies=True,
+                              additional_checks=[ping_es])
+
+    return meta_response_cache.response(("status",), _full_status)
+
+
+def _full_status():
     return get_app_status(data_api_client=None,
                           search_api_client=None,
-                          ignore_dependencies='ignore-dependencies' in request.args,
+                          ignore_dependencies=False,
                           additional_checks=[get_es_status])
@@ -0,0 +1,142 @@
+import json
+import pathlib
+import tracemalloc
+
+import pytest
+from elasticsearch import Elasticsearch
+
+import app.mapping
+from app import create_app
+from tests.elasticsearch_stand_in import ElasticsearchStandIn, StandInConnection
+
+
+mappings_dir = (pathlib.Path(__file__).parent / "../mappings").resolve()
+
+g_cloud_services_mappings = (
+    "services-g-cloud-10",
+    "services-g-cloud-11",
+    "services-g-cloud-12",
+)
+
+# {benchmark name: peak bytes allocated by one call}, reported at the end of the run
+_peak_allocations = {}
+# how much more a call can allocate than it did in the baseline before it's flagged as a regression
+ALLOCATION_REGRESSION_TOLERANCE = 0.1
+
+
+@pytest.fixture(scope="module", params=g_cloud_services_mappings)
+def g_cloud_services_mapping_definition(request):
+    return json.loads((mappings_dir / f"{request.param}.json").read_text())
+
+
+@pytest.fixture()
+def g_cloud_services_mapping(g_cloud_services_mapping_definition):
+    return app.mapping.Mapping(g_cloud_services_mapping_definition, "services")
+
+
+def _make_app(stand_in):
+    """An app whose Elasticsearch client is ``stand_in``, without leaving the process, and with the response cache off
+    so every request goes as far as the client"""
+    application = create_app('test')
+    application.config["DM_SEARCH_RESPONSE_CACHE_BACKEND"] = None
+    application.extensions["dm_search_response_cache"] = None
+    application.extensions["dm_elasticsearch"] = Elasticsearch(connection_class=StandInConnection, stand_in=stand_in)
+    return application
+
+
+def _make_client(application):
+    client = application.test_client()
+    client.environ_base["HTTP_AUTHORIZATION"] = "Bearer {}".format(application.config["DM_SEARCH_API_AUTH_TOKENS"])
+    return client
+
+
+def _service(i):
+    """One of the services the stand-in is loaded with: half are in each of the lots the benchmarks filter by, and all
+    match their keywords and other filters, so that every search the benchmarks make has a full second page"""
+    return {
+        "id": str(1234567890123456 + i),
+        "lot": "cloud-hosting" if i % 2 else "cloud-software",
+        "frameworkName": "G-Cloud 12",
+        "serviceName": f"Secure hosting {i}",
+        "serviceDescription": "Secure, scalable hosting for applications and data. " * 4,
+        "serviceBenefits": ["Access from anywhere", "Audited access", "Automatic backups"],
+        "serviceFeatures": ["Autoscaling", "Fine-grained permissions", "Single sign-on"],
+        "serviceCategories": ["compute", "storage", "Data storage"],
+        "supplierName": f"Example Supplier {i % 20} Ltd",
+        "publicSectorNetworksTypes": ["PSN", "PNN"],
+        "governmentSecurityClearances": "dv",
+        "phoneSupport": True,
+    }
+
+
+@pytest.fixture(scope="session")
+def stand_in():
+    """An in-memory `ElasticsearchStandIn` with a `g-cloud` alias of a G-Cloud 12 services index of 200 services, put
+    there through the API"""
+    stand_in = ElasticsearchStandIn()
+    client = _make_client(_make_app(stand_in))
+    for url, data in (
+        ("/g-cloud-12", {"type": "index", "mapping": "services-g-cloud-12"}),
+        ("/g-cloud", {"type": "alias", "target": "g-cloud-12"}),
+    ):
+        assert client.put(url, data=json.dumps(data), content_type="application/json").status_code == 200
+    response = client.post("/g-cloud/services/_bulk", data=json.dumps([
+        {"id": service["id"], "document": service} for service in (_service(i) for i in range(200))
+    ]), content_type="application/json")
+    assert not response.json["errors"]
+    return stand_in
+
+
+@pytest.fixture()
+def stand_in_app(stand_in):
+    return _make_app(stand_in)
+
+
+@pytest.fixture()
+def stand_in_client(stand_in_app):
+    return _make_client(stand_in_app)
+
+
+@pytest.fixture()
+def record_allocations(request, benchmark):
+    """Call with a function and its arguments to record the peak memory one call allocates alongside the benchmark's
+    timings (in its ``extra_info``, and so in any saved run) and in the summary at the end of the run"""
+    def record(fn, *args, **kwargs):
+        tracemalloc.start()
+        try:
+            fn(*args, **kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        benchmark.extra_info["peak_allocated_bytes"] = peak
+        _peak_allocations[request.node.name] = peak
+
+    return record
+
+
+def _baseline_peak_allocations(rootdir):
+    """The peak allocations recorded by the latest run saved with ``--benchmark-save=baseline``, if any"""
+    baselines = sorted((pathlib.Path(str(rootdir)) / ".benchmarks").glob("*/*_baseline.json"))
+    if not baselines:
+        return {}
+    return {
+        benchmark["name"]: benchmark["extra_info"].get("peak_allocated_bytes")
+        for benchmark in json.loads(baselines[-1].read_text())["benchmarks"]
+    }
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    if not _peak_allocations:
+        return
+    baseline = _baseline_peak_allocations(config.rootdir)
+
+    terminalreporter.section("peak bytes allocated per call")
+    width = max(len(name) for name in _peak_allocations)
+    for name, peak in sorted(_peak_allocations.items()):
+        line = f"{name:<{width}}  {peak:>12,}"
+        if baseline.get(name):
+            change = (peak - baseline[name]) / baseline[name]
+            line += f"  {change:+8.1%} vs baseline"
+            if change > ALLOCATION_REGRESSION_TOLERANCE:
+                line += "  REGRESSED"
+        terminalreporter.write_line(line)
@@ -0,0 +1,159 @@
+"""
+Benchmarks of each stage of handling search, aggregation, fetch and indexing requests, and of whole requests through
+the test client, with Elasticsearch replaced by the in-process `tests.elasticsearch_stand_in`. Since that takes very
+little time to search its couple of hundred documents, and none at all on the network, almost everything measured here
+is time spent in this app (or the Elasticsearch client library).
+
+Each benchmark also records the peak memory one call allocates. To flag regressions against a saved baseline:
+
+    make benchmark-baseline
+    ... make changes ...
+    make benchmark
+"""
+import copy
+import pathlib
+
+import pytest
+from flask import json, url_for
+from werkzeug.datastructures import MultiDict
+
+from app import elasticsearch_client as es
+from app.json_provider import json_provider
+from app.main.services.process_request_json import convert_request_json_into_index_json
+from app.main.services.query_builder import construct_query
+from app.main.services.response_formatters import convert_es_results, generate_pagination_links
+
+
+SEARCH_RESULTS = json.loads(
+    (pathlib.Path(__file__).parent / "../example_es_responses/search_results.json").read_text()
+)
+
+SEARCH_ARGS = MultiDict([
+    ("q", "secure hosting"),
+    ("filter_lot", "cloud-hosting"),
+    ("filter_serviceCategories", "compute,storage"),
+    ("filter_phoneSupport", "true"),
+    ("page", "2"),
+])
+
+SERVICE = {
+    "id": "1234567890123456",
+    "lot": "cloud-software",
+    "frameworkName": "G-Cloud 12",
+    "serviceName": "Secure document management",
+    "serviceDescription": "A cloud service for creating, sharing and storing documents securely. " * 4,
+    "serviceBenefits": ["Access from anywhere", "Audited sharing", "Automatic backups"],
+    "serviceFeatures": ["Version history", "Fine-grained permissions", "Single sign-on"],
+    "serviceCategories": ["Document management", "Collaborative working", "Data storage"],
+    "supplierName": "Example Supplier Ltd",
+    "publicSectorNetworksTypes": ["PSN", "PNN"],
+    "governmentSecurityClearances": "dv",
+    "phoneSupport": True,
+}
+
+URL = "/g-cloud/services"
+
+
+def _search_url(query_args):
+    return f"{URL}/search?" + "&".join(f"{key}={value}" for key, value in query_args.items(multi=True))
+
+
+class TestSearchStages(object):
+    def test_construct_query(self, benchmark, record_allocations, g_cloud_services_mapping):
+        benchmark.group = "search stages"
+        args = (g_cloud_services_mapping, SEARCH_ARGS, [], 30)
+        construct_query(*args)
+
+        benchmark(construct_query, *args)
+        record_allocations(construct_query, *args)
+
+    def test_elasticsearch_client(self, benchmark, record_allocations, g_cloud_services_mapping, stand_in_app):
+        """Serializing the query and deserializing the response, with next to no time spent searching"""
+        benchmark.group = "search stages"
+        body = construct_query(g_cloud_services_mapping, SEARCH_ARGS, [], 30)
+
+        with stand_in_app.app_context():
+            benchmark(es.search, index="g-cloud", body=body, track_total_hits=True)
+            record_allocations(es.search, index="g-cloud", body=body, track_total_hits=True)
+
+    @pytest.mark.parametrize("query_args", (
+        pytest.param(SEARCH_ARGS, id="documents"),
+        pytest.param(MultiDict(list(SEARCH_ARGS.items(multi=True)) + [("idOnly", "True")]), id="id-only"),
+    ))
+    def test_convert_es_results(
+        self, benchmark, record_allocations, g_cloud_services_mapping, stand_in_app, query_args,
+    ):
+        """Formatting the recorded `example_es_responses/search_results.json`"""
+        benchmark.group = "search stages"
+
+        with stand_in_app.app_context():
+            benchmark(convert_es_results, g_cloud_services_mapping, SEARCH_RESULTS, query_args)
+            record_allocations(convert_es_results, g_cloud_services_mapping, SEARCH_RESULTS, query_args)
+
+    def test_generate_pagination_links(self, benchmark, record_allocations, stand_in_app):
+        benchmark.group = "search stages"
+
+        def url_for_search(**kwargs):
+            return url_for('main.search', index_name="g-cloud", doc_type="services", _external=True, **kwargs)
+
+        with stand_in_app.test_request_context():
+            benchmark(generate_pagination_links, SEARCH_ARGS, 1000, 30, url_for_search)
+            record_allocations(generate_pagination_links, SEARCH_ARGS, 1000, 30, url_for_search)
+
+    @pytest.mark.parametrize("config", (
+        pytest.param({}, id="flask"),
+        pytest.param({"DEBUG": False, "JSON_SORT_KEYS": False, "JSON_AS_ASCII": False}, id="orjson"),
+    ))
+    def test_jsonify(self, benchmark, record_allocations, g_cloud_services_mapping, stand_in_app, config):
+        """Serializing a page of results as the search view does, with the test config and then the live config"""
+        benchmark.group = "search stages"
+        stand_in_app.config.update(config)
+
+        with stand_in_app.app_context():
+            documents = convert_es_results(g_cloud_services_mapping, SEARCH_RESULTS, SEARCH_ARGS)["documents"]
+            benchmark(json_provider.jsonify, documents=documents)
+            record_allocations(json_provider.jsonify, documents=documents)
+
+
+class TestIndexStages(object):
+    def test_convert_request_json_into_index_json(self, benchmark, record_allocations, g_cloud_services_mapping):
+        benchmark.group = "index stages"
+
+        # transformations modify the document they're given, so each round needs its own
+        benchmark.pedantic(
+            convert_request_json_into_index_json,
+            setup=lambda: ((g_cloud_services_mapping, copy.deepcopy(SERVICE)), {}),
+            rounds=2000,
+        )
+        record_allocations(convert_request_json_into_index_json, g_cloud_services_mapping, copy.deepcopy(SERVICE))
+
+
+class TestViews(object):
+    @pytest.mark.parametrize("url", (
+        pytest.param(_search_url(SEARCH_ARGS), id="search"),
+        pytest.param(_search_url(MultiDict([("filter_lot", "cloud-software")])), id="search-landing-page"),
+        pytest.param(
+            _search_url(MultiDict([("filter_lot", "cloud-software"), ("aggregations", "serviceCategories")])),
+            id="search-with-aggregations",
+        ),
+        pytest.param(
+            f"{URL}/aggregations?filter_lot=cloud-software&aggregations=lot&aggregations=serviceCategories",
+            id="aggregations",
+        ),
+        pytest.param(f"{URL}/1234567890123456", id="fetch"),
+    ))
+    def test_get(self, benchmark, record_allocations, stand_in_client, url):
+        benchmark.group = "views"
+        # the first request fetches (and caches) the mapping
+        assert stand_in_client.get(url).status_code == 200
+
+        benchmark(stand_in_client.get, url)
+        record_allocations(stand_in_client.get, url)
+
+    def test_index_document(self, benchmark, record_allocations, stand_in_client):
+        benchmark.group = "views"
+        url, data = f"{URL}/1234567890123456", json.dumps({"document": SERVICE})
+        assert stand_in_client.put(url, data=data, content_type="application/json").status_code == 200
+
+        benchmark(stand_in_client.put, url, data=data, content_type="application/json")
+        record_allocations(stand_in_client.put, url, data=data, content_type="application/json")
@@ -0,0 +1,77 @@
+"""
+Benchmarks of `construct_query` for the sorts of searches buyers make, with each mapping's query plans already compiled
+(as for every request after the first few), with them compiled afresh for every query, and - as the baseline - the query
+builder from before there were query plans at all (see `benchmarks.baseline_query_builder`).
+
+    make benchmark PYTEST_ARGS="-k query_builder"
+"""
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from app.main.services.query_builder import construct_query
+from benchmarks import baseline_query_builder
+
+
+QUERIES = {
+    "landing-page": (MultiDict([("filter_lot", "cloud-software")]), ()),
+    "keywords": (MultiDict([("q", "email marketing"), ("page", "2")]), ()),
+    "keywords-and-filters": (
+        MultiDict([
+            ("q", "secure hosting"),
+            ("filter_lot", "cloud-hosting"),
+            ("filter_serviceCategories", "compute,storage"),
+            ("filter_governmentSecurityClearances", "dv"),
+            ("filter_datacentreSecurityStandards", "recognised"),
+            ("filter_phoneSupport", "true"),
+            ("filter_standardsISOIEC27001", "true"),
+        ]),
+        (),
+    ),
+    "disjunctive-aggregations": (
+        MultiDict([
+            ("q", "crm"),
+            ("filter_lot", "cloud-software"),
+            ("filter_serviceCategories", "customer relationship management (crm)"),
+            ("disjunctiveAggregations", ""),
+        ]),
+        ("lot", "serviceCategories"),
+    ),
+}
+
+# the baseline builder has no disjunctive aggregations, nor can it return documents alongside aggregations, so it would
+# build a different (and cheaper) query for that one
+BASELINE_QUERIES = [name for name in QUERIES if name != "disjunctive-aggregations"]
+
+
+def _construct(mapping, query_args, aggregations):
+    return construct_query(mapping, query_args, aggregations, page_size=30, with_documents=True)
+
+
+@pytest.mark.parametrize("query_name", QUERIES)
+def test_construct_query_with_compiled_plans(benchmark, g_cloud_services_mapping, query_name):
+    benchmark.group = f"construct_query: {query_name}"
+    query_args, aggregations = QUERIES[query_name]
+    _construct(g_cloud_services_mapping, query_args, aggregations)
+
+    benchmark(_construct, g_cloud_services_mapping, query_args, aggregations)
+
+
+@pytest.mark.parametrize("query_name", QUERIES)
+def test_construct_query_compiling_plans_every_time(benchmark, g_cloud_services_mapping, query_name):
+    benchmark.group = f"construct_query: {query_name}"
+    query_args, aggregations = QUERIES[query_name]
+
+    benchmark.pedantic(
+        _construct,
+        args=(g_cloud_services_mapping, query_args, aggregations),
+        setup=g_cloud_services_mapping.query_plans.clear,
+        rounds=2000,
+    )
+
+
+@pytest.mark.parametrize("query_name", BASELINE_QUERIES)
+def test_construct_query_with_the_baseline_builder(benchmark, g_cloud_services_mapping, query_name):
+    benchmark.group = f"construct_query: {query_name}"
+    query_args, aggregations = QUERIES[query_name]
+
+    benchmark(baseline_query_builder.construct_query, g_cloud_services_mapping, query_args, aggregations, page_size=30)
@@ -12,11 +12,114 @@ class Config:
     AUTH_REQUIRED = True
 
     ELASTICSEARCH_HOST = 'localhost:9200'
+    # connections to elasticsearch each worker process keeps open - this should be at least the number of requests a
+    # worker handles at once, which with gevent workers can be in the hundreds
+    DM_ELASTICSEARCH_MAXSIZE = 10
 
     DM_SEARCH_API_AUTH_TOKENS = None
 
     DM_SEARCH_PAGE_SIZE = 30
     DM_ID_ONLY_SEARCH_PAGE_SIZE_MULTIPLIER = 10
+    # whether cursor-paginated searches should read from an Elasticsearch point in time (so that every page is from a
+    # consistent view of the index), and how long one should be kept open after each page is fetched
+    DM_SEARCH_CURSOR_USE_PIT = False
+    DM_SEARCH_CURSOR_PIT_KEEP_ALIVE = "1m"
+
+    # exports read all matching documents through a scroll this many at a time
+    DM_EXPORT_PAGE_SIZE = 1000
+    DM_EXPORT_SCROLL_KEEP_ALIVE = "1m"
+
+    # the most buckets a terms aggregation will ask for - fields with more values are fetched with composite
+    # aggregations, this many buckets at a time
+    DM_AGGREGATION_MAX_SIZE = 1000
+    DM_AGGREGATION_COMPOSITE_PAGE_SIZE = 1000
+
+    # limits on the size of each `_bulk` request made to elasticsearch when handling a bulk update
+    DM_BULK_INDEX_CHUNK_SIZE = 500  # documents
+    DM_BULK_INDEX_MAX_CHUNK_BYTES = 10 * 1024 * 1024
+
+    # per-worker cache of index mappings - a max size of 0 disables it
+    DM_MAPPING_CACHE_MAX_SIZE = 32
+    DM_MAPPING_CACHE_TTL = 60  # seconds
+
+    # cache of search and aggregation responses - "memory" for a per-worker cache, "redis" to share one between workers
+    # or None to disable it. In memory, only the worker handling a write stops serving
+    # responses from before it, and other workers' responses may be up to the TTL out of date
+    DM_SEARCH_RESPONSE_CACHE_BACKEND = "memory"
+    DM_SEARCH_RESPONSE_CACHE_MAX_SIZE = 1024  # responses, per worker, when in memory
+    DM_SEARCH_RESPONSE_CACHE_TTL = 30  # seconds
+    DM_SEARCH_RESPONSE_CACHE_REDIS_URL = None
+    # how long after a write to wait before caching responses, to give Elasticsearch time to refresh the index
+    DM_SEARCH_RESPONSE_CACHE_SETTLE_TIME = 2  # seconds
+
+    # the Cache-Control header of successful search, aggregations and fetch responses. with the "redis" response cache
+    # backend they each have an ETag which holds until the index is next written to through this app, so caches can
+    # cheaply revalidate them - but since requests are authorized, shared caches need "public" (e.g. "public,
+    # max-age=60") to store them at all
+    DM_SEARCH_CACHE_CONTROL = "no-cache"
+    DM_AGGREGATIONS_CACHE_CONTROL = "no-cache"
+    DM_FETCH_CACHE_CONTROL = "no-cache"
+
+    # identical searches made while one is already in flight wait for and share its response - "memory" to coalesce
+    # those made within a worker, "redis" for those made by any worker or None not to
+    DM_SEARCH_SINGLE_FLIGHT_BACKEND = "memory"
+    DM_SEARCH_SINGLE_FLIGHT_REDIS_URL = None
+    # how long to wait for another request's search before making our own
+    DM_SEARCH_SINGLE_FLIGHT_TIMEOUT = 10  # seconds
+
+    # serialize responses and parse request bodies with orjson, if it's installed - though responses are only
+    # serialized with it when key-sorting, ASCII-escaping and pretty-printing are all off
+    DM_FAST_JSON = True
+    JSONIFY_PRETTYPRINT_REGULAR = False
+
+    # the API root and full `_status` responses are rebuilt in the background once they're this old, so at most one
+    # request per worker this often asks elasticsearch about every index, and aren't served at all once MAX_STALE old
+    DM_META_RESPONSE_CACHE_TTL = 10  # seconds
+    DM_META_RESPONSE_CACHE_MAX_STALE = 60  # seconds
+
+    # searches and aggregations taking at least this long are logged (None not to), and each worker keeps statistics
+    # on how long each "fingerprint" (shape of query) takes for the most recently seen MAX_FINGERPRINTS, with
+    # percentiles from the last SAMPLES durations of each, served by `/_slow-queries`
+    DM_SLOW_QUERY_LOG_THRESHOLD = 1.0  # seconds
+    DM_SLOW_QUERY_LOG_MAX_FINGERPRINTS = 500
+    DM_SLOW_QUERY_LOG_SAMPLES = 100
+    DM_SLOW_QUERY_LOG_TOP_N = 20
+
+    # register an Elasticsearch ingest pipeline compiled from the mapping's transformations and prefixes with each index
+    # created, and leave documents indexed into it to be transformed by that, so indexes can be rebuilt server-side with
+    # `_reindex`. Needs Elasticsearch nodes with the ingest role and Painless scripting
+    DM_INGEST_PIPELINES = False
+
+    # force-merging an index (when leaving bulk load mode, or finishing a reindex) merges it down to this many
+    # segments, waiting up to TIMEOUT seconds for Elasticsearch to do so
+    DM_FORCE_MERGE_MAX_NUM_SEGMENTS = 1
+    DM_FORCE_MERGE_TIMEOUT = 3600  # seconds
+
+    # `POST /<alias>/_reindex` copies documents with this many slices (parallel scrolls) of Elasticsearch's `_reindex`,
+    # throttled to this many documents a second (-1 for no limit), and the job's thread checks on the copy every
+    # POLL_INTERVAL seconds, cancelling it and failing the job if it's not done after TIMEOUT seconds. a job which has
+    # gone ABANDONED_AFTER seconds longer than its step could take without moving on (because the worker seeing it
+    # through has stopped) is reported as abandoned, and can be resumed with `POST /<new index>/_reindex/resume`
+    DM_REINDEX_SLICES = "auto"
+    DM_REINDEX_REQUESTS_PER_SECOND = 5000
+    DM_REINDEX_POLL_INTERVAL = 5  # seconds
+    DM_REINDEX_TIMEOUT = 86400  # seconds
+    DM_REINDEX_ABANDONED_AFTER = 60  # seconds
+
+    # acknowledge single-document index and delete requests with a 202 once they're validated and transformed, and
+    # send them to Elasticsearch from a background thread in `_bulk` batches of up to BATCH_SIZE, at least every
+    # FLUSH_INTERVAL seconds. Requests wait up to ENQUEUE_TIMEOUT seconds when MAX_QUEUE_SIZE operations are already
+    # waiting, then get a 503. With a SPOOL_DIR, queued operations are also written there so they survive the worker
+    # dying. Operations which still fail (with a 429, a 5xx or no response) after MAX_ATTEMPTS tries are given up on,
+    # and with a SPOOL_DIR written to a "write-behind-<pid>.ndjson.dead" file there, which is never replayed
+    DM_WRITE_BEHIND = False
+    DM_WRITE_BEHIND_MAX_QUEUE_SIZE = 10000
+    DM_WRITE_BEHIND_BATCH_SIZE = 500
+    DM_WRITE_BEHIND_FLUSH_INTERVAL = 1  # seconds
+    DM_WRITE_BEHIND_ENQUEUE_TIMEOUT = 1  # seconds
+    DM_WRITE_BEHIND_MAX_ATTEMPTS = 60
+    DM_WRITE_BEHIND_SPOOL_DIR = None
+
     # Logging
     DM_LOG_LEVEL = 'DEBUG'
     DM_APP_NAME = 'search-api'
@@ -48,6 +151,8 @@ class Development(Config):
 
 class Live(Config):
     DEBUG = False
+    JSON_SORT_KEYS = False
+    JSON_AS_ASCII = False
 
     DM_LOG_PATH = '/var/log/digitalmarketplace/application.log'
 
@@ -1,6 +1,14 @@
+import copy
+import json
 
+import pytest
+
+from app import elasticsearch_client
+from app.mapping import Mapping
 from app.main.services.process_request_json import \
-    convert_request_json_into_index_json
+    compile_ingest_pipeline, convert_request_json_into_index_json
+from tests.conftest import mappings_dir
+from tests.helpers import BaseApplicationTest, make_service
 
 
 def test_should_add_filter_fields_to_index_json(services_mapping):
@@ -140,6 +148,23 @@ def test_duplicative_transformations_do_duplicate_values(services_mapping):
     ]
 
 
+def test_appended_values_can_satisfy_later_transformations(services_mapping):
+    services_mapping.transform_fields = [
+        {"append_conditionally": {"field": "serviceCategories", "any_of": ["Crops"], "append_value": ["Agriculture"]}},
+        {"append_conditionally": {"field": "serviceCategories", "any_of": ["Agriculture"], "append_value": ["Food"]}},
+        {"append_conditionally": {"field": "serviceCategories", "any_of": ["Food"], "append_value": ["Crops"]}},
+    ]
+
+    request = {
+        "serviceCategories": "Crops",
+    }
+
+    result = convert_request_json_into_index_json(services_mapping, request)
+
+    # but the first transformation has already been applied by the time "Crops" is appended again
+    assert result["dmtext_serviceCategories"] == ["Crops", "Agriculture", "Food", "Crops"]
+
+
 def test_missing_field_in_transformation(services_mapping):
     services_mapping.transform_fields = [
         {
@@ -324,6 +349,23 @@ class TestSetConditionally():
             "dmtext_supplierName": ["Silver"],
         }
 
+    def test_last_matching_transformation_wins(self, services_mapping):
+        services_mapping.transform_fields = [
+            {"set_conditionally": {"field": "lot", "target_field": "serviceCategories", "any_of": ["SaaS", "PaaS"],
+                                   "set_value": ["Software"]}},
+            {"set_conditionally": {"field": "lot", "target_field": "serviceCategories", "any_of": ["SaaS"],
+                                   "set_value": ["Software as a service"]}},
+            {"set_conditionally": {"field": "lot", "target_field": "serviceCategories", "any_of": ["IaaS"],
+                                   "set_value": ["Infrastructure"]}},
+        ]
+
+        assert convert_request_json_into_index_json(services_mapping, {"lot": "SaaS"})["dmtext_serviceCategories"] == [
+            "Software as a service",
+        ]
+        assert convert_request_json_into_index_json(services_mapping, {"lot": "PaaS"})["dmtext_serviceCategories"] == [
+            "Software",
+        ]
+
     def test_works_if_source_field_is_a_string(self, services_mapping):
         services_mapping.transform_fields = [
             {
@@ -361,3 +403,129 @@ def test_service_id_hash_added_if_id_present(services_mapping):
         "dmtext_id": "999999999",
         "sortonly_serviceIdHash": "bb421fa35db885ce507b0ef5c3f23cb09c62eb378fae3641c165bdf4c0272949",
     }
+
+
+class TestIngestPipeline():
+    def test_pipeline_unprefixes_then_transforms_then_prefixes(self, services_mapping):
+        pipeline = compile_ingest_pipeline(services_mapping)
+        tags = [processor["script"]["tag"] for processor in pipeline["processors"]]
+
+        assert tags == ["unprefix"] + [
+            next(iter(transformation)) for transformation in services_mapping.transform_fields
+        ] + ["fan_out"]
+        assert pipeline["processors"][0]["script"]["params"] == {"prefixes": sorted(services_mapping.fields_by_prefix)}
+        assert pipeline["processors"][-1]["script"]["params"]["prefixes_by_field"]["lot"] == [
+            "dmagg", "dmfilter", "dmtext",
+        ]
+
+    def test_transformation_arguments_are_script_params(self, services_mapping):
+        services_mapping.transform_fields = (
+            {"hash_to": {"field": "id", "target_field": "serviceIdHash"}},
+            {"set_conditionally": {"field": "status", "any_of": ["awarded"], "set_value": "closed"}},
+            {"append_conditionally": {"field": "a", "target_field": "b", "any_of": ["x"], "append_value": ["y"]}},
+        )
+
+        pipeline = compile_ingest_pipeline(services_mapping)
+        params = [processor["script"]["params"] for processor in pipeline["processors"]]
+
+        assert params[1:4] == [
+            {"field": "id", "target_field": "serviceIdHash"},
+            {
+                "field": "status", "target_field": "status", "any_of": ["awarded"], "set_value": "closed",
+                "append": False,
+            },
+            {"field": "a", "target_field": "b", "any_of": ["x"], "append_value": ["y"], "append": True},
+        ]
+
+    def test_documents_are_left_to_the_pipeline_to_transform(self, services_mapping):
+        services_mapping.ingest_pipeline = "test-index-pipeline"
+        request = {
+            "id": "999999999",
+            "lot": "SaaS",
+            "notInTheMapping": "ignored",
+        }
+
+        assert convert_request_json_into_index_json(services_mapping, request) == {
+            "id": "999999999",
+            "lot": "SaaS",
+        }
+
+    @pytest.mark.parametrize("service_id", (999999999, True, ["999999999"]))
+    def test_values_the_pipeline_would_hash_differently_are_hashed_first(self, services_mapping, service_id):
+        expected_hash = convert_request_json_into_index_json(services_mapping, {"id": service_id})[
+            "sortonly_serviceIdHash"
+        ]
+        services_mapping.ingest_pipeline = "test-index-pipeline"
+
+        assert convert_request_json_into_index_json(services_mapping, {"id": service_id}) == {
+            "id": service_id,
+            "serviceIdHash": expected_hash,
+        }
+
+    def test_values_hashed_in_place_are_sent_as_strings(self, services_mapping):
+        services_mapping.ingest_pipeline = "test-index-pipeline"
+        services_mapping.transform_fields = ({"hash_to": {"field": "id"}},)
+
+        assert convert_request_json_into_index_json(services_mapping, {"id": True}) == {"id": "True"}
+        assert convert_request_json_into_index_json(services_mapping, {"id": "abc"}) == {"id": "abc"}
+
+
+def _pipeline_fixtures(mapping):
+    """Documents exercising every rule of ``mapping``'s transformations, each value on its own and all of a field's
+    values together, besides ids of each JSON type"""
+    base = dict(make_service()["document"]) if mapping.mapping_type == "services" else {"id": "1", "title": "Brief"}
+    documents = [base, dict(base, id=999999999), dict(base, id=True), dict(base, id=["1", "2"])]
+    values_by_field = {}
+    for transformation in mapping.transform_fields:
+        for arguments in transformation.values():
+            for value in arguments.get('any_of', ()):
+                values_by_field.setdefault(arguments['field'], []).append(value)
+                documents.append(dict(base, **{arguments['field']: value}))
+                documents.append(dict(base, **{arguments['field']: [value, "not-a-rule-value"]}))
+    for field, values in values_by_field.items():
+        documents.append(dict(base, **{field: values}))
+    return documents
+
+
+def _without_repeats(value):
+    """``value`` with any repeated list items removed, as the pipeline doesn't append values already present"""
+    if isinstance(value, dict):
+        return {key: _without_repeats(item) for key, item in value.items()}
+    if isinstance(value, list):
+        unique = []
+        for item in value:
+            if item not in unique:
+                unique.append(item)
+        return unique
+    return value
+
+
+class TestIngestPipelineAgainstElasticsearch(BaseApplicationTest):
+    """Runs each mapping's ingest pipeline through Elasticsearch's simulate API, to check its Painless scripts compile
+    and transform documents just as `convert_request_json_into_index_json` does"""
+
+    @pytest.mark.parametrize("mapping_path", sorted(mappings_dir.glob("*.json")), ids=lambda path: path.stem)
+    def test_pipeline_transforms_documents_as_the_app_does(self, mapping_path):
+        definition = json.loads(mapping_path.read_text())
+        mapping = Mapping(definition, definition["mappings"]["_meta"]["doc_type"])
+        pipelined_mapping = Mapping(definition, mapping.mapping_type)
+        pipelined_mapping.ingest_pipeline = "test-pipeline"
+        documents = _pipeline_fixtures(mapping)
+
+        with self.app.app_context():
+            if elasticsearch_client.info()["name"] == "elasticsearch-stand-in":
+                pytest.skip("needs a real Elasticsearch - the stand-in can't run Painless scripts")
+            response = elasticsearch_client.ingest.simulate(body={
+                "pipeline": compile_ingest_pipeline(mapping),
+                "docs": [
+                    {"_source": convert_request_json_into_index_json(pipelined_mapping, copy.deepcopy(document))}
+                    for document in documents
+                ],
+            })
+
+        assert len(response["docs"]) == len(documents)
+        for document, result in zip(documents, response["docs"]):
+            assert "error" not in result, (document, result)
+            assert _without_repeats(result["doc"]["_source"]) == _without_repeats(
+                convert_request_json_into_index_json(mapping, copy.deepcopy(document))
+            ), document
@@ -1,10 +1,14 @@
 import pytest
-from app.main.services.query_builder import construct_query, is_filtered
+from app.main.services.query_builder import construct_query, is_filtered, encode_cursor, decode_cursor, \
+    construct_composite_aggregation_query
 from app.main.services.query_builder import (
+    build_keywords_query,
     field_is_or_filter,
     field_filters,
     filter_clause,
+    query_plan,
 )
+from app.mapping import Mapping
 from werkzeug.datastructures import MultiDict
 from tests.helpers import build_query_params
 
@@ -54,6 +58,82 @@ def test_aggregations_terms_added_for_each_param(services_mapping, aggregations)
     }
 
 
+def test_aggregations_can_be_requested_with_documents(services_mapping):
+    query = construct_query(
+        services_mapping, build_query_params(keywords="some keywords"), ['lot'], with_documents=True
+    )
+
+    assert query['size'] == 100
+    assert 'lot' in query['aggregations']
+    assert 'highlight' in query
+    assert query['sort'] == services_mapping.sort_clause
+
+
+def test_disjunctive_aggregations_move_filters_to_post_filter(services_mapping):
+    query_params = build_query_params(
+        keywords="some keywords", filters={"lot": "cloud-software", "serviceCategories": ["a", "b"]}
+    )
+    query_params.add("disjunctiveAggregations", "")
+    query = construct_query(services_mapping, query_params, ['lot', 'serviceCategories'], with_documents=True)
+
+    assert query['query'] == build_keywords_query(services_mapping, query_params)
+    assert query['post_filter'] == filter_clause(services_mapping, query_params)
+    assert query['aggregations']['lot'] == {
+        "filter": {"bool": {"must": [
+            {"term": {"dmfilter_serviceCategories": "a"}},
+            {"term": {"dmfilter_serviceCategories": "b"}},
+        ]}},
+        "aggregations": {"lot": {"terms": {"field": "dmagg_lot", "size": 999999}}},
+    }
+    assert query['aggregations']['serviceCategories']['filter'] == {"bool": {"must": [
+        {"term": {"dmfilter_lot": "cloud-software"}},
+    ]}}
+
+
+def test_disjunctive_aggregations_without_filters_are_plain_aggregations(services_mapping):
+    query_params = build_query_params(keywords="some keywords")
+    query_params.add("disjunctiveAggregations", "")
+    query = construct_query(services_mapping, query_params, ['lot'])
+
+    assert 'post_filter' not in query
+    assert query['aggregations']['lot'] == {"terms": {"field": "dmagg_lot", "size": 999999}}
+
+
+def test_aggregation_sizes_are_used(services_mapping):
+    query_params = build_query_params(filters={"lot": "cloud-software"})
+    query = construct_query(services_mapping, query_params, ['lot'], aggregation_sizes={"lot": 12})
+    assert query['aggregations']['lot']['terms']['size'] == 12
+
+    query_params.add("disjunctiveAggregations", "")
+    query = construct_query(services_mapping, query_params, ['lot'], aggregation_sizes={"lot": 12})
+    assert query['aggregations']['lot']['aggregations']['lot']['terms']['size'] == 12
+
+
+def test_composite_aggregation_query(services_mapping):
+    query_params = build_query_params(keywords="some keywords", filters={"lot": "cloud-software"})
+    query = construct_composite_aggregation_query(services_mapping, query_params, 'lot', 100)
+
+    assert query['size'] == 0
+    assert query['query'] == construct_query(services_mapping, query_params, page_size=None)['query']
+    assert query['aggregations'] == {"lot": {"composite": {
+        "size": 100,
+        "sources": [{"lot": {"terms": {"field": "dmagg_lot"}}}],
+    }}}
+
+    query = construct_composite_aggregation_query(services_mapping, query_params, 'lot', 100, after={"lot": "x"})
+    assert query['aggregations']['lot']['composite']['after'] == {"lot": "x"}
+
+
+def test_disjunctive_composite_aggregation_query_excludes_own_filter(services_mapping):
+    query_params = build_query_params(
+        keywords="some keywords", filters={"lot": "cloud-software", "serviceCategories": "a"}
+    )
+    query_params.add("disjunctiveAggregations", "")
+    query = construct_composite_aggregation_query(services_mapping, query_params, 'lot', 100)
+
+    assert query['query']['bool']['filter'] == {"bool": {"must": [{"term": {"dmfilter_serviceCategories": "a"}}]}}
+
+
 def test_aggregation_throws_error_if_not_implemented(services_mapping):
     with pytest.raises(ValueError):
         construct_query(services_mapping, build_query_params(), aggregations=['missing'])
@@ -212,6 +292,58 @@ def test_sort_results_by_score_and_service_id_hash(services_mapping):
     assert query['sort'] == ['_score', {"sortonly_serviceIdHash": 'desc'}]
 
 
+def test_source_is_limited_to_response_fields(services_mapping):
+    query = construct_query(services_mapping, build_query_params(keywords="some keywords"))
+
+    assert query['_source'] == sorted(
+        "dmtext_" + name for name in services_mapping.fields_by_prefix["dmtext"]
+    )
+    assert "dmtext_serviceName" in query['_source']
+    assert not any(field.startswith(("dmfilter_", "dmagg_", "sortonly_")) for field in query['_source'])
+
+
+def test_id_only_search_requests_no_source(services_mapping):
+    query_params = build_query_params(keywords="some keywords")
+    query_params.add("idOnly", "true")
+    query = construct_query(services_mapping, query_params)
+
+    assert query['_source'] is False
+
+
+def test_first_cursor_page_is_sorted_without_search_after(services_mapping):
+    query_params = build_query_params()
+    query_params.add("idOnly", "true")
+    query_params.add("cursor", "")
+    query = construct_query(services_mapping, query_params)
+
+    assert query['sort'] == services_mapping.sort_clause
+    assert "search_after" not in query
+    assert "from" not in query
+
+
+def test_cursor_sets_search_after(services_mapping):
+    query_params = build_query_params(keywords="some keywords")
+    query_params.add("cursor", encode_cursor([1.5, "abc"], "some-pit-id"))
+    query = construct_query(services_mapping, query_params)
+
+    assert query['search_after'] == [1.5, "abc"]
+    assert "from" not in query
+
+
+def test_cursor_cannot_be_used_with_page(services_mapping):
+    query_params = build_query_params(keywords="some keywords", page=2)
+    query_params.add("cursor", "")
+    with pytest.raises(ValueError):
+        construct_query(services_mapping, query_params)
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor([1.5, "abc"])) == {"search_after": [1.5, "abc"]}
+    assert decode_cursor(encode_cursor([1.5, "abc"], "some-pit-id")) == {
+        "search_after": [1.5, "abc"], "pit": "some-pit-id",
+    }
+
+
 @pytest.mark.parametrize('example', (
     'id',
     'lot',
@@ -296,3 +428,43 @@ class TestFilterClause(object):
         assert {"terms": {"dmfilter_orFieldName": ['Aa', 'Bb']}} in bool_filter['bool']['must']
         assert {"term": {"dmfilter_andFieldName": 'Aa'}} in bool_filter['bool']['must']
         assert {"term": {"dmfilter_andFieldName": 'bb'}} in bool_filter['bool']['must']
+
+
+class TestQueryPlan(object):
+    def test_plan_is_reused_for_the_same_filters_with_different_values(self, services_mapping):
+        plan = query_plan(services_mapping, MultiDict({'q': 'cloud', 'filter_lot': 'saas'}))
+
+        assert query_plan(services_mapping, MultiDict({'filter_lot': 'paas', 'page': '2'})) is plan
+        assert query_plan(services_mapping, MultiDict({'filter_lot': 'paas', 'filter_other': 'x'})) is not plan
+
+    def test_plan_is_not_shared_between_mappings(self, services_mapping):
+        other_mapping = Mapping(services_mapping.definition, "services")
+        query_args = MultiDict({'filter_lot': 'saas'})
+
+        assert query_plan(other_mapping, query_args) is not query_plan(services_mapping, query_args)
+
+    def test_plan_only_counts_known_filter_fields_towards_being_filtered(self, services_mapping):
+        plan = query_plan(services_mapping, MultiDict({'filter_lot': 'saas', 'filter_unknownField': 'x'}))
+
+        assert plan.is_filtered
+        assert plan.filter_fields == (
+            ('filter_lot', 'dmfilter_lot'),
+            ('filter_unknownField', 'dmfilter_unknownField'),
+        )
+        assert not query_plan(services_mapping, MultiDict({'filter_unknownField': 'x'})).is_filtered
+
+    def test_plan_fills_in_values_of_each_request(self, services_mapping):
+        plan = query_plan(services_mapping, MultiDict({'filter_lot': 'saas'}))
+
+        assert plan.filter_clause(MultiDict({'filter_lot': 'saas'})) == {
+            'bool': {'must': [{"term": {"dmfilter_lot": 'saas'}}]}
+        }
+        assert plan.filter_clause(MultiDict([('filter_lot', 'paas'), ('filter_lot', 'iaas')])) == {
+            'bool': {'must': [{"term": {"dmfilter_lot": 'paas'}}, {"term": {"dmfilter_lot": 'iaas'}}]}
+        }
+
+    def test_text_search_fields_are_in_a_consistent_order(self, services_mapping):
+        fields = construct_query(services_mapping, build_query_params(keywords="cloud"))[
+            "query"]["simple_query_string"]["fields"]
+
+        assert fields == sorted(fields)
@@ -0,0 +1,269 @@
+import mock
+import pytest
+from elasticsearch import NotFoundError, TransportError
+
+from app import elasticsearch_client as es
+from app.mapping import load_mapping_definition
+from app.main.services import reindex_service
+from app.main.services.reindex_service import finish_reindex, reindex_status, resume_reindex, start_reindex
+from tests.helpers import BaseApplicationTest
+
+
+class TestReindex(BaseApplicationTest):
+    def setup(self):
+        super().setup()
+        self.mapping_definition = load_mapping_definition(self.default_mapping_name)
+        self.stored_meta = dict(self.mapping_definition["mappings"]["_meta"])
+
+        self.es_indices = mock.Mock()
+        self.es_indices.get_alias.return_value = {"test-source": {"aliases": {"test-alias": {}}}}
+        self.es_indices.get_mapping.side_effect = lambda index: {"test-target": {
+            "mappings": dict(self.mapping_definition["mappings"], _meta=self.stored_meta),
+        }}
+        self.es_indices.put_mapping.side_effect = self.put_meta
+        self.es_indices.create.side_effect = lambda index, body: self.put_meta(index, body["mappings"])
+        self.es_tasks = mock.Mock()
+
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.patches = [
+            mock.patch.object(es, 'indices', self.es_indices),
+            mock.patch.object(es, 'ingest'),
+            mock.patch.object(es, 'tasks', self.es_tasks),
+            mock.patch.object(es, 'reindex', return_value={"task": "node:1"}),
+            mock.patch.object(es, 'search', return_value={"hits": {"hits": [], "total": {"value": 0}}}),
+            mock.patch('app.mapping.get_aggregation_sizes', return_value={}),
+            mock.patch.object(reindex_service.time, 'sleep'),
+            mock.patch.object(reindex_service.threading, 'Thread'),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def teardown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.app_context.pop()
+        super().teardown()
+
+    def put_meta(self, index, body):
+        self.stored_meta.clear()
+        self.stored_meta.update(body["_meta"])
+
+    def _start(self):
+        return start_reindex("test-alias", "test-target", self.default_mapping_name)
+
+    def test_start_reindex_creates_the_target_for_bulk_loading_and_starts_copying(self):
+        job, status_code = self._start()
+
+        assert status_code == 202
+        assert job["source"] == "test-source"
+        assert job["step"] == "reindexing"
+        assert job["task"] == "node:1"
+        assert self.stored_meta["dm_reindex"] == job
+        assert self.stored_meta["dm_bulk_load"] == {"number_of_replicas": None, "refresh_interval": None}
+
+        index_settings = self.es_indices.create.call_args[1]["body"]["settings"]["index"]
+        assert index_settings["number_of_replicas"] == 0
+        assert index_settings["refresh_interval"] == "-1"
+
+        es.reindex.assert_called_once_with(
+            body={
+                "source": {"index": "test-source"},
+                "dest": {"index": "test-target", "pipeline": "test-target-pipeline"},
+            },
+            slices="auto",
+            requests_per_second=5000,
+            wait_for_completion=False,
+        )
+        es.ingest.put_pipeline.assert_called_once()
+        assert reindex_service.threading.Thread.return_value.start.called
+
+    def test_start_reindex_needs_an_alias(self):
+        self.es_indices.get_alias.side_effect = NotFoundError(404, "alias [test-alias] missing", {
+            "error": "alias [test-alias] missing",
+        })
+
+        assert self._start() == ("alias [test-alias] missing", 404)
+        assert not self.es_indices.create.called
+        assert not es.reindex.called
+
+    def test_finish_reindex_sees_the_job_through_to_swapping_the_alias(self):
+        job, _ = self._start()
+        self.es_tasks.get.side_effect = [
+            {"completed": False, "task": {"status": {"total": 10, "created": 5}}},
+            {"completed": True, "task": {"status": {"total": 10, "created": 10}}, "response": {"failures": []}},
+        ]
+
+        finish_reindex("test-target", job)
+
+        assert self.stored_meta["dm_reindex"]["step"] == "done"
+        assert "dm_bulk_load" not in self.stored_meta
+        assert self.stored_meta["dm_reindex"]["progress"] == {"total": 10, "created": 10}
+        self.es_indices.put_settings.assert_called_once_with(
+            index="test-target", body={"index": {"number_of_replicas": None, "refresh_interval": None}},
+        )
+        es.ingest.delete_pipeline.assert_called_once_with(id="test-target-pipeline", ignore=404)
+        self.es_indices.refresh.assert_called_once_with(index="test-target")
+        assert self.es_indices.forcemerge.call_args[1]["max_num_segments"] == 1
+        assert es.search.call_args[1]["index"] == "test-target"
+        self.es_indices.update_aliases.assert_called_once_with({"actions": [
+            {"remove": {"index": "_all", "alias": "test-alias"}},
+            {"add": {"index": "test-target", "alias": "test-alias"}},
+        ]})
+
+    @pytest.mark.parametrize("task, error", (
+        (
+            {"completed": True, "error": {"type": "search_phase_execution_exception", "reason": "all shards failed"}},
+            "search_phase_execution_exception: all shards failed",
+        ),
+        (
+            {"completed": True, "response": {"failures": [
+                {"id": "1", "cause": {"type": "mapper_parsing_exception", "reason": "bad"}},
+            ]}},
+            "1 documents failed to copy, the first with mapper_parsing_exception: bad",
+        ),
+    ))
+    def test_finish_reindex_stops_if_the_copy_fails(self, task, error):
+        job, _ = self._start()
+        self.es_tasks.get.return_value = task
+
+        finish_reindex("test-target", job)
+
+        assert self.stored_meta["dm_reindex"]["step"] == "failed"
+        assert self.stored_meta["dm_reindex"]["failedStep"] == "reindexing"
+        assert self.stored_meta["dm_reindex"]["error"] == error
+        # the index isn't left in bulk load mode
+        assert "dm_bulk_load" not in self.stored_meta
+        self.es_indices.put_settings.assert_called_once_with(
+            index="test-target", body={"index": {"number_of_replicas": None, "refresh_interval": None}},
+        )
+        assert not self.es_indices.forcemerge.called
+        assert not self.es_indices.update_aliases.called
+        # the job can't be resumed, so the pipeline it was copying through isn't needed
+        es.ingest.delete_pipeline.assert_called_once_with(id="test-target-pipeline", ignore=404)
+
+    def test_a_failed_job_keeps_the_index_s_own_pipeline(self):
+        self.app.config["DM_INGEST_PIPELINES"] = True
+        job, _ = self._start()
+        self.es_tasks.get.return_value = {"completed": True, "error": {"type": "x", "reason": "y"}}
+
+        finish_reindex("test-target", job)
+
+        assert self.stored_meta["dm_reindex"]["step"] == "failed"
+        assert not es.ingest.delete_pipeline.called
+
+    def test_finish_reindex_gives_up_on_a_copy_which_takes_too_long(self):
+        self.app.config["DM_REINDEX_TIMEOUT"] = 0
+        job, _ = self._start()
+        self.es_tasks.get.return_value = {"completed": False, "task": {"status": {"total": 10, "created": 5}}}
+
+        finish_reindex("test-target", job)
+
+        assert self.stored_meta["dm_reindex"]["step"] == "failed"
+        assert self.stored_meta["dm_reindex"]["error"] == "Gave up waiting for the copy after 0 seconds"
+        self.es_tasks.cancel.assert_called_once_with(task_id="node:1")
+        assert "dm_bulk_load" not in self.stored_meta
+
+    def test_finish_reindex_records_unexpected_errors(self):
+        job, _ = self._start()
+        self.es_tasks.get.return_value = {"completed": True, "response": {"failures": []}}
+        es.search.side_effect = KeyError("doc_type")
+
+        finish_reindex("test-target", job)
+
+        assert self.stored_meta["dm_reindex"]["step"] == "failed"
+        assert self.stored_meta["dm_reindex"]["failedStep"] == "warming"
+        assert self.stored_meta["dm_reindex"]["error"] == "KeyError: 'doc_type'"
+        assert not self.es_indices.update_aliases.called
+
+    def test_reindex_status_has_up_to_date_progress_while_copying(self):
+        self._start()
+        self.es_tasks.get.return_value = {"completed": False, "task": {"status": {"total": 10, "created": 3}}}
+
+        job, status_code = reindex_status("test-target")
+
+        assert status_code == 200
+        assert job["step"] == "reindexing"
+        assert job["progress"] == {"total": 10, "created": 3}
+
+    def test_reindex_status_of_an_index_not_created_by_a_reindex(self):
+        assert reindex_status("test-target") == ("Index 'test-target' was not created by a reindex", 404)
+
+    def test_a_job_whose_copy_finished_long_ago_is_abandoned_and_can_be_resumed(self):
+        self._start()
+        reindex_service.threading.Thread.reset_mock()
+        self.es_tasks.get.return_value = {
+            "completed": True,
+            "task": {"start_time_in_millis": 0, "running_time_in_nanos": 10 ** 9, "status": {"total": 10}},
+        }
+
+        job, _ = reindex_status("test-target")
+        assert job["abandoned"] is True
+
+        job, status_code = resume_reindex("test-target")
+
+        assert status_code == 202
+        assert job["step"] == "reindexing"
+        assert "abandoned" not in self.stored_meta["dm_reindex"]
+        assert "resumedAt" in self.stored_meta["dm_reindex"]
+        assert reindex_service.threading.Thread.return_value.start.called
+
+    def test_a_job_which_is_still_copying_cannot_be_resumed(self):
+        self._start()
+        reindex_service.threading.Thread.reset_mock()
+        self.es_tasks.get.return_value = {"completed": False, "task": {"status": {"total": 10, "created": 3}}}
+
+        assert reindex_status("test-target")[0]["abandoned"] is False
+        assert resume_reindex("test-target") == (
+            "Reindex into 'test-target' is reindexing and hasn't been abandoned", 400,
+        )
+        assert not reindex_service.threading.Thread.called
+
+    def test_a_job_which_failed_after_copying_is_resumed_from_the_step_it_failed_at(self):
+        job, _ = self._start()
+        self.es_tasks.get.return_value = {"completed": True, "response": {"failures": []}}
+        es.search.side_effect = TransportError(500, "search_phase_execution_exception", {})
+        finish_reindex("test-target", job)
+        reindex_service.threading.Thread.reset_mock()
+
+        job, status_code = resume_reindex("test-target")
+
+        assert status_code == 202
+        assert job["step"] == "warming"
+        assert "error" not in job and "failedStep" not in job
+        assert reindex_service.threading.Thread.return_value.start.called
+
+        es.search.side_effect = None
+        finish_reindex("test-target", job)
+        assert self.stored_meta["dm_reindex"]["step"] == "done"
+        assert self.es_indices.update_aliases.called
+
+    def test_a_job_whose_copy_failed_cannot_be_resumed(self):
+        job, _ = self._start()
+        self.es_tasks.get.return_value = {"completed": True, "error": {"type": "x", "reason": "y"}}
+        finish_reindex("test-target", job)
+
+        assert resume_reindex("test-target") == (
+            "Reindex into 'test-target' failed to copy documents, so has to be started again", 400,
+        )
+
+    def test_a_job_which_failed_leaving_bulk_load_is_still_force_merged_when_resumed(self):
+        job, _ = self._start()
+        self.es_tasks.get.return_value = {"completed": True, "response": {"failures": []}}
+        self.es_indices.forcemerge.side_effect = TransportError(500, "timeout", {})
+        finish_reindex("test-target", job)
+        assert self.stored_meta["dm_reindex"]["failedStep"] == "leaving_bulk_load"
+        # taken out of bulk load mode when it failed
+        assert "dm_bulk_load" not in self.stored_meta
+
+        job, _ = resume_reindex("test-target")
+        self.es_indices.forcemerge.reset_mock()
+        self.es_indices.forcemerge.side_effect = None
+        finish_reindex("test-target", job)
+
+        assert self.stored_meta["dm_reindex"]["step"] == "done"
+        self.es_indices.forcemerge.assert_called_once_with(
+            index="test-target",
+            max_num_segments=self.app.config["DM_FORCE_MERGE_MAX_NUM_SEGMENTS"],
+            request_timeout=self.app.config["DM_FORCE_MERGE_TIMEOUT"],
+        )
@@ -102,3 +102,18 @@ def test_should_build_status_response_from_es_response_with_empty_index():
         "num_docs": None,
         "primary_size": "73.7mb",
     }
+
+
+@mock.patch('app.main.services.response_formatters.current_app')
+def test_id_only_results_only_have_ids(current_app, services_mapping):
+    res = convert_es_results(services_mapping, SEARCH_RESULTS_JSON, {"idOnly": "True"})
+
+    assert res["documents"] == [{"id": hit["_id"]} for hit in SEARCH_RESULTS_JSON["hits"]["hits"]]
+
+
+def test_response_projection_strips_prefixes_of_response_fields(services_mapping):
+    assert services_mapping.response_projection["dmtext_serviceName"] == "serviceName"
+    # any prefix of a response field is stripped, not just the response field prefix
+    assert services_mapping.response_projection["dmfilter_lot"] == "lot"
+    # fields which aren't response fields are dropped
+    assert "dmfilter_phoneSupport" not in services_mapping.response_projection
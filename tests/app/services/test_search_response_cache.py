@@ -0,0 +1,159 @@
+import json
+
+import mock
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from app import elasticsearch_client as es
+from app.mapping import Mapping, load_mapping_definition
+from app.main.services.search_response_cache import search_response_cache
+from app.main.services.search_service import refresh, search_with_keywords_and_filters
+from tests.helpers import BaseApplicationTest
+
+with open("example_es_responses/search_results.json") as search_results:
+    SEARCH_RESULTS_JSON = json.load(search_results)
+
+
+class TestSearchResponseCache(BaseApplicationTest):
+    def setup(self):
+        super().setup()
+        self.app.config["DM_SEARCH_RESPONSE_CACHE_SETTLE_TIME"] = 0
+        self.mapping = Mapping(
+            load_mapping_definition(self.default_mapping_name), "services", index_name="test-index-2020-01-01"
+        )
+
+    def key(self, *args, **options):
+        with self.app.app_context():
+            return search_response_cache.key(self.mapping, MultiDict(args), **options)
+
+    @pytest.mark.parametrize("args, equivalent_args", (
+        ([("q", "cloud"), ("filter_lot", "saas")], [("filter_lot", "saas"), ("q", "cloud")]),
+        ([("filter_a", "x"), ("filter_a", "y")], [("filter_a", "y"), ("filter_a", "x")]),
+        ([("q", "cloud"), ("page", "1")], [("q", "cloud")]),
+        ([("q", "cloud"), ("idOnly", "yes")], [("q", "cloud"), ("idOnly", "")]),
+        ([("q", "cloud"), ("utm_source", "email")], [("q", "cloud")]),
+    ))
+    def test_equivalent_query_args_share_a_key(self, args, equivalent_args):
+        assert self.key(*args) == self.key(*equivalent_args)
+
+    @pytest.mark.parametrize("args, other_args", (
+        ([("q", "cloud")], [("q", "clouds")]),
+        ([("q", "cloud")], [("q", "cloud"), ("page", "2")]),
+        ([("q", "cloud")], [("q", "cloud"), ("idOnly", "")]),
+        ([("filter_a", "x,y")], [("filter_a", "x"), ("filter_a", "y")]),
+    ))
+    def test_different_query_args_have_different_keys(self, args, other_args):
+        assert self.key(*args) != self.key(*other_args)
+
+    def test_options_are_part_of_key(self):
+        assert self.key(("q", "cloud"), page_size=30) != self.key(("q", "cloud"), page_size=300)
+
+    def test_new_generation_changes_key(self):
+        key = self.key(("q", "cloud"))
+        with self.app.app_context():
+            search_response_cache.new_generation("some-other-index")
+        assert self.key(("q", "cloud")) == key
+
+        with self.app.app_context():
+            search_response_cache.new_generation("test-index-2020-01-01")
+        assert self.key(("q", "cloud")) != key
+
+    def test_generation_outlasts_cached_responses(self):
+        self.app.config["DM_SEARCH_RESPONSE_CACHE_TTL"] = 0
+        search_response_cache.init_app(self.app)
+
+        assert self.key(("q", "cloud")) == self.key(("q", "cloud"))
+
+    def test_nothing_is_cached_while_index_settles(self):
+        self.app.config["DM_SEARCH_RESPONSE_CACHE_SETTLE_TIME"] = 60
+        assert self.key(("q", "cloud")) is not None
+
+        with self.app.app_context():
+            search_response_cache.new_generation("test-index-2020-01-01")
+        assert self.key(("q", "cloud")) is None
+
+    def test_cache_can_be_disabled(self):
+        self.app.config["DM_SEARCH_RESPONSE_CACHE_BACKEND"] = None
+        search_response_cache.init_app(self.app)
+
+        assert self.key(("q", "cloud")) is None
+
+    def test_unrecognized_backend(self):
+        self.app.config["DM_SEARCH_RESPONSE_CACHE_BACKEND"] = "memcached"
+        with pytest.raises(ValueError):
+            search_response_cache.init_app(self.app)
+
+
+class TestCachedSearch(BaseApplicationTest):
+    def setup(self):
+        super().setup()
+        self.app.config["DM_SEARCH_RESPONSE_CACHE_SETTLE_TIME"] = 0
+        self.mapping = Mapping(
+            load_mapping_definition(self.default_mapping_name), "services", index_name="test-index-2020-01-01"
+        )
+        self.get_mapping_patch = mock.patch('app.mapping.get_mapping', return_value=self.mapping)
+        self.get_mapping_patch.start()
+
+    def teardown(self):
+        self.get_mapping_patch.stop()
+        super().teardown()
+
+    def search(self, *args):
+        with self.app.test_request_context():
+            return search_with_keywords_and_filters("test-alias", "services", MultiDict(args))
+
+    def test_repeated_search_is_served_from_cache(self):
+        with self.app.app_context(), mock.patch.object(es, 'search', return_value=SEARCH_RESULTS_JSON) as es_search:
+            first = self.search(("q", "cloud"), ("filter_lot", "saas"))
+            second = self.search(("filter_lot", "saas"), ("q", "cloud"), ("page", "1"))
+
+        assert es_search.call_count == 1
+        assert first[1] == second[1] == 200
+        assert first[0]["documents"] == second[0]["documents"]
+        # the echoed query and links are always those of the request being served
+        assert second[0]["meta"]["query"] == MultiDict([("filter_lot", "saas"), ("q", "cloud"), ("page", "1")])
+
+    def test_new_generation_causes_a_miss(self):
+        with self.app.app_context(), mock.patch.object(es, 'search', return_value=SEARCH_RESULTS_JSON) as es_search:
+            self.search(("q", "cloud"))
+            search_response_cache.new_generation("test-index-2020-01-01")
+            self.search(("q", "cloud"))
+
+        assert es_search.call_count == 2
+
+    def test_refreshing_via_an_alias_causes_a_miss(self):
+        with self.app.app_context(), mock.patch.object(es, 'search', return_value=SEARCH_RESULTS_JSON) as es_search, \
+                mock.patch.object(es, 'indices') as es_indices:
+            es_indices.get_mapping.return_value = {"test-index-2020-01-01": {"mappings": {}}}
+            self.search(("q", "cloud"))
+            assert refresh("test-alias") == ("acknowledged", 200)
+            self.search(("q", "cloud"))
+
+        es_indices.get_mapping.assert_called_once_with(index="test-alias")
+        assert es_search.call_count == 2
+
+    def test_pages_off_the_end_are_not_cached(self):
+        empty_results = dict(SEARCH_RESULTS_JSON, hits={"total": {"value": 0, "relation": "eq"}, "hits": []})
+        with self.app.app_context(), mock.patch.object(es, 'search', return_value=empty_results) as es_search:
+            assert self.search(("q", "cloud"), ("page", "5"))[1] == 404
+            assert self.search(("q", "cloud"), ("page", "5"))[1] == 404
+
+        assert es_search.call_count == 2
+
+    def test_indexing_a_document_causes_a_miss(self):
+        with self.app.app_context(), mock.patch.object(es, 'search', return_value=SEARCH_RESULTS_JSON) as es_search:
+            self.search(("q", "cloud"))
+
+        with mock.patch('app.main.views.update.get_mapping', return_value=self.mapping), \
+                mock.patch('app.main.views.update.index', return_value=("acknowledged", 200)):
+            response = self.client.put(
+                '/test-alias/services/1',
+                data=json.dumps({"document": {"id": "1"}}),
+                content_type="application/json",
+            )
+        assert response.status_code == 200
+
+        with self.app.app_context(), mock.patch.object(es, 'search', return_value=SEARCH_RESULTS_JSON) as es_search:
+            self.search(("q", "cloud"))
+
+        assert es_search.call_count == 1
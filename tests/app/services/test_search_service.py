@@ -3,7 +3,15 @@ import mock
 
 from elasticsearch import TransportError
 
-from tests.helpers import BaseApplicationTestWithIndex
+from werkzeug.datastructures import MultiDict
+from werkzeug.urls import url_decode
+
+from app import elasticsearch_client as es
+from app.mapping import Mapping, load_mapping_definition
+from app.main.services.query_builder import decode_cursor, encode_cursor
+from app.main.services.search_service import bulk, bulk_load, create_index, delete_index, index, \
+    search_with_keywords_and_filters
+from tests.helpers import BaseApplicationTest, BaseApplicationTestWithIndex
 
 
 class TestCoreSearchAndAggregate(BaseApplicationTestWithIndex):
@@ -27,3 +35,169 @@ class TestCoreSearchAndAggregate(BaseApplicationTestWithIndex):
 
         assert response.status_code == 500
         assert data['error'] is None
+
+
+class TestBulk(BaseApplicationTest):
+    def test_bulk_reports_each_operation_in_order(self):
+        with self.app.app_context(), mock.patch.object(es, 'bulk') as es_bulk:
+            es_bulk.return_value = {"errors": True, "items": [
+                {"index": {"_id": "1", "status": 201, "result": "created"}},
+                {"delete": {"_id": "2", "status": 404, "result": "not_found"}},
+                {"index": {"_id": "3", "status": 400, "error": {"type": "mapper_parsing_exception", "reason": "bad"}}},
+            ]}
+
+            result, status_code = bulk("test-index", "services", (
+                ("index", "1", {"dmtext_id": "1"}),
+                ("delete", "2", None),
+                ("index", "3", {"dmtext_id": "3"}),
+            ))
+
+        assert status_code == 200
+        assert result == {"errors": True, "items": [
+            {"id": "1", "action": "index", "status": 201, "result": "created"},
+            {"id": "2", "action": "delete", "status": 404, "result": "not_found"},
+            {"id": "3", "action": "index", "status": 400, "error": "mapper_parsing_exception: bad"},
+        ]}
+
+        bulk_body = es_bulk.call_args[0][0].splitlines()
+        assert [json.loads(line) for line in bulk_body] == [
+            {"index": {"_index": "test-index", "_id": "1"}},
+            {"dmtext_id": "1"},
+            {"delete": {"_index": "test-index", "_id": "2"}},
+            {"index": {"_index": "test-index", "_id": "3"}},
+            {"dmtext_id": "3"},
+        ]
+
+    def test_bulk_reports_chunk_failures_against_each_operation(self):
+        with self.app.app_context(), mock.patch.object(es, 'bulk') as es_bulk:
+            es_bulk.side_effect = TransportError(503, 'unavailable', 'Cluster unavailable')
+
+            result, status_code = bulk("test-index", "services", (
+                ("index", "1", {"dmtext_id": "1"}),
+                ("delete", "2", None),
+            ))
+
+        assert status_code == 200
+        assert result["errors"] is True
+        assert [(item["id"], item["status"]) for item in result["items"]] == [("1", 503), ("2", 503)]
+
+
+class TestBulkLoad(BaseApplicationTestWithIndex):
+    def test_documents_loaded_in_bulk_load_mode_are_searchable_afterwards(self):
+        with self.app.app_context():
+            with bulk_load("test-index"):
+                settings = es.indices.get_settings(index="test-index")["test-index"]["settings"]["index"]
+                assert settings["refresh_interval"] == "-1"
+                assert settings["number_of_replicas"] == "0"
+
+                index("test-index", "services", {"dmtext_id": "1"}, "1")
+
+            assert es.count(index="test-index")["count"] == 1
+            settings = es.indices.get_settings(index="test-index")["test-index"]["settings"]["index"]
+            assert settings.get("refresh_interval") is None
+            assert settings["number_of_replicas"] == "1"
+
+
+class TestIngestPipelines(BaseApplicationTest):
+    def setup(self):
+        super().setup()
+        self.app.config["DM_INGEST_PIPELINES"] = True
+
+    def test_create_index_registers_a_pipeline_and_makes_it_the_default(self):
+        with self.app.app_context(), \
+                mock.patch.object(es, 'ingest') as es_ingest, mock.patch.object(es, 'indices') as es_indices:
+            assert create_index("test-index", "services") == ("acknowledged", 200)
+
+        assert es_ingest.put_pipeline.call_args[1]["id"] == "test-index-pipeline"
+        processors = es_ingest.put_pipeline.call_args[1]["body"]["processors"]
+        assert processors[0]["script"]["tag"] == "unprefix"
+        assert processors[-1]["script"]["tag"] == "fan_out"
+
+        index_body = es_indices.create.call_args[1]["body"]
+        assert index_body["settings"]["index"]["default_pipeline"] == "test-index-pipeline"
+        assert index_body["mappings"]["_meta"]["dm_ingest_pipeline"] == "test-index-pipeline"
+        assert Mapping(index_body, "services").ingest_pipeline == "test-index-pipeline"
+
+    def test_create_index_without_pipelines(self):
+        self.app.config["DM_INGEST_PIPELINES"] = False
+        with self.app.app_context(), \
+                mock.patch.object(es, 'ingest') as es_ingest, mock.patch.object(es, 'indices') as es_indices:
+            assert create_index("test-index", "services") == ("acknowledged", 200)
+
+        assert not es_ingest.put_pipeline.called
+        assert es_indices.create.call_args[1]["body"] == load_mapping_definition("services")
+
+    def test_create_index_fails_if_the_pipeline_cannot_be_registered(self):
+        with self.app.app_context(), \
+                mock.patch.object(es, 'ingest') as es_ingest, mock.patch.object(es, 'indices') as es_indices:
+            es_ingest.put_pipeline.side_effect = TransportError(400, 'script_exception', {"error": {
+                "root_cause": [{"type": "script_exception", "reason": "compile error"}],
+            }})
+            assert create_index("test-index", "services") == ("script_exception: compile error", 400)
+
+        assert not es_indices.create.called
+
+    def test_delete_index_deletes_its_pipeline(self):
+        with self.app.app_context(), \
+                mock.patch.object(es, 'ingest') as es_ingest, mock.patch.object(es, 'indices') as es_indices:
+            assert delete_index("test-index") == ("acknowledged", 200)
+
+        es_indices.delete.assert_called_once_with(index="test-index")
+        es_ingest.delete_pipeline.assert_called_once_with(id="test-index-pipeline", ignore=404)
+
+
+class TestCursorSearchWithPointInTime(BaseApplicationTest):
+    def setup(self):
+        super().setup()
+        self.app.config['DM_SEARCH_CURSOR_USE_PIT'] = True
+        self.app.config['DM_SEARCH_PAGE_SIZE'] = 2
+        mapping = Mapping(load_mapping_definition(self.default_mapping_name), "services", index_name="test-index")
+        self.get_mapping_patch = mock.patch('app.mapping.get_mapping', return_value=mapping)
+        self.get_mapping_patch.start()
+
+    def teardown(self):
+        self.get_mapping_patch.stop()
+        super().teardown()
+
+    def search(self, *args):
+        with self.app.test_request_context():
+            return search_with_keywords_and_filters("test-alias", "services", MultiDict(args))
+
+    def es_response(self, *hit_sort_values, pit_id="pit-2"):
+        return {
+            "took": 1,
+            "pit_id": pit_id,
+            "hits": {
+                "total": {"value": 3, "relation": "eq"},
+                "hits": [{"_id": str(i), "_source": {}, "sort": sort} for i, sort in enumerate(hit_sort_values)],
+            },
+        }
+
+    def test_first_page_opens_a_point_in_time(self):
+        with self.app.app_context(), mock.patch.object(es, 'open_point_in_time') as open_point_in_time, \
+                mock.patch.object(es, 'search') as es_search:
+            open_point_in_time.return_value = {"id": "pit-1"}
+            es_search.return_value = self.es_response([2.0, "b"], [1.0, "a"])
+
+            result, status_code = self.search(("q", "cloud"), ("cursor", ""))
+
+        assert status_code == 200
+        open_point_in_time.assert_called_once_with(index="test-alias", keep_alive="1m")
+        assert es_search.call_args[1]["index"] is None
+        assert es_search.call_args[1]["body"]["pit"] == {"id": "pit-1", "keep_alive": "1m"}
+
+        next_cursor = MultiDict(url_decode(result["links"]["next"].split("?", 1)[1]))["cursor"]
+        assert decode_cursor(next_cursor) == {"search_after": [1.0, "a"], "pit": "pit-2"}
+
+    def test_later_pages_reuse_the_cursors_point_in_time(self):
+        with self.app.app_context(), mock.patch.object(es, 'open_point_in_time') as open_point_in_time, \
+                mock.patch.object(es, 'search') as es_search:
+            es_search.return_value = self.es_response([0.5, "c"])
+
+            result, status_code = self.search(("q", "cloud"), ("cursor", encode_cursor([1.0, "a"], "pit-2")))
+
+        assert status_code == 200
+        assert not open_point_in_time.called
+        assert es_search.call_args[1]["body"]["pit"]["id"] == "pit-2"
+        assert es_search.call_args[1]["body"]["search_after"] == [1.0, "a"]
+        assert result["links"] == {}
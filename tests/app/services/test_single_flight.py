@@ -0,0 +1,223 @@
+import json
+import sys
+import threading
+import time
+
+import mock
+import pytest
+from flask import Flask
+from werkzeug.datastructures import MultiDict
+
+from app import elasticsearch_client as es
+from app.mapping import Mapping, load_mapping_definition
+from app.main.services.search_response_cache import search_response_cache
+from app.main.services.search_service import search_with_keywords_and_filters
+from app.main.services.single_flight import InProcessSingleFlight, RedisSingleFlight, single_flight
+from tests.helpers import BaseApplicationTest
+
+with open("example_es_responses/search_results.json") as search_results:
+    SEARCH_RESULTS_JSON = json.load(search_results)
+
+
+def run_concurrently(count, target):
+    """Calls ``target`` from ``count`` threads at once, returning what each returned (or raised)"""
+    results = [None] * count
+
+    def run(i):
+        try:
+            results[i] = target()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+class BlockingCall(object):
+    """A callable which doesn't return until released, counting how many times it's been called"""
+
+    def __init__(self, result=None, exception=None):
+        self.result = result
+        self.exception = exception
+        self.calls = 0
+        self.started = threading.Event()
+        self.released = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        self.released.wait(5)
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+
+class TestInProcessSingleFlight(object):
+    def setup(self):
+        self.single_flight = InProcessSingleFlight(timeout=5)
+
+    def coalesce(self, fn, count=5, key="a"):
+        threads, results = run_concurrently(count, lambda: self.single_flight.do(key, fn))
+        fn.started.wait(5)
+        # give the other threads time to join the flight
+        time.sleep(0.2)
+        fn.released.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_concurrent_calls_share_one_result(self):
+        fn = BlockingCall(result={"hits": []})
+        results = self.coalesce(fn)
+
+        assert fn.calls == 1
+        assert all(result is fn.result for result in results)
+
+    def test_concurrent_calls_share_an_exception(self):
+        fn = BlockingCall(exception=ValueError("boom"))
+        results = self.coalesce(fn)
+
+        assert fn.calls == 1
+        assert all(isinstance(result, ValueError) for result in results)
+
+    def test_calls_after_the_flight_has_landed_make_their_own(self):
+        fn = mock.Mock(return_value=1)
+        self.single_flight.do("a", fn)
+        self.single_flight.do("a", fn)
+
+        assert fn.call_count == 2
+
+    def test_different_keys_are_not_coalesced(self):
+        fn = BlockingCall(result=1)
+        other_fn = mock.Mock(return_value=2)
+
+        threads, results = run_concurrently(1, lambda: self.single_flight.do("a", fn))
+        fn.started.wait(5)
+        assert self.single_flight.do("b", other_fn) == 2
+        fn.released.set()
+        threads[0].join(5)
+
+        assert results == [1]
+
+    def test_waiting_is_abandoned_after_timeout(self):
+        self.single_flight.timeout = 0.01
+        fn = BlockingCall(result=1)
+        other_fn = mock.Mock(return_value=2)
+
+        threads, results = run_concurrently(1, lambda: self.single_flight.do("a", fn))
+        fn.started.wait(5)
+        assert self.single_flight.do("a", other_fn) == 2
+        fn.released.set()
+        threads[0].join(5)
+
+
+class TestRedisSingleFlight(object):
+    def setup(self):
+        self.redis = mock.Mock()
+        self.redis.RedisError = type("RedisError", (Exception,), {})
+        self.redis_modules_patch = mock.patch.dict(sys.modules, {"redis": self.redis})
+        self.redis_modules_patch.start()
+        self.single_flight = RedisSingleFlight("redis://localhost", timeout=5, poll_interval=0)
+        self.client = self.redis.Redis.from_url.return_value
+        self.release = self.client.register_script.return_value
+
+    def teardown(self):
+        self.redis_modules_patch.stop()
+
+    def test_leader_publishes_its_result_and_releases_lock(self):
+        self.client.set.return_value = True
+
+        with mock.patch("app.main.services.single_flight.uuid.uuid4", return_value=mock.Mock(hex="token")):
+            assert self.single_flight.do("a", lambda: {"b": 1}) == {"b": 1}
+
+        assert self.client.set.call_args_list == [
+            mock.call("dm-search-api:flight:a", "token", nx=True, px=5000),
+            mock.call("dm-search-api:flight:result:token", '{"b": 1}', px=5000),
+        ]
+        self.release.assert_called_once_with(keys=["dm-search-api:flight:a"], args=["token"])
+
+    def test_leader_releases_lock_on_error(self):
+        self.client.set.return_value = True
+
+        def fail():
+            raise ValueError("boom")
+
+        with pytest.raises(ValueError), \
+                mock.patch("app.main.services.single_flight.uuid.uuid4", return_value=mock.Mock(hex="token")):
+            self.single_flight.do("a", fail)
+        self.release.assert_called_once_with(keys=["dm-search-api:flight:a"], args=["token"])
+
+    def test_follower_waits_for_leaders_result(self):
+        self.client.set.return_value = False
+        self.client.exists.return_value = True
+        self.client.get.side_effect = [b"token", None, None, b'{"b": 1}']
+        fn = mock.Mock()
+
+        assert self.single_flight.do("a", fn) == {"b": 1}
+        assert not fn.called
+        assert self.client.get.call_args_list[-1] == mock.call("dm-search-api:flight:result:token")
+
+    def test_follower_makes_its_own_call_if_leader_finishes_without_result(self):
+        self.client.set.return_value = False
+        self.client.exists.return_value = False
+        self.client.get.side_effect = [b"token", None]
+
+        assert self.single_flight.do("a", lambda: {"b": 2}) == {"b": 2}
+
+    def test_redis_errors_fall_back_to_making_the_call(self):
+        self.client.set.side_effect = self.redis.RedisError("connection refused")
+
+        with Flask(__name__).app_context():
+            assert self.single_flight.do("a", lambda: {"b": 2}) == {"b": 2}
+
+
+class TestCoalescedSearch(BaseApplicationTest):
+    def setup(self):
+        super().setup()
+        # so that every search gets as far as elasticsearch
+        self.app.config["DM_SEARCH_RESPONSE_CACHE_BACKEND"] = None
+        search_response_cache.init_app(self.app)
+        self.mapping = Mapping(
+            load_mapping_definition(self.default_mapping_name), "services", index_name="test-index-2020-01-01"
+        )
+        self.get_mapping_patch = mock.patch('app.mapping.get_mapping', return_value=self.mapping)
+        self.get_mapping_patch.start()
+
+    def teardown(self):
+        self.get_mapping_patch.stop()
+        super().teardown()
+
+    def search(self, *args):
+        with self.app.test_request_context():
+            return search_with_keywords_and_filters("test-alias", "services", MultiDict(args))
+
+    def test_concurrent_identical_searches_are_sent_once(self):
+        es_search = BlockingCall(result=SEARCH_RESULTS_JSON)
+
+        with self.app.app_context(), mock.patch.object(es, 'search', side_effect=lambda **kwargs: es_search()):
+            threads, results = run_concurrently(3, lambda: self.search(("q", "cloud")))
+            es_search.started.wait(5)
+            time.sleep(0.2)
+            es_search.released.set()
+            for thread in threads:
+                thread.join(5)
+
+        assert es_search.calls == 1
+        assert [status for _, status in results] == [200, 200, 200]
+
+    def test_coalescing_can_be_disabled(self):
+        self.app.config["DM_SEARCH_SINGLE_FLIGHT_BACKEND"] = None
+        single_flight.init_app(self.app)
+
+        with self.app.app_context(), mock.patch.object(es, 'search', return_value=SEARCH_RESULTS_JSON) as es_search:
+            self.search(("q", "cloud"))
+            self.search(("q", "cloud"))
+
+        assert es_search.call_count == 2
+
+    def test_unrecognized_backend(self):
+        self.app.config["DM_SEARCH_SINGLE_FLIGHT_BACKEND"] = "memcached"
+        with pytest.raises(ValueError):
+            single_flight.init_app(self.app)
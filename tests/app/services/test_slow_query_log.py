@@ -0,0 +1,120 @@
+import mock
+import pytest
+from flask import Flask
+from werkzeug.datastructures import MultiDict
+
+from app.main.services.slow_query_log import FingerprintStats, SlowQueryLog, fingerprint
+
+
+class TestFingerprint(object):
+    def test_values_do_not_affect_fingerprint(self):
+        assert fingerprint(MultiDict([("q", "email"), ("filter_lot", "cloud-software")])) == fingerprint(
+            MultiDict([("filter_lot", "cloud-hosting,cloud-support"), ("q", "hosting")])
+        )
+
+    @pytest.mark.parametrize("query_args, other_query_args", (
+        ([("q", "email")], []),
+        ([("filter_lot", "cloud-software")], [("filter_serviceCategories", "email")]),
+        ([("page", "1")], [("page", "2")]),
+        ([("page", "10")], [("page", "11")]),
+        ([], [("cursor", "")]),
+        ([], [("idOnly", "True")]),
+    ))
+    def test_shape_affects_fingerprint(self, query_args, other_query_args):
+        assert fingerprint(MultiDict(query_args)) != fingerprint(MultiDict(other_query_args))
+
+    def test_aggregations_affect_fingerprint_but_not_their_order(self):
+        assert fingerprint(MultiDict(), aggregations=["lot", "serviceCategories"]) == fingerprint(
+            MultiDict(), aggregations=["serviceCategories", "lot", "lot"]
+        )
+        assert fingerprint(MultiDict(), aggregations=["lot"]) != fingerprint(MultiDict())
+
+    def test_page_depth(self):
+        assert fingerprint(MultiDict([("page", "5")]))["page"] == "<=10"
+        assert fingerprint(MultiDict([("page", "5000")]))["page"] == ">1000"
+        assert fingerprint(MultiDict([("page", "foo")]))["page"] == "invalid"
+
+
+class TestFingerprintStats(object):
+    def test_statistics(self):
+        stats = FingerprintStats(max_size=10, samples=100)
+        for duration in range(1, 101):
+            stats.record({"a": 1}, duration / 100)
+        stats.record({"b": 1}, 0.5)
+
+        most_expensive, cheapest = stats.most_expensive(10)
+        assert most_expensive["fingerprint"] == {"a": 1}
+        assert most_expensive["count"] == 100
+        assert most_expensive["totalSeconds"] == pytest.approx(50.5)
+        assert most_expensive["meanSeconds"] == pytest.approx(0.505)
+        assert most_expensive["maxSeconds"] == 1
+        assert most_expensive["percentileSeconds"] == {"50": 0.5, "95": 0.95, "99": 0.99}
+        assert cheapest["fingerprint"] == {"b": 1}
+
+    def test_most_expensive_is_limited(self):
+        stats = FingerprintStats(max_size=10, samples=100)
+        for i in range(5):
+            stats.record({"a": i}, i)
+
+        assert [entry["fingerprint"] for entry in stats.most_expensive(2)] == [{"a": 4}, {"a": 3}]
+
+    def test_least_recently_seen_fingerprints_are_dropped(self):
+        stats = FingerprintStats(max_size=2, samples=100)
+        stats.record({"a": 1}, 1)
+        stats.record({"b": 1}, 1)
+        stats.record({"a": 1}, 1)
+        stats.record({"c": 1}, 1)
+
+        assert len(stats) == 2
+        assert {"b": 1} not in [entry["fingerprint"] for entry in stats.most_expensive(10)]
+
+    def test_percentiles_are_of_recent_samples(self):
+        stats = FingerprintStats(max_size=2, samples=2)
+        for duration in (10, 1, 2):
+            stats.record({"a": 1}, duration)
+
+        entry, = stats.most_expensive(1)
+        assert entry["maxSeconds"] == 10
+        assert entry["percentileSeconds"]["99"] == 2
+
+
+class TestSlowQueryLog(object):
+    def setup(self):
+        self.app = Flask(__name__)
+        self.app.config.update(
+            DM_SLOW_QUERY_LOG_THRESHOLD=1.0,
+            DM_SLOW_QUERY_LOG_MAX_FINGERPRINTS=10,
+            DM_SLOW_QUERY_LOG_SAMPLES=10,
+        )
+        self.slow_query_log = SlowQueryLog()
+        self.slow_query_log.init_app(self.app)
+
+    def record(self, duration):
+        with mock.patch("app.main.services.slow_query_log.time.monotonic", side_effect=[0, duration]):
+            with self.slow_query_log.record("g-cloud", MultiDict([("q", "email")]), search=True):
+                pass
+
+    def test_queries_over_threshold_are_logged(self):
+        with self.app.app_context(), mock.patch.object(self.app, "logger") as logger:
+            self.record(0.5)
+            assert not logger.warning.called
+
+            self.record(1.5)
+            assert logger.warning.call_count == 1
+            assert logger.warning.call_args[1]["extra"]["query_args"] == {"q": ["email"]}
+            assert logger.warning.call_args[1]["extra"]["fingerprint"]["index"] == "g-cloud"
+
+    def test_threshold_of_none_disables_logging(self):
+        self.app.config["DM_SLOW_QUERY_LOG_THRESHOLD"] = None
+        with self.app.app_context(), mock.patch.object(self.app, "logger") as logger:
+            self.record(100)
+            assert not logger.warning.called
+
+    def test_queries_are_recorded_even_if_they_fail(self):
+        with self.app.app_context():
+            with pytest.raises(ValueError):
+                with self.slow_query_log.record("g-cloud", MultiDict()):
+                    raise ValueError
+
+            entry, = self.slow_query_log.most_expensive(10)
+            assert entry["count"] == 1
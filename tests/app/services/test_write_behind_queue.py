@@ -0,0 +1,176 @@
+import json
+import os
+
+import mock
+from elasticsearch import ConnectionError
+
+from app import elasticsearch_client as es
+from app.main.services import write_behind_queue as write_behind_queue_module
+from app.main.services.write_behind_queue import QueuedOperation, write_behind_queue
+from tests.helpers import BaseApplicationTestWithIndex, make_search_api_url, make_service
+
+
+class TestWriteBehindQueue(BaseApplicationTestWithIndex):
+    def setup(self):
+        super().setup()
+        self.enable(DM_WRITE_BEHIND_FLUSH_INTERVAL=60)
+
+    def enable(self, **config):
+        self.app.config.update(DM_WRITE_BEHIND=True, **config)
+        write_behind_queue.init_app(self.app)
+
+    def put(self, service):
+        return self.client.put(make_search_api_url(service), data=json.dumps(service), content_type="application/json")
+
+    def flush(self):
+        with self.app.app_context():
+            write_behind_queue.flush()
+
+    def test_writes_are_acknowledged_then_made_when_flushed(self):
+        service = make_service(id="1")
+        response = self.put(service)
+        assert response.status_code == 202
+        assert response.json["message"] == "queued"
+        assert self.client.get(make_search_api_url(service)).status_code == 404
+
+        self.flush()
+        assert self.client.get(make_search_api_url(service)).status_code == 200
+
+        assert self.client.delete(make_search_api_url(service)).status_code == 202
+        self.flush()
+        assert self.client.get(make_search_api_url(service)).status_code == 404
+
+    def test_only_the_last_operation_on_each_document_is_sent(self):
+        with self.app.app_context(), mock.patch.object(write_behind_queue_module, "bulk") as bulk:
+            bulk.return_value = ({"errors": False, "items": [
+                {"id": "2", "action": "index", "status": 201, "result": "created"},
+                {"id": "1", "action": "delete", "status": 200, "result": "deleted"},
+            ]}, 200)
+            write_behind_queue.put("test-index", "test-index", "index", "1", {"dmtext_id": "1"})
+            write_behind_queue.put("test-index", "test-index", "index", "2", {"dmtext_id": "2"})
+            write_behind_queue.put("test-index", "test-index", "delete", "1")
+            write_behind_queue.flush()
+
+        assert bulk.call_count == 1
+        index_name, _, operations = bulk.call_args[0]
+        assert index_name == "test-index"
+        assert list(operations) == [("index", "2", {"dmtext_id": "2"}), ("delete", "1", None)]
+
+    def test_writes_are_kept_until_elasticsearch_can_be_reached(self, tmp_path):
+        self.enable(DM_WRITE_BEHIND_FLUSH_INTERVAL=60, DM_WRITE_BEHIND_SPOOL_DIR=str(tmp_path))
+        service = make_service(id="1")
+        assert self.put(service).status_code == 202
+
+        with self.app.app_context(), mock.patch.object(es, "bulk", side_effect=ConnectionError("N/A", "refused", None)):
+            assert write_behind_queue.flush() == 1
+        assert self.client.delete(make_search_api_url(service)).status_code == 202
+
+        spool_path = tmp_path / "write-behind-{}.ndjson.sending".format(os.getpid())
+        assert [json.loads(line)["action"] for line in spool_path.read_text().splitlines()] == ["index"]
+        buffer = self.app.extensions["dm_write_behind_queue"]
+        assert [operation.action for operation in buffer._operations] == ["index", "delete"]
+
+        with self.app.app_context():
+            assert write_behind_queue.flush() == 0
+        assert self.client.get(make_search_api_url(service)).status_code == 404
+        assert list(tmp_path.iterdir()) == []
+
+    def test_operations_which_elasticsearch_rejects_are_dropped(self):
+        with self.app.app_context(), mock.patch.object(write_behind_queue_module, "bulk") as bulk:
+            bulk.return_value = ({"errors": True, "items": [
+                {"id": "1", "action": "index", "status": 400, "error": "mapper_parsing_exception: bad"},
+            ]}, 200)
+            write_behind_queue.put("test-index", "test-index", "index", "1", {"dmtext_id": "1"})
+
+            assert write_behind_queue.flush() == 0
+        assert not self.app.extensions["dm_write_behind_queue"]._operations
+
+    def test_operations_which_keep_failing_are_dead_lettered(self, tmp_path):
+        self.enable(DM_WRITE_BEHIND_FLUSH_INTERVAL=60, DM_WRITE_BEHIND_SPOOL_DIR=str(tmp_path),
+                    DM_WRITE_BEHIND_MAX_ATTEMPTS=2)
+        with self.app.app_context(), mock.patch.object(write_behind_queue_module, "bulk") as bulk, \
+                mock.patch.object(write_behind_queue_module, "WRITE_BEHIND_OPERATIONS_TOTAL") as operations_total:
+            bulk.return_value = ({"errors": True, "items": [
+                {"id": "1", "action": "index", "status": 500, "error": "illegal_state_exception: always"},
+            ]}, 200)
+            write_behind_queue.put("test-index", "test-index", "index", "1", {"dmtext_id": "1"})
+            assert write_behind_queue.flush() == 1
+
+            bulk.return_value = ({"errors": True, "items": [
+                {"id": "1", "action": "index", "status": 500, "error": "illegal_state_exception: always"},
+                {"id": "2", "action": "index", "status": 201, "result": "created"},
+            ]}, 200)
+            write_behind_queue.put("test-index", "test-index", "index", "2", {"dmtext_id": "2"})
+            assert write_behind_queue.flush() == 0
+
+        assert not self.app.extensions["dm_write_behind_queue"]._operations
+        operations_total.labels.assert_any_call("dead_lettered")
+        dead_letter_path = tmp_path / "write-behind-{}.ndjson.dead".format(os.getpid())
+        assert [json.loads(line) for line in dead_letter_path.read_text().splitlines()] == [{
+            "index_name": "test-index", "resolved_index_name": "test-index", "action": "index", "document_id": "1",
+            "document": {"dmtext_id": "1"}, "attempts": 2,
+        }]
+        assert [path.name for path in tmp_path.iterdir()] == [dead_letter_path.name]
+
+        # and they aren't replayed
+        with self.app.app_context():
+            assert list(self.app.extensions["dm_write_behind_queue"]._spool.claim_orphans()) == []
+
+    def test_writes_are_turned_away_when_the_queue_is_full(self):
+        self.enable(DM_WRITE_BEHIND_FLUSH_INTERVAL=60, DM_WRITE_BEHIND_MAX_QUEUE_SIZE=1,
+                    DM_WRITE_BEHIND_ENQUEUE_TIMEOUT=0)
+        service = make_service(id="1")
+
+        response = self.put(service)
+        assert response.status_code == 202
+
+        response = self.put(service)
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+
+        self.flush()
+        response = self.put(service)
+        assert response.status_code == 202
+
+    def test_queued_operations_are_spooled_until_sent(self, tmp_path):
+        self.enable(DM_WRITE_BEHIND_FLUSH_INTERVAL=60, DM_WRITE_BEHIND_SPOOL_DIR=str(tmp_path))
+
+        with self.app.app_context():
+            write_behind_queue.put("test-index", "test-index", "delete", "1")
+
+        spool_path = tmp_path / "write-behind-{}.ndjson".format(os.getpid())
+        assert [json.loads(line) for line in spool_path.read_text().splitlines()] == [{
+            "index_name": "test-index", "resolved_index_name": "test-index", "action": "delete", "document_id": "1",
+            "document": None, "attempts": 0,
+        }]
+
+        self.flush()
+        assert list(tmp_path.iterdir()) == []
+
+    def test_operations_spooled_by_dead_workers_are_replayed(self, tmp_path):
+        self.enable(DM_WRITE_BEHIND_FLUSH_INTERVAL=60, DM_WRITE_BEHIND_SPOOL_DIR=str(tmp_path))
+        dead_pid = 2 ** 22 + 1  # more than Linux's maximum pid
+        (tmp_path / "write-behind-{}.ndjson.claimed-{}".format(dead_pid - 1, dead_pid)).write_text(
+            json.dumps(QueuedOperation("test-index", "test-index", "delete", "0", None)._asdict()) + "\n"
+        )
+        (tmp_path / "write-behind-{}.ndjson".format(dead_pid)).write_text(
+            json.dumps(QueuedOperation("test-index", "test-index", "delete", "2", None)._asdict()) + "\n"
+        )
+        (tmp_path / "write-behind-{}.ndjson.sending".format(dead_pid)).write_text(
+            json.dumps(QueuedOperation("test-index", "test-index", "delete", "1", None)._asdict()) + "\n"
+        )
+
+        buffer = self.app.extensions["dm_write_behind_queue"]
+        with self.app.app_context():
+            buffer._replay_spool()
+
+        assert [operation.document_id for operation in buffer._operations] == ["0", "1", "2"]
+        assert [path.name for path in tmp_path.iterdir()] == ["write-behind-{}.ndjson".format(os.getpid())]
+
+    def test_writes_are_made_synchronously_when_disabled(self):
+        self.app.config["DM_WRITE_BEHIND"] = False
+        write_behind_queue.init_app(self.app)
+        service = make_service(id="1")
+
+        response = self.put(service)
+        assert response.status_code == 200
@@ -2,6 +2,8 @@
 Tests for the application infrastructure
 """
 import gzip
+import threading
+import time
 
 import mock
 import pytest
@@ -9,6 +11,7 @@ import pytest
 from flask import json
 from elasticsearch.exceptions import ConnectionError
 
+from app import elasticsearch_client
 from tests.helpers import BaseApplicationTest, BaseApplicationTestWithIndex
 
 
@@ -44,12 +47,42 @@ class TestApplication(BaseApplicationTest):
         with pytest.raises(ConnectionError):
             self.client.get('/')
 
-        # FlaskElasticsearch attaches the es client to the context in flask_elasticsearch.py
-        from flask import _app_ctx_stack
-
-        assert perform_request.call_count == 1 + _app_ctx_stack.top.elasticsearch.transport.max_retries
+        assert perform_request.call_count == 1 + self.app.extensions["dm_elasticsearch"].transport.max_retries
         assert perform_request.call_count == 1 + 3
 
+    def test_elasticsearch_client_is_shared_between_requests(self):
+        with self.app.app_context():
+            first_client = elasticsearch_client.transport
+        with self.app.app_context():
+            assert elasticsearch_client.transport is first_client
+
+    def test_elasticsearch_client_is_created_once_by_concurrent_requests(self):
+        def slow_client(**kwargs):
+            time.sleep(0.05)
+            return mock.Mock()
+
+        def get_transport():
+            with self.app.app_context():
+                transports.append(elasticsearch_client.transport)
+
+        transports = []
+        self.app.extensions["dm_elasticsearch"] = None
+        with mock.patch('app.Elasticsearch', side_effect=slow_client) as elasticsearch:
+            threads = [threading.Thread(target=get_transport) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert elasticsearch.call_count == 1
+        assert len(transports) == 8
+        assert all(transport is transports[0] for transport in transports)
+
+    def test_elasticsearch_client_connection_pool_size_is_configured(self):
+        with self.app.app_context():
+            connection = elasticsearch_client.transport.connection_pool.connections[0]
+        assert connection.pool.pool.maxsize == self.app.config["DM_ELASTICSEARCH_MAXSIZE"]
+
 
 class TestGzip(BaseApplicationTestWithIndex):
     def setup(self):
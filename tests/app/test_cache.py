@@ -0,0 +1,213 @@
+import sys
+
+import mock
+from flask import Flask
+
+from app.cache import InProcessCacheBackend, LRUCache, RedisCacheBackend, RefreshingCache
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache(object):
+    def setup(self):
+        self.clock = FakeClock()
+
+    def test_get_returns_default_for_missing_key(self):
+        cache = LRUCache(max_size=2, clock=self.clock)
+        assert cache.get("missing") is None
+        assert cache.get("missing", "default") == "default"
+
+    def test_set_and_get(self):
+        cache = LRUCache(max_size=2, clock=self.clock)
+        cache.set("a", 1)
+        assert cache.get("a") == 1
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LRUCache(max_size=2, clock=self.clock)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+        assert cache.get("c") == 3
+        assert len(cache) == 2
+
+    def test_entries_expire_after_ttl(self):
+        cache = LRUCache(max_size=2, ttl=10, clock=self.clock)
+        cache.set("a", 1)
+
+        self.clock.now = 9.9
+        assert cache.get("a") == 1
+
+        self.clock.now = 10
+        assert cache.get("a") is None
+        assert len(cache) == 0
+
+    def test_per_entry_ttl_overrides_default(self):
+        cache = LRUCache(max_size=2, ttl=10, clock=self.clock)
+        cache.set("a", 1, ttl=1)
+
+        self.clock.now = 1
+        assert cache.get("a") is None
+
+    def test_no_ttl_means_no_expiry(self):
+        cache = LRUCache(max_size=2, clock=self.clock)
+        cache.set("a", 1)
+
+        self.clock.now = 1e9
+        assert cache.get("a") == 1
+
+    def test_max_size_zero_disables_cache(self):
+        cache = LRUCache(max_size=0, clock=self.clock)
+        cache.set("a", 1)
+        assert cache.get("a") is None
+
+    def test_delete_where(self):
+        cache = LRUCache(max_size=3, clock=self.clock)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.set("c", 3)
+
+        cache.delete_where(lambda key, value: key == "a" or value == 3)
+
+        assert cache.get("a") is None
+        assert cache.get("b") == 2
+        assert cache.get("c") is None
+
+    def test_setdefault_keeps_any_unexpired_value(self):
+        cache = LRUCache(max_size=2, ttl=10, clock=self.clock)
+        assert cache.setdefault("a", 1) == 1
+        assert cache.setdefault("a", 2) == 1
+
+        self.clock.now = 10
+        assert cache.setdefault("a", 3) == 3
+
+
+class TestInProcessCacheBackend(object):
+    def test_unexpiring_values_are_bounded(self):
+        backend = InProcessCacheBackend(max_size=2, ttl=10, max_unexpiring=2)
+        backend.set("a", 1, expire=False)
+        assert backend.add("b", 2) == 2
+        assert backend.add("c", 3) == 3
+
+        assert backend.get("a") is None
+        assert backend.add("b", 4) == 2
+
+
+class TestRedisCacheBackend(object):
+    def setup(self):
+        self.redis = mock.Mock()
+        self.redis.RedisError = type("RedisError", (Exception,), {})
+        self.redis_modules_patch = mock.patch.dict(sys.modules, {"redis": self.redis})
+        self.redis_modules_patch.start()
+        self.backend = RedisCacheBackend("redis://localhost", ttl=30)
+        self.client = self.redis.Redis.from_url.return_value
+
+    def teardown(self):
+        self.redis_modules_patch.stop()
+
+    def test_values_are_stored_as_json_with_ttl(self):
+        self.backend.set("a", {"b": [1, 2]})
+        self.client.set.assert_called_once_with("dm-search-api:a", '{"b": [1, 2]}', ex=30)
+
+        self.client.get.return_value = b'{"b": [1, 2]}'
+        assert self.backend.get("a") == {"b": [1, 2]}
+        self.client.get.assert_called_once_with("dm-search-api:a")
+
+    def test_missing_key(self):
+        self.client.get.return_value = None
+        assert self.backend.get("a") is None
+
+    def test_values_can_be_stored_without_ttl(self):
+        self.backend.set("a", 1, expire=False)
+        self.client.set.assert_called_once_with("dm-search-api:a", '1', ex=None)
+
+    def test_add_keeps_any_value_already_stored(self):
+        self.client.set.return_value = True
+        assert self.backend.add("a", 1) == 1
+        self.client.set.assert_called_once_with("dm-search-api:a", '1', nx=True)
+
+        self.client.set.return_value = None
+        self.client.get.return_value = b'2'
+        assert self.backend.add("a", 1) == 2
+
+    def test_redis_errors_are_treated_as_misses(self):
+        self.client.get.side_effect = self.redis.RedisError("connection refused")
+        self.client.set.side_effect = self.redis.RedisError("connection refused")
+
+        with Flask(__name__).app_context():
+            self.backend.set("a", 1)
+            assert self.backend.get("a") is None
+
+
+class TestRefreshingCache(object):
+    def setup(self):
+        self.clock = FakeClock()
+        self.cache = RefreshingCache(ttl=10, max_stale=60, clock=self.clock)
+        self.compute = mock.Mock(side_effect=[1, 2, 3])
+        self.request_context = Flask(__name__).test_request_context()
+        self.request_context.push()
+        # background refreshes are started by the test, when it's ready for them
+        self.thread_patch = mock.patch("app.cache.threading.Thread")
+        self.thread = self.thread_patch.start()
+
+    def teardown(self):
+        self.thread_patch.stop()
+        self.request_context.pop()
+
+    def run_background_refresh(self):
+        (_, kwargs), = self.thread.call_args_list
+        kwargs["target"]()
+        self.thread.reset_mock()
+
+    def test_value_is_computed_on_first_lookup_and_then_served_from_the_cache(self):
+        assert self.cache.get("a", self.compute) == 1
+        self.clock.now = 9.9
+        assert self.cache.get("a", self.compute) == 1
+
+        assert self.compute.call_count == 1
+        assert not self.thread.called
+
+    def test_stale_value_is_served_while_being_recomputed_in_the_background(self):
+        self.cache.get("a", self.compute)
+        self.clock.now = 10
+
+        assert self.cache.get("a", self.compute) == 1
+        assert self.cache.get("a", self.compute) == 1
+        assert self.thread.call_count == 1  # only one refresh at a time
+
+        self.run_background_refresh()
+        assert self.cache.get("a", self.compute) == 2
+        assert not self.thread.called
+
+    def test_value_is_recomputed_in_the_foreground_once_too_stale(self):
+        self.cache.get("a", self.compute)
+        self.clock.now = 60
+
+        assert self.cache.get("a", self.compute) == 2
+        assert not self.thread.called
+
+    def test_failed_background_refresh_leaves_stale_value_to_be_retried(self):
+        self.compute.side_effect = [1, Exception("elasticsearch is down"), 3]
+        self.cache.get("a", self.compute)
+        self.clock.now = 10
+
+        self.cache.get("a", self.compute)
+        self.run_background_refresh()
+
+        assert self.cache.get("a", self.compute) == 1
+        self.run_background_refresh()
+        assert self.cache.get("a", self.compute) == 3
+
+    def test_clear(self):
+        self.cache.get("a", self.compute)
+        self.cache.clear()
+        assert self.cache.get("a", self.compute) == 2
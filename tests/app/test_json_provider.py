@@ -0,0 +1,143 @@
+import datetime
+import json
+import sys
+
+import mock
+import pytest
+from flask import jsonify, request
+from werkzeug.datastructures import MultiDict
+
+from app.json_provider import json_provider
+from app.main.services import search_service
+from tests.helpers import BaseApplicationTest, BaseApplicationTestWithIndex, make_search_api_url, make_service
+
+with open("example_es_responses/search_results.json") as search_results:
+    SEARCH_RESULTS_JSON = json.load(search_results)
+
+
+class TestJSONProvider(BaseApplicationTest):
+    def setup(self):
+        super().setup()
+        self.orjson = pytest.importorskip("orjson")
+        self.app.config.update(DEBUG=False, JSON_SORT_KEYS=False, JSON_AS_ASCII=False)
+
+    def test_orjson_is_used_if_installed(self):
+        assert self.app.extensions["dm_json_provider"] is self.orjson
+
+    def test_orjson_is_not_used_if_not_installed(self):
+        with mock.patch.dict(sys.modules, {"orjson": None}):
+            json_provider.init_app(self.app)
+        assert self.app.extensions["dm_json_provider"] is None
+
+        with self.app.app_context():
+            assert json_provider.jsonify(a=1).data == b'{"a":1}\n'
+            assert json_provider.loads('{"a": 1}') == {"a": 1}
+
+    def test_orjson_is_not_used_if_disabled(self):
+        self.app.config["DM_FAST_JSON"] = False
+        json_provider.init_app(self.app)
+        assert self.app.extensions["dm_json_provider"] is None
+
+    @pytest.mark.parametrize("data", (
+        SEARCH_RESULTS_JSON,
+        {"date": datetime.datetime(2020, 1, 2, 3, 4, 5), "text": "Naïve café ✓", "float": 0.1, "nested": [None, True]},
+    ))
+    def test_jsonify_output_is_the_same_as_flasks(self, data):
+        with self.app.app_context(), mock.patch.object(self.orjson, "dumps", wraps=self.orjson.dumps) as dumps:
+            response = json_provider.jsonify(data)
+            assert dumps.called
+
+            expected = jsonify(data)
+            assert response.data == expected.data
+            assert response.mimetype == expected.mimetype
+
+    def test_jsonify_serializes_subclasses_of_builtin_types_as_flask_does(self):
+        data = {
+            "query": MultiDict([("q", "cloud"), ("filter_a", "x"), ("filter_a", "y")]),
+            "ids": type("Ids", (list,), {})(["1"]),
+        }
+        with self.app.app_context():
+            assert json_provider.jsonify(data).data == jsonify(data).data == (
+                b'{"query":{"q":"cloud","filter_a":"x"},"ids":["1"]}\n'
+            )
+
+    @pytest.mark.parametrize("data", (
+        {"_score": 1.2e-05},
+        {"hits": [{"_score": -3e-07}, {"_score": 1e16}, {"_score": 1.5e20}]},
+    ))
+    def test_jsonify_output_has_the_same_values_as_flasks_for_floats_in_exponent_notation(self, data):
+        with self.app.app_context():
+            assert json.loads(json_provider.jsonify(data).data) == json.loads(jsonify(data).data) == data
+
+    def test_jsonify_writes_floats_which_are_not_finite_as_null(self):
+        with self.app.app_context():
+            assert json_provider.jsonify({"floats": [float("nan"), float("inf")]}).data == b'{"floats":[null,null]}\n'
+
+    @pytest.mark.parametrize("config", (
+        {"JSON_SORT_KEYS": True},
+        {"JSON_AS_ASCII": True},
+        {"JSONIFY_PRETTYPRINT_REGULAR": True},
+        {"DEBUG": True},
+    ))
+    def test_flask_is_used_to_serialize_if_orjson_would_give_different_output(self, config):
+        self.app.config.update(config)
+        with self.app.app_context(), mock.patch.object(self.orjson, "dumps") as dumps:
+            assert json_provider.jsonify(SEARCH_RESULTS_JSON).data == jsonify(SEARCH_RESULTS_JSON).data
+            json_provider.dumps(SEARCH_RESULTS_JSON)
+        assert not dumps.called
+
+    def test_flask_is_used_to_serialize_what_orjson_cannot(self):
+        with self.app.app_context():
+            assert json_provider.dumps({"big": 2 ** 64}) == json.dumps({"big": 2 ** 64})
+            assert json_provider.jsonify(big=2 ** 64).data == b'{"big":18446744073709551616}\n'
+
+    def test_jsonify_args_and_kwargs(self):
+        with self.app.app_context():
+            assert json.loads(json_provider.jsonify(a=1, b=2).data) == {"a": 1, "b": 2}
+            assert json.loads(json_provider.jsonify(1, 2).data) == [1, 2]
+            with pytest.raises(TypeError):
+                json_provider.jsonify(1, a=2)
+
+    def test_loads_falls_back_to_flask_for_what_orjson_cannot_parse(self):
+        with self.app.app_context():
+            assert json_provider.loads('{"big": 18446744073709551616}') == {"big": 2 ** 64}
+            with pytest.raises(ValueError):
+                json_provider.loads("{")
+
+    def test_get_json(self):
+        with self.app.test_request_context(data=b'{"document": {"id": "1"}}', content_type="application/json"):
+            assert json_provider.get_json(request) == {"document": {"id": "1"}}
+
+        with self.app.test_request_context(data=b'{"document": {"id": "1"}}', content_type="text/plain"):
+            assert json_provider.get_json(request) is None
+
+
+class TestSearchResponseSerialization(BaseApplicationTestWithIndex):
+    def setup(self):
+        super().setup()
+        self.orjson = pytest.importorskip("orjson")
+        # as in the live config
+        self.app.config.update(DEBUG=False, JSON_SORT_KEYS=False, JSON_AS_ASCII=False)
+        for i, name in enumerate(("Cloud hosting", "Hébergement cloud", "クラウド cloud")):
+            service = make_service(id=str(i), serviceName=name)
+            response = self.client.put(
+                make_search_api_url(service), data=json.dumps(service), content_type='application/json',
+            )
+            assert response.status_code == 200
+        with self.app.app_context():
+            search_service.refresh('test-index')
+        self.app.config["DM_SEARCH_RESPONSE_CACHE_BACKEND"] = None
+
+    def test_search_response_is_the_same_serialized_with_orjson_as_with_flask(self):
+        url = '/test-index/services/search?q=cloud&filter_lot=LoT'
+        with mock.patch.object(self.orjson, "dumps", wraps=self.orjson.dumps) as dumps:
+            fast_response = self.client.get(url)
+        assert dumps.called
+
+        self.app.extensions["dm_json_provider"] = None
+        flask_response = self.client.get(url)
+
+        assert fast_response.status_code == flask_response.status_code == 200
+        assert len(fast_response.json["documents"]) == 3
+        assert fast_response.data == flask_response.data
+        assert fast_response.mimetype == flask_response.mimetype
@@ -0,0 +1,204 @@
+import json
+
+import mock
+import pytest
+
+from elasticsearch import TransportError
+
+from app.mapping import get_aggregation_sizes, get_mapping, load_mapping_definition, mapping_cache, Mapping, \
+    MappingNotFound
+from tests.helpers import BaseApplicationTest
+from tests.app.test_metrics import load_prometheus_metrics
+
+
+class TestGetMapping(BaseApplicationTest):
+    def setup(self):
+        super().setup()
+        self.es_patch = mock.patch('app.mapping.es')
+        self.es = self.es_patch.start()
+        self.es.indices.get_mapping.return_value = {
+            "test-index-2020-01-01": {"mappings": load_mapping_definition(self.default_mapping_name)["mappings"]},
+        }
+
+    def teardown(self):
+        self.es_patch.stop()
+        super().teardown()
+
+    def test_get_mapping_resolves_index_name(self):
+        with self.app.app_context():
+            mapping = get_mapping("test-alias", "services")
+
+        self.es.indices.get_mapping.assert_called_once_with(index="test-alias")
+        assert mapping.index_name == "test-index-2020-01-01"
+        assert mapping.mapping_type == "services"
+        assert "serviceName" in mapping.fields_by_prefix["dmtext"]
+
+    def test_get_mapping_is_cached(self):
+        with self.app.app_context():
+            first = get_mapping("test-alias", "services")
+            second = get_mapping("test-alias", "services")
+
+        assert first is second
+        assert self.es.indices.get_mapping.call_count == 1
+
+    def test_get_mapping_with_wrong_doc_type_raises_even_when_cached(self):
+        with self.app.app_context():
+            get_mapping("test-alias", "services")
+            with pytest.raises(MappingNotFound):
+                get_mapping("test-alias", "briefs")
+
+        assert self.es.indices.get_mapping.call_count == 1
+
+    def test_cache_is_not_shared_between_apps(self):
+        with self.app.app_context():
+            get_mapping("test-alias", "services")
+
+        other_app = type(self.app)(__name__)
+        other_app.config.update(self.app.config)
+        mapping_cache.init_app(other_app)
+        with other_app.app_context():
+            get_mapping("test-alias", "services")
+
+        assert self.es.indices.get_mapping.call_count == 2
+
+    @pytest.mark.parametrize("invalidated_name", ("test-alias", "test-index-2020-01-01"))
+    def test_invalidate_by_requested_or_resolved_name(self, invalidated_name):
+        with self.app.app_context():
+            get_mapping("test-alias", "services")
+            mapping_cache.invalidate(invalidated_name)
+            get_mapping("test-alias", "services")
+
+        assert self.es.indices.get_mapping.call_count == 2
+
+    def test_invalidate_leaves_unrelated_entries(self):
+        with self.app.app_context():
+            get_mapping("test-alias", "services")
+            mapping_cache.invalidate("some-other-index")
+            get_mapping("test-alias", "services")
+
+        assert self.es.indices.get_mapping.call_count == 1
+
+    def test_cache_can_be_disabled(self):
+        self.app.config["DM_MAPPING_CACHE_MAX_SIZE"] = 0
+        mapping_cache.init_app(self.app)
+        with self.app.app_context():
+            get_mapping("test-alias", "services")
+            get_mapping("test-alias", "services")
+
+        assert self.es.indices.get_mapping.call_count == 2
+
+    @pytest.mark.parametrize("body", (
+        {"type": "alias", "target": "test-index-2020-01-02"},
+        {"type": "index", "mapping": "services"},
+    ))
+    def test_admin_create_invalidates_cache(self, body):
+        with self.app.app_context():
+            get_mapping("test-alias", "services")
+
+        with mock.patch('app.main.views.admin.create_alias', return_value=("acknowledged", 200)), \
+                mock.patch('app.main.views.admin.create_index', return_value=("acknowledged", 200)):
+            response = self.client.put("/test-alias", data=json.dumps(body), content_type="application/json")
+        assert response.status_code == 200
+
+        with self.app.app_context():
+            get_mapping("test-alias", "services")
+
+        assert self.es.indices.get_mapping.call_count == 2
+
+    def test_admin_delete_invalidates_cache(self):
+        with self.app.app_context():
+            get_mapping("test-index-2020-01-01", "services")
+
+        with mock.patch('app.main.views.admin.status_for_index', return_value=({"aliases": []}, 200)), \
+                mock.patch('app.main.views.admin.delete_index', return_value=("acknowledged", 200)):
+            response = self.client.delete("/test-index-2020-01-01")
+        assert response.status_code == 200
+
+        with self.app.app_context():
+            get_mapping("test-index-2020-01-01", "services")
+
+        assert self.es.indices.get_mapping.call_count == 2
+
+    def test_cache_hits_and_misses_are_counted(self):
+        def lookups(result):
+            metrics = load_prometheus_metrics(self.client.get('/_metrics').data)
+            return int(metrics.get(
+                'search_api_mapping_cache_lookups_total{{result="{}"}}'.format(result).encode(), 0
+            ))
+
+        initial_hits, initial_misses = lookups("hit"), lookups("miss")
+        with self.app.app_context():
+            for _ in range(3):
+                get_mapping("test-alias", "services")
+
+        assert lookups("hit") - initial_hits == 2
+        assert lookups("miss") - initial_misses == 1
+
+
+class TestGetAggregationSizes(BaseApplicationTest):
+    def setup(self):
+        super().setup()
+        self.es_patch = mock.patch('app.mapping.es')
+        self.es = self.es_patch.start()
+        self.es.search.return_value = {"aggregations": {
+            "lot": {"value": 4},
+            "serviceCategories": {"value": 700},
+        }}
+        self.app.config["DM_AGGREGATION_MAX_SIZE"] = 1000
+
+    def teardown(self):
+        self.es_patch.stop()
+        super().teardown()
+
+    def mapping(self, aggregation_size_hints=None, index_name="test-index-2020-01-01"):
+        definition = load_mapping_definition(self.default_mapping_name)
+        if aggregation_size_hints is not None:
+            definition["mappings"]["_meta"]["dm_aggregation_sizes"] = aggregation_size_hints
+        return Mapping(definition, "services", index_name=index_name)
+
+    def test_sizes_are_derived_from_probed_cardinality(self):
+        with self.app.app_context():
+            sizes = get_aggregation_sizes(self.mapping())
+
+        assert sizes == {"lot": 10, "serviceCategories": 1000}
+        assert self.es.search.call_args[1]["index"] == "test-index-2020-01-01"
+        assert self.es.search.call_args[1]["body"]["aggregations"]["lot"] == {
+            "cardinality": {"field": "dmagg_lot"},
+        }
+
+    def test_probe_is_made_once_per_mapping(self):
+        mapping = self.mapping()
+        with self.app.app_context():
+            get_aggregation_sizes(mapping)
+            get_aggregation_sizes(mapping)
+
+        assert self.es.search.call_count == 1
+
+    def test_hints_are_used_instead_of_probing(self):
+        with self.app.app_context():
+            sizes = get_aggregation_sizes(self.mapping({"lot": 5, "serviceCategories": 5000}))
+
+        assert sizes == {"lot": 5, "serviceCategories": 1000}
+        assert not self.es.search.called
+
+    def test_only_fields_without_hints_are_probed(self):
+        with self.app.app_context():
+            sizes = get_aggregation_sizes(self.mapping({"lot": 5}))
+
+        assert sizes == {"lot": 5, "serviceCategories": 1000}
+        assert self.es.search.call_args[1]["body"]["aggregations"].keys() == {"serviceCategories"}
+
+    def test_failed_probe_falls_back_to_max_size_and_is_retried(self):
+        self.es.search.side_effect = TransportError(500, "oops")
+        mapping = self.mapping()
+        with self.app.app_context():
+            assert get_aggregation_sizes(mapping) == {"lot": 1000, "serviceCategories": 1000}
+            get_aggregation_sizes(mapping)
+
+        assert self.es.search.call_count == 2
+
+    def test_mapping_not_from_an_index_gets_max_size(self):
+        with self.app.app_context():
+            assert get_aggregation_sizes(self.mapping(index_name=None)) == {"lot": 1000, "serviceCategories": 1000}
+
+        assert not self.es.search.called
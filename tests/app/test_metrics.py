@@ -1,6 +1,7 @@
+import json
 import re
 
-from tests.helpers import BaseApplicationTest
+from tests.helpers import BaseApplicationTest, BaseApplicationTestWithIndex, make_service
 
 
 def load_prometheus_metrics(response_bytes):
@@ -55,3 +56,62 @@ class TestMetricsPageRegistersPageViews(BaseApplicationTest):
 
         assert expected_metric_name in results
         assert metric_value - initial_metric_value == 3
+
+
+class TestRequestStageMetrics(BaseApplicationTestWithIndex):
+
+    def test_search_records_duration_of_each_stage(self):
+        res = self.client.get('/test-index/services/search?q=serviceName')
+        assert res.status_code == 200
+
+        metrics_response = self.client.get('/_metrics')
+        results = load_prometheus_metrics(metrics_response.data)
+
+        labels = b'endpoint="main.search",index="test-index"'
+        for stage in (b"mapping_lookup", b"query_construction", b"result_conversion", b"serialization"):
+            assert (
+                b'search_api_request_stage_duration_seconds_count{%s,stage="%s"}' % (labels, stage)
+            ) in results
+        assert b'search_api_elasticsearch_request_duration_seconds_count{%s,operation="search"}' % labels in results
+        assert b'search_api_elasticsearch_took_seconds_count{%s}' % labels in results
+
+    def test_elasticsearch_requests_are_recorded_by_operation(self):
+        res = self.client.get('/test-index')
+        assert res.status_code == 200
+
+        metrics_response = self.client.get('/_metrics')
+        results = load_prometheus_metrics(metrics_response.data)
+
+        assert (
+            b'search_api_elasticsearch_request_duration_seconds_count'
+            b'{endpoint="main.status",index="test-index",operation="stats"}'
+        ) in results
+
+    def test_indexes_that_are_not_found_are_labelled_other(self):
+        res = self.client.get('/not-an-index/services/search?q=serviceName')
+        assert res.status_code == 404
+
+        metrics_response = self.client.get('/_metrics')
+        results = load_prometheus_metrics(metrics_response.data)
+
+        assert (
+            b'search_api_request_stage_duration_seconds_count'
+            b'{endpoint="main.search",index="other",stage="mapping_lookup"}'
+        ) in results
+        assert not any(b'not-an-index' in metric for metric in results)
+
+    def test_bulk_requests_are_timed_per_chunk_sent(self):
+        labels = b'{endpoint="main.bulk_update",index="test-index",operation="bulk"}'
+        metric = b'search_api_elasticsearch_request_duration_seconds_count' + labels
+        initial_count = int(load_prometheus_metrics(self.client.get('/_metrics').data).get(metric, 0))
+        self.app.config['DM_BULK_INDEX_CHUNK_SIZE'] = 2
+
+        res = self.client.post(
+            '/test-index/services/_bulk',
+            data=json.dumps([{"id": str(i), "document": make_service(id=str(i))["document"]} for i in range(5)]),
+            content_type='application/json',
+        )
+        assert res.status_code == 200
+
+        results = load_prometheus_metrics(self.client.get('/_metrics').data)
+        assert int(results[metric]) - initial_count == 3
@@ -1,6 +1,8 @@
+import mock
 from flask import json
 
-from tests.helpers import BaseApplicationTest
+from app import elasticsearch_client as es
+from tests.helpers import BaseApplicationTest, BaseApplicationTestWithIndex
 
 
 class TestSearchIndexes(BaseApplicationTest):
@@ -130,3 +132,101 @@ class TestSearchIndexes(BaseApplicationTest):
 
         assert response.status_code == 400
         assert response.json["error"] == "Mapping definition named 'some-bad-mapping' not found."
+
+
+class TestSlowQueries(BaseApplicationTestWithIndex):
+    def test_most_expensive_fingerprints(self):
+        self.client.get('/test-index/services/search?q=email&filter_lot=cloud-software')
+        self.client.get('/test-index/services/search?q=hosting&filter_lot=cloud-hosting')
+        self.client.get('/test-index/services/aggregations?aggregations=lot')
+
+        response = self.client.get('/_slow-queries')
+        assert response.status_code == 200
+        fingerprints = response.json["fingerprints"]
+        assert sorted(entry["count"] for entry in fingerprints) == [1, 2]
+        assert {
+            "index": "test-index",
+            "search": True,
+            "keywords": True,
+            "filters": ["lot"],
+            "aggregations": [],
+            "disjunctive": False,
+            "idOnly": False,
+            "page": "<=1",
+        } in [entry["fingerprint"] for entry in fingerprints]
+
+        response = self.client.get('/_slow-queries?limit=1')
+        assert len(response.json["fingerprints"]) == 1
+
+    def test_invalid_limit(self):
+        response = self.client.get('/_slow-queries?limit=foo')
+        assert response.status_code == 400
+
+    def test_requires_authentication(self):
+        self.do_not_provide_access_token()
+        response = self.client.get('/_slow-queries')
+        assert response.status_code == 401
+
+
+class TestReindex(BaseApplicationTestWithIndex):
+    def test_starting_a_reindex(self):
+        with mock.patch('app.main.views.admin.start_reindex', return_value=({"step": "reindexing"}, 202)) as start:
+            response = self.client.post('/test-alias/_reindex', data=json.dumps({
+                "mapping": self.default_mapping_name,
+                "target": "test-index-2",
+            }), content_type="application/json")
+
+        assert response.status_code == 202
+        assert response.json["reindex"] == {"step": "reindexing"}
+        start.assert_called_once_with("test-alias", "test-index-2", self.default_mapping_name)
+
+    def test_reindex_needs_a_mapping(self):
+        response = self.client.post('/test-alias/_reindex', data=json.dumps({
+            "target": "test-index-2",
+        }), content_type="application/json")
+
+        assert response.status_code == 400
+
+    def test_progress_of_an_index_not_created_by_a_reindex(self):
+        response = self.client.get('/test-index/_reindex')
+
+        assert response.status_code == 404
+        assert response.json["error"] == "Index 'test-index' was not created by a reindex"
+
+    def test_resuming_a_reindex(self):
+        with mock.patch('app.main.views.admin.resume_reindex', return_value=({"step": "warming"}, 202)) as resume:
+            response = self.client.post('/test-index-2/_reindex/resume')
+
+        assert response.status_code == 202
+        assert response.json["reindex"] == {"step": "warming"}
+        resume.assert_called_once_with("test-index-2")
+
+
+class TestBulkLoad(BaseApplicationTestWithIndex):
+    def _index_settings(self):
+        with self.app.app_context():
+            settings = es.indices.get_settings(index='test-index')['test-index']['settings']['index']
+        return settings['number_of_replicas'], settings.get('refresh_interval')
+
+    def test_entering_and_leaving_bulk_load_mode(self):
+        original_settings = self._index_settings()
+
+        response = self.client.put('/test-index/_bulk-load')
+        assert response.status_code == 200
+        assert self._index_settings() == ('0', '-1')
+
+        # entering it again doesn't lose the original settings
+        assert self.client.put('/test-index/_bulk-load').status_code == 200
+
+        response = self.client.delete('/test-index/_bulk-load?force-merge')
+        assert response.status_code == 200
+        assert self._index_settings() == original_settings
+
+    def test_leaving_bulk_load_mode_when_not_in_it(self):
+        response = self.client.delete('/test-index/_bulk-load')
+
+        assert response.status_code == 400
+        assert response.json["error"] == "Index 'test-index' is not in bulk load mode"
+
+    def test_bulk_load_of_missing_index(self):
+        assert self.client.put('/test-missing/_bulk-load').status_code == 404
@@ -1,5 +1,9 @@
 
+import gzip
 import json
+
+import mock
+
 from tests.helpers import BaseApplicationTestWithIndex
 
 from app import elasticsearch_client
@@ -55,3 +59,31 @@ class TestMeta(BaseApplicationTestWithIndex):
 
         assert response.status_code == 200
         assert b"dot-index" not in response.data
+
+    def test_home_is_served_gzipped_if_accepted(self):
+        response = self.client.get('/', headers={"Accept-Encoding": "gzip"})
+
+        assert response.status_code == 200
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(response.data) == self.client.get('/').data
+
+    def test_home_is_cached_until_an_alias_is_created(self):
+        with self.app.app_context():
+            cat = elasticsearch_client.cat
+
+        with mock.patch.object(cat, 'aliases', wraps=cat.aliases) as aliases:
+            self.client.get('/')
+            self.client.get('/')
+            assert aliases.call_count == 1
+
+        self.client.put('/another-alias', data=json.dumps({
+            "type": "alias",
+            "target": "test-index",
+        }), content_type="application/json")
+        try:
+            assert {"href": "http://localhost/another-alias/services/search",
+                    "rel": "query.gdm.alias",
+                    } in self.client.get('/').json['links']
+        finally:
+            with self.app.app_context():
+                elasticsearch_client.indices.delete_alias(name="another-alias", index="test-index")
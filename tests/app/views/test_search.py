@@ -127,6 +127,62 @@ class TestSearchEndpoint(BaseSearchTestWithServices):
                 '/test-index/services/search?q=serviceName&page=foo')
             assert response.status_code == 400
 
+    @pytest.mark.parametrize("id_only", (False, True))
+    def test_cursor_pagination_visits_every_result_once(self, id_only):
+        with self.app.app_context():
+            self.app.config['DM_SEARCH_PAGE_SIZE'] = '3'
+            self.app.config['DM_ID_ONLY_SEARCH_PAGE_SIZE_MULTIPLIER'] = '1'
+
+            ids, pages = [], 0
+            url = '/test-index/services/search?q=serviceName&cursor={}'.format('&idOnly=True' if id_only else '')
+            while url:
+                response = self.client.get(url)
+                assert response.status_code == 200
+                assert "prev" not in response.json['links']
+                ids.extend(document["id"] for document in response.json['documents'])
+                pages += 1
+                url = response.json['links'].get('next')
+
+        assert sorted(ids) == sorted(str(i) for i in range(10))
+        assert pages == 4
+
+    def test_point_in_time_is_closed_after_the_last_page(self):
+        self.app.config['DM_SEARCH_PAGE_SIZE'] = '3'
+        self.app.config['DM_SEARCH_CURSOR_USE_PIT'] = True
+        closed = []
+
+        with self.app.app_context():
+            close_point_in_time = es.close_point_in_time
+            with mock.patch.object(
+                es, 'close_point_in_time', side_effect=lambda **kwargs: closed.append(close_point_in_time(**kwargs)),
+            ):
+                url = '/test-index/services/search?q=serviceName&cursor='
+                while url:
+                    response = self.client.get(url)
+                    assert response.status_code == 200
+                    url = response.json['links'].get('next')
+                    assert not closed if url else closed
+
+        assert [result["succeeded"] for result in closed] == [True]
+
+    def test_cursor_links_keep_other_query_args(self):
+        with self.app.app_context():
+            self.app.config['DM_SEARCH_PAGE_SIZE'] = '3'
+            response = self.client.get('/test-index/services/search?q=serviceName&cursor=')
+
+        assert "q=serviceName" in response.json['links']['next']
+        assert "page=" not in response.json['links']['next']
+
+    def test_should_get_400_response_on_cursor_with_page(self):
+        response = self.client.get('/test-index/services/search?q=serviceName&cursor=&page=2')
+        assert response.status_code == 400
+
+    @pytest.mark.parametrize("cursor", ("not-a-cursor", "e30", "W10"))
+    def test_should_get_400_response_on_invalid_cursor(self, cursor):
+        response = self.client.get('/test-index/services/search?q=serviceName&cursor={}'.format(cursor))
+        assert response.status_code == 400
+        assert "Invalid cursor" in response.json["error"]
+
     @pytest.mark.parametrize('page_size, multiplier, expected_count',
                              (
                                  ('1', '5', 5),
@@ -155,6 +211,135 @@ class TestSearchEndpoint(BaseSearchTestWithServices):
             assert set(response_json['documents'][0].keys()) == {'id'}
 
 
+class TestExport(BaseSearchTestWithServices):
+    def export(self, query_string=""):
+        response = self.client.get('/test-index/services/export?{}'.format(query_string))
+        assert response.status_code == 200
+        assert response.mimetype == "application/x-ndjson"
+        assert response.is_streamed
+        return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    def test_exports_every_id_across_scroll_pages(self):
+        self.app.config['DM_EXPORT_PAGE_SIZE'] = 3
+
+        documents = self.export("idOnly=true")
+
+        assert sorted(documents, key=lambda document: int(document["id"])) == [{"id": str(i)} for i in range(10)]
+
+    def test_exports_documents_without_prefixes(self):
+        documents = self.export("q=serviceName")
+
+        assert len(documents) == 10
+        assert documents[0]["serviceName"]
+        assert not any("_" in key for key in documents[0])
+        assert "highlight" not in documents[0]
+
+    def test_export_applies_filters(self):
+        lot = self.client.get('/test-index/services/0').json["services"]["_source"]["dmtext_lot"]
+        searched = self.client.get('/test-index/services/search?idOnly=true&filter_lot={}'.format(lot)).json
+
+        documents = self.export("idOnly=true&filter_lot={}".format(lot))
+
+        assert sorted(document["id"] for document in documents) == sorted(
+            document["id"] for document in searched["documents"]
+        )
+
+    def test_export_is_not_compressed(self):
+        response = self.client.get('/test-index/services/export', headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in response.headers
+
+    def test_export_of_missing_index_is_404(self):
+        response = self.client.get('/no-such-index/services/export')
+        assert response.status_code == 404
+
+
+class TestConditionalGet(BaseSearchTestWithServices):
+    def setup(self):
+        super().setup()
+        self.app.config["DM_SEARCH_RESPONSE_CACHE_SETTLE_TIME"] = 0
+        # as though it were the redis backend, shared by every worker
+        self.app.extensions["dm_search_response_cache"].shared = True
+
+    @pytest.mark.parametrize("url, es_method", (
+        ('/test-index/services/search?q=serviceName', 'search'),
+        ('/test-index/services/aggregations?aggregations=lot', 'search'),
+        ('/test-index/services/1', 'get'),
+    ))
+    def test_if_none_match_with_current_etag_is_answered_without_elasticsearch(self, url, es_method):
+        response = self.client.get(url)
+        assert response.status_code == 200
+        assert response.headers["Cache-Control"] == "no-cache"
+        etag, _ = response.get_etag()
+        assert etag
+
+        with self.app.app_context(), mock.patch.object(es, es_method) as es_method_mock:
+            response = self.client.get(url, headers={"If-None-Match": '"{}"'.format(etag)})
+
+            assert response.status_code == 304
+            assert response.get_etag() == (etag, False)
+            assert response.headers["Cache-Control"] == "no-cache"
+            assert not es_method_mock.called
+
+    def test_etag_depends_on_query(self):
+        first = self.client.get('/test-index/services/search?q=serviceName').get_etag()
+        assert self.client.get('/test-index/services/search?q=serviceName').get_etag() == first
+        assert self.client.get('/test-index/services/search?q=serviceName&page=2').get_etag() != first
+
+    def test_etag_changes_when_index_is_written_to(self):
+        url = '/test-index/services/search?q=serviceName'
+        etag, _ = self.client.get(url).get_etag()
+
+        service = make_service(id="10")
+        self.client.put(make_search_api_url(service), data=json.dumps(service), content_type='application/json')
+
+        response = self.client.get(url, headers={"If-None-Match": '"{}"'.format(etag)})
+        assert response.status_code == 200
+        assert response.get_etag()[0] != etag
+
+    @pytest.mark.parametrize("url, etag_function", (
+        ('/test-index/services/search?q=serviceName', 'search_etag'),
+        ('/test-index/services/1', 'fetch_etag'),
+    ))
+    def test_response_has_the_etag_of_what_it_was_fetched_from(self, url, etag_function):
+        current_etag, _ = self.client.get(url).get_etag()
+
+        # as though the index were written to between the If-None-Match check and the fetch
+        with mock.patch('app.main.views.search.{}'.format(etag_function), return_value="before-the-write"):
+            response = self.client.get(url)
+
+        assert response.status_code == 200
+        assert response.get_etag() == (current_etag, False)
+
+    def test_no_etag_until_writes_are_visible(self):
+        self.app.config["DM_SEARCH_RESPONSE_CACHE_SETTLE_TIME"] = 60
+        service = make_service(id="10")
+        self.client.put(make_search_api_url(service), data=json.dumps(service), content_type='application/json')
+
+        response = self.client.get('/test-index/services/search?q=serviceName')
+        assert response.status_code == 200
+        assert response.get_etag() == (None, None)
+
+    def test_no_etag_without_response_cache(self):
+        self.app.extensions["dm_search_response_cache"] = None
+
+        response = self.client.get('/test-index/services/search?q=serviceName')
+        assert response.status_code == 200
+        assert response.get_etag() == (None, None)
+
+    def test_no_etag_with_a_per_worker_response_cache(self):
+        self.app.extensions["dm_search_response_cache"].shared = False
+
+        response = self.client.get('/test-index/services/search?q=serviceName')
+        assert response.status_code == 200
+        assert response.get_etag() == (None, None)
+
+    def test_no_etag_on_errors(self):
+        response = self.client.get('/test-index/services/100')
+        assert response.status_code == 404
+        assert response.get_etag() == (None, None)
+        assert "Cache-Control" not in response.headers
+
+
 class TestFetchById(BaseApplicationTestWithIndex):
     def test_should_return_404_if_no_service(self):
         response = self.client.get(
@@ -232,12 +417,26 @@ class TestSearchType(BaseApplicationTestWithIndex):
 
         assert es_search_mock.call_args[1]['search_type'] == 'dfs_query_then_fetch'
 
-    def test_core_search_and_aggregate_does_size_0_query_for_aggregations(self):
+    @mock.patch('app.mapping.get_aggregation_sizes', return_value={})
+    def test_core_search_and_aggregate_does_size_0_query_for_aggregations(self, get_aggregation_sizes):
         with self.app.app_context(), mock.patch.object(es, 'search') as es_search_mock:
             core_search_and_aggregate('test-index', 'services', MultiDict(), aggregations=['serviceCategories'])
 
         assert es_search_mock.call_args[1]['body']['size'] == 0
 
+    @mock.patch('app.mapping.get_aggregation_sizes', return_value={})
+    def test_core_search_and_aggregate_can_search_and_aggregate_at_once(self, get_aggregation_sizes):
+        with self.app.app_context(), mock.patch.object(es, 'search') as es_search_mock:
+            core_search_and_aggregate(
+                'test-index', 'services', MultiDict(), search=True, aggregations=['serviceCategories']
+            )
+
+        assert es_search_mock.call_count == 1
+        assert es_search_mock.call_args[1]['search_type'] == 'dfs_query_then_fetch'
+        assert es_search_mock.call_args[1]['body']['size'] == int(self.app.config['DM_SEARCH_PAGE_SIZE'])
+        assert 'serviceCategories' in es_search_mock.call_args[1]['body']['aggregations']
+        assert 'highlight' in es_search_mock.call_args[1]['body']
+
 
 class TestSearchResultsOrdering(BaseSearchTestWithServices):
 
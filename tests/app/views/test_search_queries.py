@@ -70,6 +70,64 @@ def test_basic_aggregations():
     check_aggregations_query('filter_lot=SaaS&filter_webChatSupport=no,yes_extra_cost', 20, {'SaaS': (20).__eq__})
 
 
+@pytest.mark.parametrize('query', ('', 'q=Service', 'filter_lot=SaaS&filter_webChatSupport=no,yes_extra_cost'))
+def test_search_with_aggregations_matches_separate_requests(query):
+    combined = search_results('{}&aggregations=lot'.format(query))
+    searched = search_results(query)
+    aggregated = aggregations_results(query)
+
+    assert combined['aggregations'] == aggregated['aggregations']
+    assert combined['documents'] == searched['documents']
+    assert combined['meta']['total'] == searched['meta']['total']
+    assert combined['links'].keys() == searched['links'].keys()
+
+
+def test_disjunctive_aggregations_exclude_their_own_filter():
+    results = aggregations_results('filter_lot=SaaS&filter_webChatSupport=no&disjunctiveAggregations')
+
+    # the documents counted are still those matching every filter...
+    count_for_query(results, 10)
+    # ...but the lot counts are those there would be for each lot, were it the one filtered on
+    assert results['aggregations']['lot'] == {'SaaS': 10, 'PaaS': 10, 'IaaS': 10, 'SCS': 10}
+
+
+def test_disjunctive_aggregations_apply_other_fields_filters():
+    disjunctive = search_results(
+        'filter_lot=SaaS&filter_serviceCategories=Planning&aggregations=lot&aggregations=serviceCategories'
+        '&disjunctiveAggregations'
+    )
+
+    assert disjunctive['aggregations']['lot'] == search_results(
+        'filter_serviceCategories=Planning&aggregations=lot'
+    )['aggregations']['lot']
+    assert disjunctive['aggregations']['serviceCategories'] == search_results(
+        'filter_lot=SaaS&aggregations=serviceCategories'
+    )['aggregations']['serviceCategories']
+    assert disjunctive['documents'] == search_results('filter_lot=SaaS&filter_serviceCategories=Planning')['documents']
+
+
+@pytest.mark.parametrize('query', (
+    'aggregations=lot',
+    'aggregations=lot&filter_webChatSupport=no',
+    'aggregations=lot&filter_lot=SaaS&filter_webChatSupport=no&disjunctiveAggregations',
+))
+def test_aggregations_with_more_values_than_asked_for_are_paged_through(query):
+    app = create_app('test')
+    app.config['DM_AGGREGATION_MAX_SIZE'] = 2
+    app.config['DM_AGGREGATION_COMPOSITE_PAGE_SIZE'] = 3
+    setup_authorization(app)
+
+    response = app.test_client().get('/test-index/services/search?{}'.format(query))
+
+    assert response.status_code == 200
+    assert json.loads(response.get_data())['aggregations'] == search_results(query)['aggregations']
+    assert len(json.loads(response.get_data())['aggregations']['lot']) == 4
+
+
+def test_search_without_aggregations_has_no_aggregations_key():
+    assert 'aggregations' not in search_results('q=Service')
+
+
 def test_or_filters():
     check_query('filter_lot=SaaS,PaaS', 60, {'lot': ['SaaS', 'PaaS'].__contains__})
     check_query('filter_webChatSupport=no,yes_extra_cost', 80, {})
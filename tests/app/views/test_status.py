@@ -1,8 +1,10 @@
+import gzip
 import json
 
 import mock
 from elasticsearch import TransportError
 
+from app.main.services.meta_response_cache import meta_response_cache
 from tests.helpers import BaseApplicationTest
 
 
@@ -43,3 +45,76 @@ class TestStatus(BaseApplicationTest):
 
             data = json.loads(response.data.decode('utf-8'))
             assert data['message'] == ['Error connecting to elasticsearch (status_code: 500, message: FOO)']
+
+    @mock.patch('app.main.services.search_service.es.indices')
+    def test_elb_status_check_does_not_ask_for_index_stats(self, indices):
+        with self.app.app_context():
+            response = self.client.get('/_status?ignore-dependencies')
+
+            assert response.status_code == 200
+            assert "es_status" not in response.json
+            assert not indices.stats.called
+
+    @mock.patch('app.status.views.es.ping', return_value=False)
+    def test_elb_status_check_when_elasticsearch_cannot_be_reached(self, ping):
+        with self.app.app_context():
+            response = self.client.get('/_status?ignore-dependencies')
+
+            assert response.status_code == 500
+            assert response.json['message'] == ['Error connecting to elasticsearch']
+
+    @mock.patch('app.status.views.status_for_all_indexes', return_value=({"test-index": {}}, 200))
+    def test_status_is_cached(self, status_for_all_indexes):
+        with self.app.app_context():
+            assert self.client.get('/_status').json["es_status"] == {"test-index": {}}
+            assert self.client.get('/_status').json["es_status"] == {"test-index": {}}
+
+            assert status_for_all_indexes.call_count == 1
+
+    @mock.patch('app.status.views.status_for_all_indexes', side_effect=[
+        ({"test-index": {}}, 200),
+        ("connection refused", 500),
+        ({"test-index-2": {}}, 200),
+    ])
+    def test_error_statuses_are_not_cached(self, status_for_all_indexes):
+        with self.app.app_context():
+            assert self.client.get('/_status').json["es_status"] == {"test-index": {}}
+            meta_response_cache.invalidate()
+
+            assert self.client.get('/_status').status_code == 500
+            response = self.client.get('/_status')
+            assert response.status_code == 200
+            assert response.json["es_status"] == {"test-index-2": {}}
+
+            assert status_for_all_indexes.call_count == 3
+
+    @mock.patch('app.status.views.status_for_all_indexes', side_effect=[
+        ({"test-index": {}}, 200),
+        ("connection refused", 500),
+        ({"test-index-2": {}}, 200),
+    ])
+    def test_an_error_refreshing_the_status_discards_it(self, status_for_all_indexes):
+        self.app.config["DM_META_RESPONSE_CACHE_TTL"] = 0
+        meta_response_cache.init_app(self.app)
+        # refreshes happen as soon as they're started
+        with self.app.app_context(), mock.patch(
+            "app.cache.threading.Thread", side_effect=lambda target, daemon: mock.Mock(start=target),
+        ):
+            assert self.client.get('/_status').json["es_status"] == {"test-index": {}}
+            # served while being refreshed
+            assert self.client.get('/_status').json["es_status"] == {"test-index": {}}
+            assert status_for_all_indexes.call_count == 2
+
+            response = self.client.get('/_status')
+            assert response.status_code == 200
+            assert response.json["es_status"] == {"test-index-2": {}}
+            assert status_for_all_indexes.call_count == 3
+
+    @mock.patch('app.status.views.status_for_all_indexes', return_value=({"test-index": {}}, 200))
+    def test_status_is_served_gzipped_if_accepted(self, status_for_all_indexes):
+        with self.app.app_context():
+            response = self.client.get('/_status', headers={"Accept-Encoding": "gzip, deflate"})
+
+            assert response.headers["Content-Encoding"] == "gzip"
+            assert response.headers["Vary"] == "Accept-Encoding"
+            assert json.loads(gzip.decompress(response.data))["es_status"] == {"test-index": {}}
@@ -4,7 +4,7 @@ from flask import json
 from urllib3.exceptions import NewConnectionError
 
 from app.main.services import search_service
-from tests.helpers import BaseApplicationTestWithIndex, make_search_api_url
+from tests.helpers import BaseApplicationTestWithIndex, make_search_api_url, make_service
 
 
 class TestIndexingDocuments(BaseApplicationTestWithIndex):
@@ -138,3 +138,95 @@ class TestDeleteById(BaseApplicationTestWithIndex):
         )
 
         assert response.status_code == 400
+
+
+class TestBulkUpdate(BaseApplicationTestWithIndex):
+    def _bulk(self, operations, content_type='application/json'):
+        if content_type == 'application/x-ndjson':
+            data = "\n".join(json.dumps(operation) for operation in operations) + "\n"
+        else:
+            data = json.dumps(operations)
+        return self.client.post('/test-index/services/_bulk', data=data, content_type=content_type)
+
+    @pytest.mark.parametrize('content_type', ('application/json', 'application/x-ndjson'))
+    def test_should_index_and_delete_documents_in_bulk(self, content_type):
+        response = self._bulk([
+            {"id": "1", "document": make_service(id="1")["document"]},
+            {"id": "2", "action": "index", "document": make_service(id="2")["document"]},
+            {"id": "3", "document": make_service(id="3")["document"]},
+        ], content_type)
+        assert response.status_code == 200
+        assert response.json["errors"] is False
+        assert [(item["id"], item["action"], item["status"]) for item in response.json["results"]] == [
+            ("1", "index", 201), ("2", "index", 201), ("3", "index", 201),
+        ]
+
+        response = self._bulk([{"id": "2", "action": "delete"}], content_type)
+        assert response.status_code == 200
+        assert response.json["results"] == [{"id": "2", "action": "delete", "status": 200, "result": "deleted"}]
+
+        with self.app.app_context():
+            search_service.refresh('test-index')
+        assert self.client.get('/test-index').json["status"]["num_docs"] == 2
+        assert self.client.get('/test-index/services/1').json["services"]["_source"]["dmfilter_lot"] == "LoT"
+
+    def test_bulk_documents_are_transformed(self):
+        self._bulk([{"id": "1", "document": make_service(id="1", serviceCategories=["Accounts payable"])["document"]}])
+
+        source = self.client.get('/test-index/services/1').json["services"]["_source"]
+        assert source["dmfilter_serviceCategories"] == ["Accounts payable", "Accounting and finance"]
+        assert source["sortonly_serviceIdHash"]
+
+    def test_failed_operations_are_reported_individually(self):
+        response = self._bulk([
+            {"id": "1", "document": make_service(id="1")["document"]},
+            {"id": "does-not-exist", "action": "delete"},
+        ])
+
+        assert response.status_code == 200
+        assert response.json["errors"] is True
+        assert response.json["results"][0]["status"] == 201
+        assert response.json["results"][1] == {
+            "id": "does-not-exist", "action": "delete", "status": 404, "result": "not_found",
+        }
+
+    @mock.patch('app.main.services.search_service.streaming_bulk')
+    def test_bulk_requests_are_chunked(self, streaming_bulk):
+        streaming_bulk.return_value = iter(())
+        self.app.config['DM_BULK_INDEX_CHUNK_SIZE'] = 2
+
+        self._bulk([{"id": str(i), "document": make_service(id=str(i))["document"]} for i in range(5)])
+
+        assert streaming_bulk.call_args[1]['chunk_size'] == 2
+        assert streaming_bulk.call_args[1]['max_chunk_bytes'] == self.app.config['DM_BULK_INDEX_MAX_CHUNK_BYTES']
+
+    def test_should_raise_400_on_bad_doc_type(self):
+        response = self.client.post(
+            '/test-index/some-bad-type/_bulk',
+            data=json.dumps([{"id": "1", "document": make_service()["document"]}]),
+            content_type='application/json',
+        )
+
+        assert response.status_code == 400
+
+    @pytest.mark.parametrize('operations, expected_error', (
+        ({"id": "1", "document": {}}, "Invalid JSON; must be a list of operations"),
+        (["1"], "Invalid operation at position 0; must be a JSON object"),
+        ([{"id": "1", "action": "update", "document": {}}], "Invalid operation at position 0; 'action' must be one of"),
+        ([{"id": "1", "document": {}}, {"document": {}}], "Invalid operation at position 1; must have an 'id'"),
+        ([{"id": True, "document": {}}], "Invalid operation at position 0; must have an 'id'"),
+        ([{"id": "1"}], "Invalid operation at position 0; must have a 'document' object"),
+    ))
+    def test_should_raise_400_on_invalid_operations(self, operations, expected_error):
+        response = self.client.post('/test-index/services/_bulk', data=json.dumps(operations),
+                                    content_type='application/json')
+
+        assert response.status_code == 400
+        assert response.json["error"].startswith(expected_error)
+
+    def test_should_raise_400_on_invalid_ndjson_line(self):
+        response = self.client.post('/test-index/services/_bulk', data='{"id": "1", "action": "delete"}\n{"id": \n',
+                                    content_type='application/x-ndjson')
+
+        assert response.status_code == 400
+        assert response.json["error"] == "Invalid JSON on line 2"
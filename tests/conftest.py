@@ -1,15 +1,36 @@
+import os
+import threading
+
 import pytest
 import pathlib
 import json
+from werkzeug.serving import make_server
 
 import app.mapping
 
+from .elasticsearch_stand_in import ElasticsearchStandIn
 from .helpers import make_service, services_mappings
 
 
 mappings_dir = (pathlib.Path(__file__).parent / "../mappings").resolve()
 
 
+def pytest_addoption(parser):
+    parser.addoption(
+        "--elasticsearch-stand-in",
+        action="store_true",
+        help="Run against an in-memory stand-in for Elasticsearch rather than the cluster at ELASTICSEARCH_HOST",
+    )
+
+
+def pytest_configure(config):
+    if config.getoption("elasticsearch_stand_in"):
+        server = make_server("localhost", 0, ElasticsearchStandIn(), threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        # picked up by every app the tests create, overriding the config
+        os.environ["ELASTICSEARCH_HOST"] = "localhost:{}".format(server.server_port)
+
+
 @pytest.fixture(scope="module", params=services_mappings)
 def services_mapping_file_name_and_path(request):
     return (request.param, mappings_dir / f"{request.param}.json")
@@ -0,0 +1,1142 @@
+"""
+A lightweight, in-memory stand-in for the subset of the Elasticsearch HTTP API which this app uses, so that the test
+suite, benchmarks and local load tests can run without a real cluster.
+
+It can either be served over HTTP, e.g.::
+
+    python -m tests.elasticsearch_stand_in --port 9200 --latency 0.05
+
+or used in-process by passing `StandInConnection` as the Elasticsearch client's ``connection_class``.
+
+Only the behaviour this app relies on is emulated, and even then only approximately - text analysis is a crude
+approximation of the `stemming_analyzer` our mappings define and scores are simple term counts. It is not a substitute
+for testing against a real Elasticsearch before release.
+"""
+import argparse
+import base64
+import functools
+import html
+import itertools
+import json
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+from elasticsearch.connection import Connection
+from werkzeug.exceptions import HTTPException, MethodNotAllowed, NotFound
+from werkzeug.routing import Map, Rule
+from werkzeug.urls import url_decode
+from werkzeug.wrappers import Request, Response
+
+
+DEFAULT_MAX_RESULT_WINDOW = 10000
+
+
+class StandInError(Exception):
+    def __init__(self, status, error_type, reason, **extra):
+        super().__init__(reason)
+        self.status = status
+        self.body = {
+            "error": {
+                "root_cause": [{"type": error_type, "reason": reason, **extra}],
+                "type": error_type,
+                "reason": reason,
+                **extra,
+            },
+            "status": status,
+        }
+
+
+def _index_not_found(index_name):
+    return StandInError(
+        404, "index_not_found_exception", "no such index [{}]".format(index_name), index=index_name,
+    )
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+#
+# analysis
+#
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_NON_WORD_RE = re.compile(r"\W+", re.UNICODE)
+
+
+def _stem(token):
+    if token.endswith("'s"):
+        token = token[:-2]
+    if len(token) > 4 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def _analyze_text(text, stemming):
+    """Returns a list of ``(term, start_offset, end_offset)`` for a text field value"""
+    return [
+        (_stem(match.group().lower()) if stemming else match.group().lower(), match.start(), match.end())
+        for match in _TOKEN_RE.finditer(text)
+    ]
+
+
+def _keyword_value(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+class _Field(object):
+    def __init__(self, name, definition):
+        self.name = name
+        self.type = definition.get("type", "object")
+        self.stemming = definition.get("analyzer") == "stemming_analyzer"
+        self.normalized = definition.get("normalizer") == "filter_normalizer"
+
+    @property
+    def is_text(self):
+        return self.type == "text"
+
+    def normalize(self, value):
+        value = _keyword_value(value)
+        return _NON_WORD_RE.sub("", value).lower() if self.normalized else value
+
+    def terms(self, value):
+        """All the terms a single field value is indexed as"""
+        if self.is_text:
+            return [term for term, _, _ in _analyze_text(_keyword_value(value), self.stemming)]
+        return [self.normalize(value)]
+
+    def sort_value(self, value):
+        if self.type in ("byte", "short", "integer", "long", "float", "double"):
+            return float(value)
+        return self.normalize(value)
+
+
+#
+# indices & documents
+#
+
+class _Index(object):
+    def __init__(self, name, body):
+        self.name = name
+        self.uuid = uuid.uuid4().hex[:22]
+        self.created = int(time.time() * 1000)
+        self.mappings = body.get("mappings") or {}
+        self.settings = {"index": {}}
+        for key, value in (body.get("settings") or {}).items():
+            if key == "index":
+                self.settings["index"].update(value)
+            else:
+                self.settings["index"][key[len("index."):] if key.startswith("index.") else key] = value
+        self.settings["index"].setdefault("number_of_shards", 1)
+        self.settings["index"].setdefault("number_of_replicas", 1)
+        self.aliases = set()
+        self.documents = OrderedDict()
+        self.fields = {
+            name: _Field(name, definition)
+            for name, definition in (self.mappings.get("properties") or {}).items()
+        }
+
+    @property
+    def max_result_window(self):
+        return int(self.settings["index"].get("max_result_window", DEFAULT_MAX_RESULT_WINDOW))
+
+    def field(self, name):
+        return self.fields.get(name) or _Field(name, {"type": "keyword"})
+
+    def check_document(self, source):
+        if self.mappings.get("dynamic") == "strict":
+            for key in source:
+                if key not in self.fields:
+                    raise StandInError(
+                        400, "strict_dynamic_mapping_exception",
+                        "mapping set to strict, dynamic introduction of [{}] within [_doc] is not allowed".format(key),
+                    )
+
+    def settings_response(self):
+        return {
+            "index": {
+                **_stringify_settings(self.settings["index"]),
+                "provided_name": self.name,
+                "creation_date": str(self.created),
+                "uuid": self.uuid,
+                "version": {"created": "7090399"},
+            },
+        }
+
+
+def _stringify_settings(settings):
+    return {
+        key: _stringify_settings(value) if isinstance(value, dict) else (
+            value if isinstance(value, (list, str)) else _keyword_value(value)
+        )
+        for key, value in settings.items()
+    }
+
+
+def _human_size(size_in_bytes):
+    for unit in ("b", "kb", "mb", "gb"):
+        if size_in_bytes < 1024 or unit == "gb":
+            return "{:.1f}{}".format(size_in_bytes, unit).replace(".0" + unit, unit)
+        size_in_bytes /= 1024.
+
+
+#
+# the stand-in itself
+#
+
+class ElasticsearchStandIn(object):
+    """An in-memory emulation of an Elasticsearch cluster, usable as a WSGI application or via `handle` directly.
+
+    ``latency`` seconds are slept before handling each request, to simulate a slow cluster.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.indices = {}
+        self.scrolls = {}
+        self.pits = {}
+        self.tasks = {}
+        self.pipelines = {}
+        # the most recent requests handled, as (method, path) tuples
+        self.request_log = deque(maxlen=1000)
+        self._lock = threading.RLock()
+        self.url_map = Map([
+            Rule("/", methods=["GET", "HEAD"], endpoint="info"),
+            Rule("/_aliases", methods=["POST"], endpoint="update_aliases"),
+            Rule("/_cat/aliases", methods=["GET"], endpoint="cat_aliases"),
+            Rule("/_mapping", methods=["GET"], endpoint="get_mapping"),
+            Rule("/_stats", methods=["GET"], endpoint="stats"),
+            Rule("/_refresh", methods=["POST", "GET"], endpoint="refresh"),
+            Rule("/_bulk", methods=["POST", "PUT"], endpoint="bulk"),
+            Rule("/_search", methods=["GET", "POST"], endpoint="search"),
+            Rule("/_search/scroll", methods=["GET", "POST"], endpoint="scroll"),
+            Rule("/_search/scroll", methods=["DELETE"], endpoint="clear_scroll"),
+            Rule("/_pit", methods=["DELETE"], endpoint="close_pit"),
+            Rule("/_reindex", methods=["POST"], endpoint="reindex"),
+            Rule("/_tasks/<task_id>", methods=["GET"], endpoint="get_task"),
+            Rule("/_ingest/pipeline/<pipeline_id>", methods=["PUT"], endpoint="put_pipeline"),
+            Rule("/_ingest/pipeline/<pipeline_id>", methods=["GET"], endpoint="get_pipeline"),
+            Rule("/_ingest/pipeline/<pipeline_id>", methods=["DELETE"], endpoint="delete_pipeline"),
+            Rule("/<index>", methods=["PUT"], endpoint="create_index"),
+            Rule("/<index>", methods=["GET"], endpoint="get_index"),
+            Rule("/<index>", methods=["HEAD"], endpoint="index_exists"),
+            Rule("/<index>", methods=["DELETE"], endpoint="delete_index"),
+            Rule("/<index>/_mapping", methods=["GET"], endpoint="get_mapping"),
+            Rule("/<index>/_mapping", methods=["PUT", "POST"], endpoint="put_mapping"),
+            Rule("/<index>/_settings", methods=["GET"], endpoint="get_settings"),
+            Rule("/<index>/_settings", methods=["PUT"], endpoint="put_settings"),
+            Rule("/<index>/_stats", methods=["GET"], endpoint="stats"),
+            Rule("/<index>/_refresh", methods=["POST", "GET"], endpoint="refresh"),
+            Rule("/<index>/_forcemerge", methods=["POST"], endpoint="forcemerge"),
+            Rule("/<index>/_alias/<name>", methods=["DELETE"], endpoint="delete_alias"),
+            Rule("/<index>/_aliases/<name>", methods=["DELETE"], endpoint="delete_alias"),
+            Rule("/<index>/_bulk", methods=["POST", "PUT"], endpoint="bulk"),
+            Rule("/<index>/_search", methods=["GET", "POST"], endpoint="search"),
+            Rule("/<index>/_count", methods=["GET", "POST"], endpoint="count"),
+            Rule("/<index>/_pit", methods=["POST"], endpoint="open_pit"),
+            Rule("/<index>/_doc/<id>", methods=["PUT", "POST"], endpoint="index_document"),
+            Rule("/<index>/_doc/<id>", methods=["GET"], endpoint="get_document"),
+            Rule("/<index>/_doc/<id>", methods=["DELETE"], endpoint="delete_document"),
+        ])
+
+    #
+    # request dispatching
+    #
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        status, body = self.handle(request.method, request.path, request.args.to_dict(), request.get_data())
+        response = Response(
+            b"" if body is None else json.dumps(body),
+            status=status,
+            content_type="application/json; charset=UTF-8",
+        )
+        return response(environ, start_response)
+
+    def handle(self, method, path, params=None, body=None):
+        """Handle a single request, returning a ``(status_code, response_body)`` tuple"""
+        if self.latency:
+            time.sleep(self.latency)
+
+        params = params or {}
+        if isinstance(body, bytes):
+            body = body.decode("utf-8")
+
+        self.request_log.append((method, path))
+        try:
+            endpoint, path_args = self.url_map.bind("localhost").match(path, method=method)
+        except (NotFound, MethodNotAllowed) as e:
+            return e.code, {"error": "Incorrect HTTP method or unknown path [{} {}]".format(method, path)}
+
+        try:
+            if endpoint in ("bulk",):
+                parsed_body = body or ""
+            else:
+                parsed_body = json.loads(body) if body else {}
+            with self._lock:
+                result = getattr(self, "_" + endpoint)(params, parsed_body, **path_args)
+        except StandInError as e:
+            return e.status, e.body
+        except (HTTPException, ValueError, KeyError, TypeError) as e:
+            return 400, StandInError(400, "parse_exception", str(e)).body
+
+        return result if isinstance(result, tuple) else (200, result)
+
+    #
+    # index name resolution
+    #
+
+    def _resolve(self, expression, allow_missing=False, allow_aliases=True):
+        """Resolve an index expression (names, aliases, wildcards, comma-separated lists or `_all`) to index names"""
+        if expression in (None, "", "_all", "*"):
+            return sorted(self.indices)
+
+        names = []
+        for part in expression.split(","):
+            if "*" in part:
+                pattern = re.compile("^" + re.escape(part).replace(r"\*", ".*") + "$")
+                names.extend(name for name in sorted(self.indices) if pattern.match(name))
+            elif part in self.indices:
+                names.append(part)
+            elif allow_aliases and any(part in index.aliases for index in self.indices.values()):
+                names.extend(name for name, index in sorted(self.indices.items()) if part in index.aliases)
+            elif not allow_missing:
+                raise _index_not_found(part)
+
+        return list(OrderedDict.fromkeys(names))
+
+    def _single_index(self, expression):
+        names = self._resolve(expression)
+        if len(names) != 1:
+            raise StandInError(
+                400, "illegal_argument_exception",
+                "no write index is defined for alias [{}]".format(expression),
+            )
+        return self.indices[names[0]]
+
+    #
+    # cluster & index administration
+    #
+
+    def _info(self, params, body):
+        return {
+            "name": "elasticsearch-stand-in",
+            "cluster_name": "stand-in",
+            "version": {"number": "7.10.0", "distribution": "stand-in"},
+            "tagline": "You Know, for Search",
+        }
+
+    def _create_index(self, params, body, index):
+        if index in self.indices:
+            raise StandInError(
+                400, "resource_already_exists_exception",
+                "index [{}/{}] already exists".format(index, self.indices[index].uuid),
+                index=index,
+            )
+        if any(index in existing.aliases for existing in self.indices.values()):
+            raise StandInError(
+                400, "invalid_index_name_exception", "Invalid index name [{}], already exists as alias".format(index),
+            )
+        self.indices[index] = _Index(index, body)
+        for alias in (body.get("aliases") or {}):
+            self.indices[index].aliases.add(alias)
+        return {"acknowledged": True, "shards_acknowledged": True, "index": index}
+
+    def _index_exists(self, params, body, index):
+        return (200, None) if self._resolve(index, allow_missing=True) else (404, None)
+
+    def _get_index(self, params, body, index):
+        return {
+            name: {
+                "aliases": {alias: {} for alias in sorted(self.indices[name].aliases)},
+                "mappings": self.indices[name].mappings,
+                "settings": self.indices[name].settings_response(),
+            }
+            for name in self._resolve(index)
+        }
+
+    def _delete_index(self, params, body, index):
+        for part in index.split(","):
+            if "*" not in part and part not in self.indices and any(
+                part in existing.aliases for existing in self.indices.values()
+            ):
+                raise StandInError(
+                    400, "illegal_argument_exception",
+                    "The provided expression [{}] matches an alias, specify the corresponding concrete indices "
+                    "instead.".format(part),
+                )
+        for name in self._resolve(index, allow_aliases=False):
+            del self.indices[name]
+        return {"acknowledged": True}
+
+    def _get_mapping(self, params, body, index=None):
+        return {name: {"mappings": self.indices[name].mappings} for name in self._resolve(index)}
+
+    def _put_mapping(self, params, body, index):
+        for name in self._resolve(index):
+            mappings = self.indices[name].mappings
+            if "_meta" in body:
+                mappings["_meta"] = body["_meta"]
+            for field_name, definition in (body.get("properties") or {}).items():
+                mappings.setdefault("properties", {})[field_name] = definition
+                self.indices[name].fields[field_name] = _Field(field_name, definition)
+        return {"acknowledged": True}
+
+    def _get_settings(self, params, body, index):
+        return {name: {"settings": self.indices[name].settings_response()} for name in self._resolve(index)}
+
+    def _put_settings(self, params, body, index):
+        updates = dict(body.get("index") or {})
+        updates.update({
+            key[len("index."):]: value for key, value in body.items() if key.startswith("index.")
+        })
+        for name in self._resolve(index):
+            for key, value in updates.items():
+                if value is None:
+                    self.indices[name].settings["index"].pop(key, None)
+                else:
+                    self.indices[name].settings["index"][key] = value
+        return {"acknowledged": True}
+
+    def _stats(self, params, body, index=None):
+        def index_stats(name):
+            size = len(json.dumps(list(self.indices[name].documents.values())))
+            store = {"size_in_bytes": size}
+            if params.get("human") in ("true", "True", True):
+                store["size"] = _human_size(size)
+            return {
+                "uuid": self.indices[name].uuid,
+                "primaries": {"docs": {"count": len(self.indices[name].documents), "deleted": 0}, "store": store},
+                "total": {"docs": {"count": len(self.indices[name].documents), "deleted": 0}, "store": store},
+            }
+
+        names = self._resolve(index)
+        return {
+            "_shards": {"total": len(names), "successful": len(names), "failed": 0},
+            "_all": {},
+            "indices": {name: index_stats(name) for name in names},
+        }
+
+    def _refresh(self, params, body, index=None):
+        names = self._resolve(index)
+        return {"_shards": {"total": len(names), "successful": len(names), "failed": 0}}
+
+    def _forcemerge(self, params, body, index):
+        names = self._resolve(index)
+        return {"_shards": {"total": len(names), "successful": len(names), "failed": 0}}
+
+    def _update_aliases(self, params, body):
+        actions = [action for action in body.get("actions", [])]
+        # validate everything before applying anything, as real ES applies alias actions atomically
+        for action in actions:
+            (action_type, args), = action.items()
+            if action_type == "add":
+                for name in self._resolve(args["index"]):
+                    pass
+                if args["alias"] in self.indices:
+                    raise StandInError(
+                        400, "invalid_alias_name_exception",
+                        "Invalid alias name [{}], an index exists with the same name as the alias".format(
+                            args["alias"]
+                        ),
+                        index=args["alias"],
+                    )
+        for action in actions:
+            (action_type, args), = action.items()
+            if action_type == "add":
+                for name in self._resolve(args["index"]):
+                    self.indices[name].aliases.add(args["alias"])
+            elif action_type == "remove":
+                for name in self._resolve(args["index"], allow_missing=True):
+                    self.indices[name].aliases.discard(args["alias"])
+            elif action_type == "remove_index":
+                for name in self._resolve(args["index"], allow_aliases=False):
+                    del self.indices[name]
+        return {"acknowledged": True}
+
+    def _delete_alias(self, params, body, index, name):
+        removed = False
+        for index_name in self._resolve(index):
+            if name in self.indices[index_name].aliases:
+                self.indices[index_name].aliases.discard(name)
+                removed = True
+        if not removed:
+            raise StandInError(404, "aliases_not_found_exception", "aliases [{}] missing".format(name))
+        return {"acknowledged": True}
+
+    def _cat_aliases(self, params, body):
+        return [
+            {
+                "alias": alias,
+                "index": name,
+                "filter": "-",
+                "routing.index": "-",
+                "routing.search": "-",
+                "is_write_index": "-",
+            }
+            for name, index in sorted(self.indices.items())
+            for alias in sorted(index.aliases)
+        ]
+
+    #
+    # ingest pipelines
+    #
+
+    def _put_pipeline(self, params, body, pipeline_id):
+        self.pipelines[pipeline_id] = body
+        return {"acknowledged": True}
+
+    def _get_pipeline(self, params, body, pipeline_id):
+        if pipeline_id not in self.pipelines:
+            return 404, {}
+        return {pipeline_id: self.pipelines[pipeline_id]}
+
+    def _delete_pipeline(self, params, body, pipeline_id):
+        if self.pipelines.pop(pipeline_id, None) is None:
+            raise StandInError(404, "resource_not_found_exception", "pipeline [{}] is missing".format(pipeline_id))
+        return {"acknowledged": True}
+
+    def _run_pipeline(self, pipeline_id, source):
+        """Pipelines can only be stored, not run: we've no painless interpreter. Documents pass through unchanged."""
+        if pipeline_id not in self.pipelines:
+            raise StandInError(
+                400, "illegal_argument_exception", "pipeline with id [{}] does not exist".format(pipeline_id),
+            )
+        return source
+
+    #
+    # documents
+    #
+
+    def _index_document(self, params, body, index, id):
+        if index not in self.indices and not self._resolve(index, allow_missing=True):
+            # real ES would auto-create the index; our mappings are strict so we never want that
+            self._create_index({}, {}, index)
+        target = self._single_index(index)
+        if params.get("pipeline"):
+            body = self._run_pipeline(params["pipeline"], body)
+        target.check_document(body)
+        result = "updated" if id in target.documents else "created"
+        target.documents[id] = body
+        return (201 if result == "created" else 200), {
+            "_index": target.name,
+            "_type": "_doc",
+            "_id": id,
+            "_version": 1,
+            "result": result,
+            "_shards": {"total": 2, "successful": 1, "failed": 0},
+        }
+
+    def _get_document(self, params, body, index, id):
+        target = self._single_index(index)
+        if id not in target.documents:
+            return 404, {"_index": target.name, "_type": "_doc", "_id": id, "found": False}
+        return {
+            "_index": target.name,
+            "_type": "_doc",
+            "_id": id,
+            "_version": 1,
+            "_seq_no": 0,
+            "_primary_term": 1,
+            "found": True,
+            "_source": target.documents[id],
+        }
+
+    def _delete_document(self, params, body, index, id):
+        target = self._single_index(index)
+        found = target.documents.pop(id, None) is not None
+        return (200 if found else 404), {
+            "_index": target.name,
+            "_type": "_doc",
+            "_id": id,
+            "_version": 1,
+            "result": "deleted" if found else "not_found",
+            "_shards": {"total": 2, "successful": 1, "failed": 0},
+        }
+
+    def _bulk(self, params, body, index=None):
+        lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+        items = []
+        position = 0
+        while position < len(lines):
+            (action, metadata), = lines[position].items()
+            position += 1
+            index_name = metadata.get("_index", index)
+            try:
+                if action == "delete":
+                    status, result = self._delete_document({}, {}, index_name, metadata["_id"])
+                else:
+                    source = lines[position]
+                    position += 1
+                    pipeline = metadata.get("pipeline", params.get("pipeline"))
+                    status, result = self._index_document(
+                        {"pipeline": pipeline} if pipeline else {}, source, index_name,
+                        metadata.get("_id") or uuid.uuid4().hex,
+                    )
+                items.append({action: dict(result, status=status)})
+            except StandInError as e:
+                items.append({action: {
+                    "_index": index_name,
+                    "_type": "_doc",
+                    "_id": metadata.get("_id"),
+                    "status": e.status,
+                    "error": {"type": e.body["error"]["type"], "reason": e.body["error"]["reason"]},
+                }})
+        return {
+            "took": 1,
+            "errors": any("error" in item[next(iter(item))] for item in items),
+            "items": items,
+        }
+
+    #
+    # reindexing
+    #
+
+    def _reindex(self, params, body):
+        source = body["source"]
+        dest = body["dest"]
+        copied = 0
+        for name in self._resolve(source["index"]):
+            for document_id, document in list(self.indices[name].documents.items()):
+                self._index_document(
+                    {"pipeline": dest["pipeline"]} if dest.get("pipeline") else {},
+                    json.loads(json.dumps(document)), dest["index"], document_id,
+                )
+                copied += 1
+        response = {
+            "took": 1,
+            "timed_out": False,
+            "total": copied,
+            "created": copied,
+            "updated": 0,
+            "deleted": 0,
+            "batches": 1,
+            "failures": [],
+        }
+        if params.get("wait_for_completion") in ("false", False):
+            task_id = "stand-in:{}".format(len(self.tasks) + 1)
+            self.tasks[task_id] = {
+                "completed": True,
+                "task": {"status": {"total": copied, "created": copied, "updated": 0, "deleted": 0}},
+                "response": response,
+            }
+            return {"task": task_id}
+        return response
+
+    def _get_task(self, params, body, task_id):
+        if task_id not in self.tasks:
+            raise StandInError(404, "resource_not_found_exception", "task [{}] isn't running".format(task_id))
+        return self.tasks[task_id]
+
+    #
+    # searching
+    #
+
+    def _search(self, params, body, index=None):
+        if body.get("pit"):
+            if index:
+                raise StandInError(
+                    400, "action_request_validation_exception",
+                    "[indices] cannot be used with point in time",
+                )
+            pit_id = body["pit"]["id"]
+            if pit_id not in self.pits:
+                raise StandInError(404, "search_context_missing_exception", "No search context found for id [1]")
+            index = self.pits[pit_id]
+
+        names = self._resolve(index)
+        size = int(params.get("size", body.get("size", 10)))
+        from_ = int(params.get("from", body.get("from", 0)))
+        max_result_window = min(
+            (self.indices[name].max_result_window for name in names), default=DEFAULT_MAX_RESULT_WINDOW,
+        )
+        if from_ < 0:
+            raise StandInError(
+                400, "illegal_argument_exception", "[from] parameter cannot be negative but was [{}]".format(from_),
+            )
+        if "scroll" not in params and from_ + size > max_result_window:
+            raise StandInError(
+                400, "illegal_argument_exception",
+                "Result window is too large, from + size must be less than or equal to: [{}] but was [{}]. See the "
+                "scroll api for a more efficient way to request large data sets. This limit can be set by changing "
+                "the [index.max_result_window] index level setting.".format(max_result_window, from_ + size),
+            )
+
+        matches = self._matching_documents(names, body.get("query"))
+        post_filtered = matches
+        if body.get("post_filter"):
+            post_filtered = [
+                match for match in matches if self._matches(match[0], match[1], match[2], body["post_filter"])[0]
+            ]
+
+        sort = _as_list(body.get("sort")) or (["_doc"] if "scroll" in params else ["_score"])
+        ordered = sorted(post_filtered, key=functools.cmp_to_key(self._sort_comparator(sort)))
+        if body.get("search_after") is not None:
+            search_after = body["search_after"]
+            ordered = [
+                match for match in ordered
+                if self._compare_sort_values(self._sort_values(match, sort), search_after, sort) > 0
+            ]
+
+        response = {
+            "took": 1,
+            "timed_out": False,
+            "_shards": {"total": len(names), "successful": len(names), "skipped": 0, "failed": 0},
+            "hits": {
+                "total": {"value": len(post_filtered), "relation": "eq"},
+                "max_score": max((match[3] for match in post_filtered), default=None),
+                "hits": [],
+            },
+        }
+
+        if "scroll" in params:
+            scroll_id = base64.b64encode(uuid.uuid4().bytes).decode("ascii")
+            self.scrolls[scroll_id] = {"hits": ordered, "position": 0, "size": size, "body": body, "sort": sort}
+            response["_scroll_id"] = scroll_id
+            response["hits"]["hits"] = self._next_scroll_page(scroll_id)
+        else:
+            response["hits"]["hits"] = [
+                self._format_hit(match, body, sort) for match in ordered[from_:from_ + size]
+            ]
+
+        if body.get("pit"):
+            response["pit_id"] = body["pit"]["id"]
+
+        aggregations = body.get("aggregations") or body.get("aggs")
+        if aggregations:
+            response["aggregations"] = self._aggregate(matches, aggregations)
+
+        return response
+
+    def _count(self, params, body, index):
+        return {"count": len(self._matching_documents(self._resolve(index), body.get("query")))}
+
+    def _scroll(self, params, body):
+        scroll_id = body.get("scroll_id") or params.get("scroll_id")
+        if scroll_id not in self.scrolls:
+            raise StandInError(404, "search_context_missing_exception", "No search context found for id [1]")
+        scroll = self.scrolls[scroll_id]
+        return {
+            "_scroll_id": scroll_id,
+            "took": 1,
+            "timed_out": False,
+            "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+            "hits": {
+                "total": {"value": len(scroll["hits"]), "relation": "eq"},
+                "hits": self._next_scroll_page(scroll_id),
+            },
+        }
+
+    def _next_scroll_page(self, scroll_id):
+        scroll = self.scrolls[scroll_id]
+        page = scroll["hits"][scroll["position"]:scroll["position"] + scroll["size"]]
+        scroll["position"] += len(page)
+        return [self._format_hit(match, scroll["body"], scroll["sort"]) for match in page]
+
+    def _clear_scroll(self, params, body):
+        scroll_ids = _as_list(body.get("scroll_id"))
+        for scroll_id in scroll_ids:
+            self.scrolls.pop(scroll_id, None)
+        return {"succeeded": True, "num_freed": len(scroll_ids)}
+
+    def _open_pit(self, params, body, index):
+        self._resolve(index)
+        pit_id = base64.b64encode(uuid.uuid4().bytes).decode("ascii")
+        self.pits[pit_id] = index
+        return {"id": pit_id}
+
+    def _close_pit(self, params, body):
+        found = self.pits.pop(body.get("id"), None) is not None
+        return {"succeeded": found, "num_freed": int(found)}
+
+    def _matching_documents(self, names, query):
+        """Returns a list of ``(index, document_id, source, score)`` for documents matching ``query``"""
+        matches = []
+        for name in names:
+            index = self.indices[name]
+            for document_id, source in index.documents.items():
+                matched, score = self._matches(index, document_id, source, query or {"match_all": {}})
+                if matched:
+                    matches.append((index, document_id, source, score))
+        return matches
+
+    def _matches(self, index, document_id, source, query):
+        """Returns a ``(matched, score)`` tuple for a document against a query clause"""
+        (query_type, args), = query.items()
+
+        if query_type == "match_all":
+            return True, 1.0
+
+        if query_type == "bool":
+            score = 0.0
+            for clause in _as_list(args.get("must")):
+                matched, clause_score = self._matches(index, document_id, source, clause)
+                if not matched:
+                    return False, 0.0
+                score += clause_score
+            for clause in _as_list(args.get("filter")):
+                if not self._matches(index, document_id, source, clause)[0]:
+                    return False, 0.0
+            for clause in _as_list(args.get("must_not")):
+                if self._matches(index, document_id, source, clause)[0]:
+                    return False, 0.0
+            should = [self._matches(index, document_id, source, clause) for clause in _as_list(args.get("should"))]
+            if should and not args.get("must") and not args.get("filter") and not any(m for m, _ in should):
+                return False, 0.0
+            score += sum(clause_score for matched, clause_score in should if matched)
+            return True, score or 1.0
+
+        if query_type in ("term", "terms"):
+            (field_name, values), = ((k, v) for k, v in args.items() if k != "boost")
+            if query_type == "term":
+                values = [values["value"] if isinstance(values, dict) else values]
+            field = index.field(field_name)
+            wanted = {field.normalize(value) for value in values}
+            indexed = {term for value in _as_list(source.get(field_name)) for term in field.terms(value)}
+            return bool(wanted & indexed), 1.0
+
+        if query_type == "ids":
+            return document_id in args["values"], 1.0
+
+        if query_type == "exists":
+            return source.get(args["field"]) not in (None, []), 1.0
+
+        if query_type == "simple_query_string":
+            return self._matches_simple_query_string(index, source, args)
+
+        raise StandInError(400, "parsing_exception", "unknown query [{}]".format(query_type))
+
+    def _matches_simple_query_string(self, index, source, args):
+        default_and = args.get("default_operator", "or").lower() == "and"
+        fields = args.get("fields") or ["*"]
+        field_names = [
+            name for pattern in fields for name in index.fields
+            if re.match("^" + re.escape(pattern.split("^")[0]).replace(r"\*", ".*") + "$", name)
+        ]
+
+        def clause_score(clause):
+            """the number of times a (possibly multi-word) clause matches across our fields"""
+            score = 0
+            for field_name in field_names:
+                field = index.field(field_name)
+                for value in _as_list(source.get(field_name)):
+                    if field.is_text:
+                        value_terms = field.terms(value)
+                        clause_terms = [term for term, _, _ in _analyze_text(clause, field.stemming)]
+                        if clause_terms and all(term in value_terms for term in clause_terms):
+                            score += sum(value_terms.count(term) for term in clause_terms)
+                    elif field.normalize(value) == field.normalize(clause):
+                        score += 1
+            return score
+
+        any_group_matched, total_score = False, 0.0
+        for group in _parse_simple_query_string(args["query"]):
+            positive = [clause for negated, clause in group if not negated]
+            negative = [clause for negated, clause in group if negated]
+            scores = [clause_score(clause) for clause in positive]
+            if any(clause_score(clause) for clause in negative):
+                continue
+            if positive and ((default_and and all(scores)) or (not default_and and any(scores))):
+                any_group_matched = True
+                total_score += sum(scores)
+            elif not positive and negative:
+                any_group_matched = True
+                total_score += 1
+        return any_group_matched, total_score
+
+    def _sort_values(self, match, sort):
+        index, document_id, source, score = match
+        values = []
+        for sort_clause in sort:
+            field_name = sort_clause if isinstance(sort_clause, str) else next(iter(sort_clause))
+            if field_name == "_score":
+                values.append(score)
+            elif field_name in ("_doc", "_shard_doc"):
+                values.append(list(index.documents).index(document_id))
+            else:
+                field_values = _as_list(source.get(field_name))
+                values.append(index.field(field_name).sort_value(field_values[0]) if field_values else None)
+        return values
+
+    @staticmethod
+    def _sort_orders(sort):
+        orders = []
+        for sort_clause in sort:
+            if isinstance(sort_clause, str):
+                orders.append("desc" if sort_clause == "_score" else "asc")
+            else:
+                (field_name, order), = sort_clause.items()
+                orders.append(order.get("order", "asc") if isinstance(order, dict) else order)
+        return orders
+
+    def _compare_sort_values(self, left, right, sort):
+        for left_value, right_value, order in zip(left, right, self._sort_orders(sort)):
+            if left_value == right_value:
+                continue
+            if left_value is None:
+                return 1
+            if right_value is None:
+                return -1
+            result = -1 if left_value < right_value else 1
+            return -result if order == "desc" else result
+        return 0
+
+    def _sort_comparator(self, sort):
+        def compare(left, right):
+            return self._compare_sort_values(self._sort_values(left, sort), self._sort_values(right, sort), sort)
+        return compare
+
+    def _format_hit(self, match, body, sort):
+        index, document_id, source, score = match
+        hit = {
+            "_index": index.name,
+            "_type": "_doc",
+            "_id": document_id,
+            "_score": score,
+        }
+        source_filter = body.get("_source", True)
+        if source_filter is not False:
+            hit["_source"] = _filter_source(source, source_filter)
+        if body.get("sort"):
+            hit["sort"] = [
+                int(value) if isinstance(value, float) and value.is_integer() else value
+                for value in self._sort_values(match, sort)
+            ]
+        if body.get("highlight"):
+            highlight = self._highlight(index, source, body["highlight"], body.get("query"))
+            if highlight:
+                hit["highlight"] = highlight
+        return hit
+
+    def _highlight(self, index, source, highlight, query):
+        query_clauses = [
+            clause for group in _parse_simple_query_string(_find_query_string(query) or "")
+            for negated, clause in group if not negated
+        ]
+        encode = (lambda text: _html_encode(text)) if highlight.get("encoder") == "html" else (lambda text: text)
+        pre_tag = highlight.get("pre_tags", ["<em>"])[0]
+        post_tag = highlight.get("post_tags", ["</em>"])[0]
+        no_match_size = highlight.get("no_match_size", 0)
+
+        result = {}
+        for pattern in highlight.get("fields", {}):
+            regex = re.compile("^" + re.escape(pattern).replace(r"\*", ".*") + "$")
+            for field_name in sorted(name for name in source if regex.match(name)):
+                field = index.field(field_name)
+                fragments = [
+                    fragment for fragment in (
+                        _highlight_value(field, str(value), query_clauses, encode, pre_tag, post_tag)
+                        for value in _as_list(source[field_name])
+                    ) if fragment is not None
+                ]
+                if fragments:
+                    result[field_name] = fragments
+                elif no_match_size and _as_list(source[field_name]):
+                    result[field_name] = [encode(str(_as_list(source[field_name])[0])[:no_match_size])]
+        return result
+
+    def _aggregate(self, matches, aggregations):
+        return {name: self._aggregation(matches, definition) for name, definition in aggregations.items()}
+
+    def _aggregation(self, matches, definition):
+        sub_aggregations = definition.get("aggregations") or definition.get("aggs")
+        (aggregation_type, args), = (
+            (key, value) for key, value in definition.items() if key not in ("aggregations", "aggs", "meta")
+        )
+
+        if aggregation_type == "filter":
+            filtered = [match for match in matches if self._matches(match[0], match[1], match[2], args)[0]]
+            result = {"doc_count": len(filtered)}
+            if sub_aggregations:
+                result.update(self._aggregate(filtered, sub_aggregations))
+            return result
+
+        if aggregation_type == "terms":
+            counts = self._term_counts(matches, args["field"])
+            ordered = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+            size = args.get("size", 10)
+            return {
+                "doc_count_error_upper_bound": 0,
+                "sum_other_doc_count": sum(count for _, count in ordered[size:]),
+                "buckets": [{"key": key, "doc_count": count} for key, count in ordered[:size]],
+            }
+
+        if aggregation_type == "cardinality":
+            return {"value": len(self._term_counts(matches, args["field"]))}
+
+        if aggregation_type == "composite":
+            (source_name, source_definition), = (next(iter(source.items())) for source in args["sources"])
+            counts = self._term_counts(matches, source_definition["terms"]["field"])
+            keys = sorted(counts)
+            if args.get("after"):
+                keys = [key for key in keys if key > args["after"][source_name]]
+            page = keys[:args.get("size", 10)]
+            result = {"buckets": [{"key": {source_name: key}, "doc_count": counts[key]} for key in page]}
+            if page:
+                result["after_key"] = {source_name: page[-1]}
+            return result
+
+        raise StandInError(400, "parsing_exception", "unknown aggregation type [{}]".format(aggregation_type))
+
+    @staticmethod
+    def _term_counts(matches, field_name):
+        counts = {}
+        for index, _, source, _ in matches:
+            field = index.field(field_name)
+            for value in set(itertools.chain.from_iterable(
+                field.terms(value) for value in _as_list(source.get(field_name))
+            )):
+                counts[value] = counts.get(value, 0) + 1
+        return counts
+
+
+def _filter_source(source, source_filter):
+    if source_filter is True:
+        return source
+    includes = source_filter if isinstance(source_filter, list) else (
+        [source_filter] if isinstance(source_filter, str) else source_filter.get("includes", ["*"])
+    )
+    patterns = [re.compile("^" + re.escape(pattern).replace(r"\*", ".*") + "$") for pattern in includes]
+    return {key: value for key, value in source.items() if any(pattern.match(key) for pattern in patterns)}
+
+
+def _find_query_string(query):
+    if not isinstance(query, dict):
+        return None
+    if "simple_query_string" in query:
+        return query["simple_query_string"]["query"]
+    for value in query.values():
+        for clause in (value if isinstance(value, list) else [value]):
+            found = _find_query_string(clause)
+            if found:
+                return found
+    return None
+
+
+def _parse_simple_query_string(query_string):
+    """Parse a query string into OR-ed groups of ``(negated, clause)`` tuples, supporting the operators
+    `|`, `+`, `-`, `"phrases"` and backslash escapes"""
+    groups, group = [], []
+    position, length = 0, len(query_string)
+
+    def read_until(stop_characters):
+        nonlocal position
+        text = []
+        while position < length and query_string[position] not in stop_characters:
+            if query_string[position] == "\\" and position + 1 < length:
+                position += 1
+            text.append(query_string[position])
+            position += 1
+        return "".join(text)
+
+    while position < length:
+        character = query_string[position]
+        if character.isspace():
+            position += 1
+        elif character == "|":
+            position += 1
+            if group:
+                groups.append(group)
+            group = []
+        else:
+            negated = character == "-"
+            if character in "+-":
+                position += 1
+                if position >= length:
+                    break
+            if query_string[position] == '"':
+                closing = position + 1
+                while closing < length and (query_string[closing] != '"' or query_string[closing - 1] == "\\"):
+                    closing += 1
+                position += 1
+                if closing < length:
+                    group.append((negated, read_until('"')))
+                    position += 1
+                continue
+            clause = read_until(" \t\n|")
+            if clause:
+                group.append((negated, clause))
+    if group:
+        groups.append(group)
+    return groups
+
+
+def _html_encode(text):
+    return html.escape(text, quote=True).replace("&#x27;", "&#x27;").replace("/", "&#x2F;")
+
+
+def _highlight_value(field, value, query_clauses, encode, pre_tag, post_tag):
+    if field.is_text:
+        wanted = {
+            term for clause in query_clauses for term, _, _ in _analyze_text(clause, field.stemming)
+        }
+        spans = [
+            (start, end) for term, start, end in _analyze_text(value, field.stemming) if term in wanted
+        ]
+    else:
+        spans = [(0, len(value))] if any(field.normalize(value) == field.normalize(c) for c in query_clauses) else []
+
+    if not spans:
+        return None
+
+    fragment, position = [], 0
+    for start, end in spans:
+        fragment.append(encode(value[position:start]))
+        fragment.append(pre_tag + encode(value[start:end]) + post_tag)
+        position = end
+    fragment.append(encode(value[position:]))
+    return "".join(fragment)
+
+
+class StandInConnection(Connection):
+    """An elasticsearch-py `Connection` which, rather than making HTTP requests, passes them straight to an
+    in-process `ElasticsearchStandIn`.
+
+    The stand-in to use is given as ``stand_in`` in the client's connection options, e.g.::
+
+        Elasticsearch(connection_class=StandInConnection, stand_in=ElasticsearchStandIn())
+    """
+
+    def __init__(self, stand_in=None, **kwargs):
+        super().__init__(**kwargs)
+        self.stand_in = stand_in if stand_in is not None else ElasticsearchStandIn()
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        start = time.time()
+        path, _, query_string = url.partition("?")
+        request_params = dict(params or {})
+        request_params.update(url_decode(query_string).to_dict())
+        status, response_body = self.stand_in.handle(method, path, request_params, body)
+        raw_data = "" if response_body is None else json.dumps(response_body)
+        duration = time.time() - start
+
+        if not (200 <= status < 300) and status not in ignore:
+            self.log_request_fail(method, url, path, body, duration, status, raw_data)
+            self._raise_error(status, raw_data)
+
+        self.log_request_success(method, url, path, body, status, raw_data, duration)
+        return status, {"content-type": "application/json"}, raw_data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to sleep before handling each request")
+    args = parser.parse_args()
+
+    from werkzeug.serving import run_simple
+    run_simple(args.host, args.port, ElasticsearchStandIn(latency=args.latency), threaded=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import time
+
+import pytest
+from elasticsearch import Elasticsearch, NotFoundError
+
+from app.mapping import load_mapping_definition
+from tests.elasticsearch_stand_in import ElasticsearchStandIn, StandInConnection
+
+
+@pytest.fixture
+def stand_in():
+    return ElasticsearchStandIn()
+
+
+@pytest.fixture
+def es(stand_in):
+    es = Elasticsearch(connection_class=StandInConnection, stand_in=stand_in)
+    es.indices.create(index="test-index", body=load_mapping_definition("services-g-cloud-10"))
+    for i, (name, lot, categories) in enumerate((
+        ("Cloud email", "SaaS", ["email", "collaboration"]),
+        ("Cloud hosting", "IaaS", ["compute"]),
+        ("Email archiving", "SaaS", ["email", "storage"]),
+    )):
+        es.index(index="test-index", id=str(i), body={
+            "dmtext_serviceName": name,
+            "dmfilter_lot": lot,
+            "dmagg_lot": lot,
+            "dmfilter_serviceCategories": categories,
+            "dmagg_serviceCategories": categories,
+        })
+    es.indices.refresh(index="test-index")
+    return es
+
+
+def _ids(response):
+    return sorted(hit["_id"] for hit in response["hits"]["hits"])
+
+
+def test_simple_query_string(es):
+    assert _ids(es.search(index="test-index", body={
+        "query": {"simple_query_string": {"query": "email", "fields": ["dmtext_serviceName"]}},
+    })) == ["0", "2"]
+    assert _ids(es.search(index="test-index", body={
+        "query": {"simple_query_string": {"query": "email -cloud", "fields": ["dmtext_serviceName"]}},
+    })) == ["2"]
+
+
+def test_term_and_terms_filters(es):
+    assert _ids(es.search(index="test-index", body={
+        "query": {"bool": {"filter": {"bool": {"must": [
+            {"term": {"dmfilter_lot": "SaaS"}},
+            {"terms": {"dmfilter_serviceCategories": ["storage", "compute"]}},
+        ]}}}},
+    })) == ["2"]
+
+
+def test_terms_aggregation(es):
+    response = es.search(index="test-index", body={
+        "size": 0,
+        "aggregations": {"serviceCategories": {"terms": {"field": "dmagg_serviceCategories", "size": 10}}},
+    })
+
+    assert response["aggregations"]["serviceCategories"]["buckets"][0] == {"key": "email", "doc_count": 2}
+    assert len(response["aggregations"]["serviceCategories"]["buckets"]) == 4
+
+
+def test_count(es):
+    assert es.count(index="test-index", body={"query": {"term": {"dmfilter_lot": "SaaS"}}})["count"] == 2
+
+
+def test_aliases(es):
+    es.indices.update_aliases({"actions": [{"add": {"index": "test-index", "alias": "test-alias"}}]})
+
+    assert es.get(index="test-alias", id="1")["_source"]["dmtext_serviceName"] == "Cloud hosting"
+    assert list(es.indices.get_mapping(index="test-alias")) == ["test-index"]
+    assert [(alias["alias"], alias["index"]) for alias in es.cat.aliases(format="json")] == [
+        ("test-alias", "test-index"),
+    ]
+
+
+def test_delete(es):
+    es.delete(index="test-index", id="1")
+    with pytest.raises(NotFoundError):
+        es.get(index="test-index", id="1")
+
+    es.indices.delete(index="test-index")
+    with pytest.raises(NotFoundError):
+        es.indices.get(index="test-index")
+
+
+def test_latency_can_be_injected(es, stand_in):
+    stand_in.latency = 0.05
+    start = time.monotonic()
+    es.get(index="test-index", id="1")
+
+    assert time.monotonic() - start >= 0.05